@@ -0,0 +1,387 @@
+"""
+Headless HTTP API around the question-answering engine, for other services and load balancers.
+
+    python api.py --port 8080
+
+Databases are configured on the server, in API_DATABASES as a JSON object of name → SQLAlchemy URI, or in
+DB_URI as "default". Clients refer to them by name, so credentials never travel with requests.
+
+    POST /v1/answer          {"question": "...", "database": "default", "history": [{"role": "human", "content": "..."}]}
+                             → {"sql": ..., "export_token": ..., "columns": [...], "rows": [[...]], "row_count": ...,
+                                "truncated": ..., "answer": ..., "seconds": ...}
+    POST /v1/answer/stream   Same body; newline-delimited JSON events of type "sql" (with the "export_token"),
+                             "result", "token", then "done" or "error".
+    POST /v1/export          {"export_token": "...", "format": "parquet"}, with "arrow" (IPC stream) and "csv" as
+                             other formats: the full result of a query answered above, streamed as a file.
+    GET  /health             Readiness, with the number of running and queued requests.
+    GET  /metrics            Stage latencies and counters in the Prometheus text format.
+
+Exports only run queries the pipeline generated and validated: the export token is an HMAC, signed with
+API_EXPORT_SECRET, of the database name and the query, valid for API_EXPORT_TTL seconds (3600). Raw SQL is
+refused. Replicas behind a load balancer need the same secret; without one, each process signs with a random
+key and only accepts its own tokens.
+
+At most API_MAX_CONCURRENCY questions are answered at once, and at most API_DB_CONCURRENCY per database
+(the size of its connection pool by default). Up to API_MAX_QUEUE further requests wait, for at most
+API_QUEUE_TIMEOUT seconds; beyond that the API answers 503 with a Retry-After header.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import time
+from contextlib import asynccontextmanager
+
+from aiohttp import web
+from langchain_core.messages import AIMessage, HumanMessage
+
+from async_pipeline import arunTurn, astreamTurn
+from config import loadConfig
+from engine_registry import adisposeAll, getSqlDatabase
+from metrics import METRICS, recordTurn, recordValue, timed
+from result_export import FORMATS, ResultExport
+from sql_guard import QueryRejected
+
+logger = logging.getLogger(__name__)
+
+HISTORY_ROLES = {"human": HumanMessage, "user": HumanMessage, "ai": AIMessage, "assistant": AIMessage}
+
+
+class Overloaded(Exception):
+    """Raised when a request can't get a slot in time; answered with 503 so that it is retried elsewhere."""
+
+
+class Admission:
+    """
+    Bounds the questions answered at once, overall and per database, and the number of requests waiting.
+
+    Waiting is capped in both count and time, so that a burst is shed right away instead of piling up behind
+    slow LLM calls.
+    """
+
+    def __init__(self, maxConcurrency: int, perDatabase: int, maxQueue: int, queueTimeout: float):
+        """
+        Args:
+            maxConcurrency (int): Questions answered at once.
+            perDatabase (int): Questions answered at once against the same database.
+            maxQueue (int): Requests allowed to wait for a slot.
+            queueTimeout (float): Longest wait for a slot, in seconds.
+        """
+        self.perDatabase = perDatabase
+        self.maxQueue = maxQueue
+        self.queueTimeout = queueTimeout
+        self.running = 0
+        self.waiting = 0
+        self._slots = asyncio.Semaphore(maxConcurrency)
+        self._databases = {}
+
+    async def _acquire(self, database: str):
+        semaphore = self._databases.setdefault(database, asyncio.Semaphore(self.perDatabase))
+        await semaphore.acquire()
+        try:
+            await self._slots.acquire()
+        except BaseException:
+            semaphore.release()
+            raise
+
+    @asynccontextmanager
+    async def slot(self, database: str):
+        """
+        Hold a slot for one question while the block runs.
+
+        Args:
+            database (str): The name of the database queried.
+
+        Raises:
+            Overloaded: If too many requests are waiting, or no slot frees up within the queue timeout.
+        """
+        if self.waiting >= self.maxQueue:
+            recordValue("api_rejections")
+            raise Overloaded("too many requests are waiting")
+        self.waiting += 1
+        try:
+            with timed("queue_wait"):
+                await asyncio.wait_for(self._acquire(database), self.queueTimeout)
+        except asyncio.TimeoutError:
+            recordValue("api_rejections")
+            raise Overloaded("no capacity became available in time") from None
+        finally:
+            self.waiting -= 1
+        self.running += 1
+        try:
+            yield
+        finally:
+            self.running -= 1
+            self._slots.release()
+            self._databases[database].release()
+
+
+def configuredDatabases() -> dict:
+    """
+    Returns:
+        dict: The SQLAlchemy URI of each database name, from API_DATABASES or else DB_URI.
+    """
+    if os.getenv("API_DATABASES"):
+        return json.loads(os.environ["API_DATABASES"])
+    return {"default": os.environ["DB_URI"]} if os.getenv("DB_URI") else {}
+
+
+def _dumps(value) -> str:
+    # Query results hold decimals and dates
+    return json.dumps(value, default=str)
+
+
+def _resultJson(result) -> dict:
+    return {"columns": result.columns, "rows": result.rows(), "row_count": result.rowCount,
+            "truncated": result.truncated}
+
+
+async def _readBody(request: web.Request) -> dict:
+    try:
+        body = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text="The body must be a JSON object") from None
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text="The body must be a JSON object")
+    return body
+
+
+def _database(request: web.Request, body: dict) -> tuple:
+    name = body.get("database", "default")
+    uri = request.app["databases"].get(name)
+    if uri is None:
+        raise web.HTTPNotFound(text=f"Unknown database {name!r}")
+    # Engines and their pools are shared per URI, across requests
+    return name, getSqlDatabase(uri)
+
+
+def signExport(secret: bytes, database: str, sql: str, ttl: float) -> str:
+    """
+    Args:
+        secret (bytes): The signing key.
+        database (str): The name of the database the query was answered on.
+        sql (str): The query, as validated by the pipeline.
+        ttl (float): Seconds the token stays valid.
+
+    Returns:
+        str: A token that lets /v1/export run this query, and only this one, on this database.
+    """
+    payload = base64.urlsafe_b64encode(_dumps([database, sql, time.time() + ttl]).encode()).decode()
+    signature = hmac.new(secret, payload.encode(), hashlib.sha256).hexdigest()
+    return f"{payload}.{signature}"
+
+
+def readExport(secret: bytes, token) -> tuple:
+    """
+    Check an export token.
+
+    Returns:
+        tuple: The database name and the query it was issued for.
+
+    Raises:
+        web.HTTPForbidden: If the token is malformed, forged or expired.
+    """
+    payload, _, signature = str(token).rpartition(".")
+    expected = hmac.new(secret, payload.encode(), hashlib.sha256).hexdigest()
+    if not payload or not hmac.compare_digest(signature, expected):
+        raise web.HTTPForbidden(text="Invalid export token")
+    database, sql, expires = json.loads(base64.urlsafe_b64decode(payload))
+    if time.time() > expires:
+        raise web.HTTPForbidden(text="The export token expired; ask the question again")
+    return database, sql
+
+
+def _exportToken(request: web.Request, database: str, sql: str) -> str:
+    app = request.app
+    return signExport(app["exportSecret"], database, sql, app["exportTtl"])
+
+
+async def _readRequest(request: web.Request) -> tuple:
+    body = await _readBody(request)
+    question = body.get("question")
+    if not isinstance(question, str) or not question.strip():
+        raise web.HTTPBadRequest(text='"question" must be a non-empty string')
+    name, db = _database(request, body)
+    history = []
+    for message in body.get("history") or []:
+        if not isinstance(message, dict) or message.get("role") not in HISTORY_ROLES:
+            raise web.HTTPBadRequest(text='"history" items need a "role" of human or ai and a "content"')
+        history.append(HISTORY_ROLES[message["role"]](content=str(message.get("content", ""))))
+    return question, name, db, history
+
+
+@web.middleware
+async def errorMiddleware(request: web.Request, handler):
+    """Turn engine errors into JSON responses with a matching status."""
+    try:
+        return await handler(request)
+    except web.HTTPException as error:
+        if error.status < 400:
+            raise
+        return web.json_response({"error": error.text}, status=error.status)
+    except Overloaded as error:
+        return web.json_response({"error": str(error)}, status=503, headers={"Retry-After": "1"})
+    except QueryRejected as error:
+        return web.json_response({"error": f"The generated query was rejected: {error}"}, status=422)
+    except asyncio.TimeoutError:
+        return web.json_response({"error": "The query timed out"}, status=504)
+
+
+async def answer(request: web.Request) -> web.Response:
+    """POST /v1/answer: answer a question in one response."""
+    question, name, db, history = await _readRequest(request)
+    async with request.app["admission"].slot(name):
+        with recordTurn(question) as record:
+            turn = await arunTurn(question, db, history, llm=request.app["llm"])
+    return web.json_response({"sql": turn.query, "export_token": _exportToken(request, name, turn.query),
+                              **_resultJson(turn.result), "answer": turn.answer,
+                              "seconds": record["stages"]["total"]}, dumps=_dumps)
+
+
+async def answerStream(request: web.Request) -> web.StreamResponse:
+    """POST /v1/answer/stream: send the SQL, the result and the answer tokens as soon as each is ready."""
+    question, name, db, history = await _readRequest(request)
+    async with request.app["admission"].slot(name):
+        # Headers go out once a slot is held, so overloaded requests still get a plain 503
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        start = time.perf_counter()
+        with recordTurn(question):
+            try:
+                async for kind, value in astreamTurn(question, db, history, llm=request.app["llm"]):
+                    if kind == "sql":
+                        event = {"type": "sql", "sql": value, "export_token": _exportToken(request, name, value)}
+                    elif kind == "result":
+                        event = {"type": "result", **_resultJson(value)}
+                    else:
+                        event = {"type": "token", "text": value}
+                    await response.write((_dumps(event) + "\n").encode())
+                event = {"type": "done", "seconds": time.perf_counter() - start}
+            except QueryRejected as error:
+                event = {"type": "error", "error": f"The generated query was rejected: {error}"}
+            except asyncio.TimeoutError:
+                event = {"type": "error", "error": "The query timed out"}
+            except Exception:
+                # The status line is already sent, so the failure can only be reported as an event
+                logger.exception("Streaming answer failed")
+                event = {"type": "error", "error": "Internal error"}
+        await response.write((_dumps(event) + "\n").encode())
+        await response.write_eof()
+    return response
+
+
+async def export(request: web.Request) -> web.StreamResponse:
+    """POST /v1/export: stream the full result of a query answered by /v1/answer as a file."""
+    body = await _readBody(request)
+    if "sql" in body:
+        raise web.HTTPBadRequest(text='Raw SQL is not accepted; send the "export_token" returned by /v1/answer')
+    token, format = body.get("export_token"), body.get("format", "parquet")
+    if not isinstance(token, str) or not token:
+        raise web.HTTPBadRequest(text='"export_token" must be the token returned by /v1/answer')
+    if format not in FORMATS:
+        raise web.HTTPBadRequest(text=f'"format" must be one of {", ".join(FORMATS)}')
+    name, sql = readExport(request.app["exportSecret"], token)
+    name, db = _database(request, {"database": name})
+    async with request.app["admission"].slot(name):
+        # Validated again, with the EXPLAIN cost check, without the LIMIT added for display
+        result_export = await asyncio.to_thread(ResultExport, db, sql, format)
+        response = web.StreamResponse(headers={
+            "Content-Type": result_export.contentType,
+            "Content-Disposition": f'attachment; filename="result{result_export.extension}"',
+        })
+        await response.prepare(request)
+        chunks = iter(result_export)
+        try:
+            # Each batch is fetched and encoded in a worker thread, and sent before the next one is read
+            while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+                await response.write(chunk)
+        except Exception:
+            # Closing without the final chunk tells the client that the file is incomplete
+            logger.exception("Export failed")
+            response.force_close()
+            return response
+        finally:
+            await asyncio.to_thread(chunks.close)
+        await response.write_eof()
+    return response
+
+
+async def health(request: web.Request) -> web.Response:
+    """GET /health"""
+    admission = request.app["admission"]
+    return web.json_response({"status": "ok", "running": admission.running, "waiting": admission.waiting,
+                              "databases": sorted(request.app["databases"])})
+
+
+async def metrics(request: web.Request) -> web.Response:
+    """GET /metrics"""
+    return web.Response(text=METRICS.toPrometheus(), content_type="text/plain")
+
+
+async def _disposeEngines(app: web.Application):
+    await adisposeAll()
+
+
+def createApp(databases: dict = None, llm=None, maxConcurrency: int = None, perDatabase: int = None,
+              maxQueue: int = None, queueTimeout: float = None, exportSecret: bytes = None) -> web.Application:
+    """
+    Build the aiohttp application.
+
+    Args:
+        databases (dict): SQLAlchemy URI of each database name. Defaults to `configuredDatabases()`.
+        llm: Optional chat model. Defaults to the shared Gemini client.
+        maxConcurrency (int): Questions answered at once. Defaults to API_MAX_CONCURRENCY or 32.
+        perDatabase (int): Questions answered at once per database. Defaults to API_DB_CONCURRENCY, or the
+            pool size plus overflow of the engines (DB_POOL_SIZE + DB_MAX_OVERFLOW, 10).
+        maxQueue (int): Requests allowed to wait for a slot. Defaults to API_MAX_QUEUE or 100.
+        queueTimeout (float): Longest wait for a slot, in seconds. Defaults to API_QUEUE_TIMEOUT or 10.
+        exportSecret (bytes): Key signing export tokens. Defaults to API_EXPORT_SECRET, or a random key.
+
+    Returns:
+        web.Application: The application, to be served with `web.run_app` or a test server.
+    """
+    maxConcurrency = int(os.getenv("API_MAX_CONCURRENCY", "32")) if maxConcurrency is None else maxConcurrency
+    if perDatabase is None:
+        pool = int(os.getenv("DB_POOL_SIZE", "5")) + int(os.getenv("DB_MAX_OVERFLOW", "5"))
+        perDatabase = int(os.getenv("API_DB_CONCURRENCY", str(pool)))
+    maxQueue = int(os.getenv("API_MAX_QUEUE", "100")) if maxQueue is None else maxQueue
+    queueTimeout = float(os.getenv("API_QUEUE_TIMEOUT", "10")) if queueTimeout is None else queueTimeout
+    if exportSecret is None:
+        exportSecret = os.getenv("API_EXPORT_SECRET", "").encode() or secrets.token_bytes(32)
+
+    app = web.Application(middlewares=[errorMiddleware])
+    app["databases"] = configuredDatabases() if databases is None else databases
+    app["llm"] = llm
+    app["admission"] = Admission(maxConcurrency, perDatabase, maxQueue, queueTimeout)
+    app["exportSecret"] = exportSecret
+    app["exportTtl"] = float(os.getenv("API_EXPORT_TTL", "3600"))
+    app.router.add_post("/v1/answer", answer)
+    app.router.add_post("/v1/answer/stream", answerStream)
+    app.router.add_post("/v1/export", export)
+    app.router.add_get("/health", health)
+    app.router.add_get("/metrics", metrics)
+    app.on_cleanup.append(_disposeEngines)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=os.getenv("API_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("API_PORT", "8080")))
+    args = parser.parse_args()
+
+    app = createApp()
+    if not app["databases"]:
+        parser.error("set API_DATABASES or DB_URI")
+    logging.basicConfig(level=logging.INFO)
+    web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    loadConfig()
+    main()
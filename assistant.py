@@ -0,0 +1,100 @@
+from urllib.parse import quote_plus
+
+# SQLAlchemy drivers of the databases offered by the pages
+DRIVERS = {
+    "MySQL": "mysql+pymysql",
+    "PostgreSQL": "postgresql+psycopg2",
+}
+
+
+def connectionUri(database: str, user: str, password: str, host: str, port: str, name: str) -> str:
+    """
+    Build the SQLAlchemy connection URI of a database server.
+
+    Args:
+        database (str): "MySQL" or "PostgreSQL".
+        user (str): The database user.
+        password (str): The database user's password.
+        host (str): The database host.
+        port (str): The database port.
+        name (str): The name of the database.
+
+    Returns:
+        str: The connection URI, with the password escaped.
+    """
+    return f"{DRIVERS[database]}://{user}:{quote_plus(password)}@{host}:{port}/{name}"
+
+
+def initDatabase(dbUri: str):
+    """
+    Initialize the connection to a database.
+
+    Args:
+        dbUri (str): The SQLAlchemy connection URI.
+
+    Returns:
+        tuple: A tuple containing the SQLDatabase object and the SQLAlchemy engine.
+    """
+    # Imported here so that the pages load SQLAlchemy only once they connect
+    from engine_registry import getSqlDatabase
+
+    # Engines are shared process-wide, so the SQLDatabase reuses the same connection pool
+    sql_database = getSqlDatabase(dbUri)
+    return sql_database, sql_database._engine
+
+
+def initMysqlDatabase(user: str, password: str, host: str, port: str, database: str):
+    """
+    Initialize the connection to the MySQL database.
+
+    Args:
+        user (str): The database user.
+        password (str): The database user's password.
+        host (str): The database host.
+        port (str): The database port.
+        database (str): The name of the database.
+
+    Returns:
+        tuple: A tuple containing the SQLDatabase object and the SQLAlchemy engine.
+    """
+    return initDatabase(connectionUri("MySQL", user, password, host, port, database))
+
+
+def initPostgresDatabase(user: str, password: str, host: str, port: str, database: str):
+    """
+    Initialize the connection to the PostgreSQL database.
+
+    Args:
+        user (str): The database user.
+        password (str): The database user's password.
+        host (str): The database host.
+        port (str): The database port.
+        database (str): The name of the database.
+
+    Returns:
+        tuple: A tuple containing the SQLDatabase object and the SQLAlchemy engine.
+    """
+    return initDatabase(connectionUri("PostgreSQL", user, password, host, port, database))
+
+
+def getResponse(userQuery: str, db, chatHistory: list):
+    """
+    Generate a natural language response to the user's question based on the database content.
+
+    Args:
+        userQuery (str): The user's natural language question.
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        chatHistory (list): The history of the chat interaction.
+
+    Returns:
+        str: The natural language response to the user's question.
+    """
+    from chain_factory import getResponseChain
+
+    # The chain and its LLM clients are built once per connection and reused across turns
+    chain = getResponseChain(db)
+
+    return chain.invoke({
+        "question": userQuery,
+        "chat_history": chatHistory,
+    })
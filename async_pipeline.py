@@ -0,0 +1,85 @@
+from dataclasses import dataclass
+
+from chain_factory import arunQuery, getAnswerChain, getSqlChain
+from query_runner import QueryResult
+
+
+@dataclass
+class Turn:
+    """Everything produced while answering one question."""
+    question: str
+    query: str
+    result: QueryResult
+    answer: str
+
+
+async def arunTurn(userQuery: str, db, chatHistory: list, llm=None, timeout: float = None) -> Turn:
+    """
+    Answer a question with non-blocking I/O: async LLM calls and an async SQLAlchemy engine.
+
+    The turn runs the chains of `chain_factory` with `ainvoke`, so it is validated, cached and answered
+    exactly like `getResponse`; the query is cancelled once it exceeds the statement timeout.
+
+    Args:
+        userQuery (str): The user's natural language question.
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        chatHistory (list): The history of the chat interaction.
+        llm: Optional chat model. Defaults to the shared Gemini client.
+        timeout (float): Statement timeout in seconds. Defaults to QUERY_TIMEOUT or 30.
+
+    Returns:
+        Turn: The generated SQL query, its result and the natural language answer.
+    """
+    sql_chain, answer_chain = getSqlChain(db, llm), getAnswerChain(db, llm)
+    variables = {"question": userQuery, "chat_history": chatHistory}
+    query = await sql_chain.ainvoke(variables)
+    result = await arunQuery(db, query, userQuery, timeout=timeout)
+    answer = await answer_chain.ainvoke({**variables, "query": query, "result": result})
+    return Turn(question=userQuery, query=query, result=result, answer=answer)
+
+
+async def astreamTurn(userQuery: str, db, chatHistory: list, llm=None, timeout: float = None):
+    """
+    Streaming variant of `arunTurn`: yields each part of the turn as soon as it is ready.
+
+    The events are ("sql", query) once the query is generated and validated, ("result", QueryResult) once it
+    ran, then ("token", text) for each piece of the answer. Templated answers are a single token and don't
+    repeat the result table.
+
+    Args:
+        userQuery (str): The user's natural language question.
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        chatHistory (list): The history of the chat interaction.
+        llm: Optional chat model. Defaults to the shared Gemini client.
+        timeout (float): Statement timeout in seconds. Defaults to QUERY_TIMEOUT or 30.
+
+    Yields:
+        tuple: The event type and its value.
+    """
+    sql_chain, answer_chain = getSqlChain(db, llm), getAnswerChain(db, llm)
+    variables = {"question": userQuery, "chat_history": chatHistory}
+    query = await sql_chain.ainvoke(variables)
+    yield "sql", query
+    result = await arunQuery(db, query, userQuery, timeout=timeout)
+    yield "result", result
+    async for token in answer_chain.astream({**variables, "query": query, "result": result,
+                                             "inline_table": False}):
+        yield "token", token
+
+
+async def agetResponse(userQuery: str, db, chatHistory: list, llm=None, timeout: float = None) -> str:
+    """
+    Async variant of `getResponse`.
+
+    Args:
+        userQuery (str): The user's natural language question.
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        chatHistory (list): The history of the chat interaction.
+        llm: Optional chat model. Defaults to the shared Gemini client.
+        timeout (float): Statement timeout in seconds. Defaults to QUERY_TIMEOUT or 30.
+
+    Returns:
+        str: The natural language response to the user's question.
+    """
+    turn = await arunTurn(userQuery, db, chatHistory, llm=llm, timeout=timeout)
+    return turn.answer
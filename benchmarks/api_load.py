@@ -0,0 +1,105 @@
+"""
+Load test of the HTTP API on a seeded SQLite database with a replaying fake LLM.
+
+The API is served in-process on a free local port and hit by `--clients` concurrent clients. Reports the
+throughput, the latency percentiles of successful requests, the status codes (503 when the admission limits
+shed load) and the server-side stage breakdown, including the time spent waiting for a slot. Run from the
+repository root:
+
+    python -m benchmarks.api_load --requests 1000 --clients 64 --llm-latency 0.2
+    python -m benchmarks.api_load --requests 1000 --clients 256 --max-concurrency 16 --max-queue 32 --stream
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from collections import Counter
+
+from aiohttp import ClientSession, TCPConnector
+from aiohttp.test_utils import TestServer
+
+from api import createApp
+from benchmarks.fixtures import QUESTIONS, ReplayChatModel, createDatabase
+from metrics import METRICS, Metrics
+
+REPORTED_STAGES = ["request", "first_byte", "queue_wait", "schema", "sql_generation", "sql_guard",
+                   "query_execution", "answer_generation"]
+
+
+async def load(url: str, args, results: Metrics) -> Counter:
+    statuses = Counter()
+    pending = iter(range(args.requests))
+
+    async def client(session: ClientSession):
+        for index in pending:
+            body = {"question": QUESTIONS[index % len(QUESTIONS)][0]}
+            start = time.perf_counter()
+            async with session.post(url, json=body) as response:
+                if response.status == 200 and args.stream:
+                    # Time until the SQL event, the first thing a streaming client can show
+                    await response.content.readline()
+                    results.observe("first_byte", time.perf_counter() - start)
+                await response.read()
+            statuses[response.status] += 1
+            if response.status == 200:
+                results.observe("request", time.perf_counter() - start)
+
+    async with ClientSession(connector=TCPConnector(limit=args.clients)) as session:
+        await asyncio.gather(*(client(session) for _ in range(args.clients)))
+    return statuses
+
+
+async def run(args):
+    if not args.cache:
+        # Zero-sized caches keep nothing, so every request generates and runs its query
+        os.environ["SQL_CACHE_SIZE"] = os.environ["RESULT_CACHE_SIZE"] = "0"
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "benchmark.db")
+        createDatabase(path, tables=args.tables, rows=args.rows, seed=args.seed)
+
+        llm = ReplayChatModel(answers=dict(QUESTIONS), default="Here is what I found in the database.",
+                              latency=args.llm_latency)
+        app = createApp(databases={"default": f"sqlite:///{path}"}, llm=llm, maxConcurrency=args.max_concurrency,
+                        perDatabase=args.max_concurrency, maxQueue=args.max_queue, queueTimeout=args.queue_timeout)
+        server = TestServer(app)
+        await server.start_server()
+        try:
+            url = str(server.make_url("/v1/answer/stream" if args.stream else "/v1/answer"))
+            results = Metrics()
+            start = time.perf_counter()
+            statuses = await load(url, args, results)
+            elapsed = time.perf_counter() - start
+        finally:
+            await server.close()
+
+    print(f"\n{args.requests} requests from {args.clients} clients in {elapsed:.2f}s: "
+          f"{statuses[200] / elapsed:.1f} answered/s")
+    print("status codes: " + ", ".join(f"{status}: {count}" for status, count in sorted(statuses.items())))
+    print(f"\n{'stage':<22}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}")
+    for stage in REPORTED_STAGES:
+        source = results if stage in results.stages() else METRICS
+        if stage not in source.stages():
+            continue
+        percentiles = [source.percentile(stage, quantile) * 1000 for quantile in (0.5, 0.9, 0.99)]
+        print(f"{stage:<22}" + "".join(f"{value:>10.2f}" for value in percentiles))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--clients", type=int, default=64, help="concurrent clients")
+    parser.add_argument("--llm-latency", type=float, default=0.1, help="seconds per fake LLM call")
+    parser.add_argument("--max-concurrency", type=int, default=32, help="questions answered at once")
+    parser.add_argument("--max-queue", type=int, default=100, help="requests allowed to wait for a slot")
+    parser.add_argument("--queue-timeout", type=float, default=10)
+    parser.add_argument("--stream", action="store_true", help="use the streaming endpoint")
+    parser.add_argument("--cache", action="store_true", help="keep the SQL and result caches enabled")
+    parser.add_argument("--tables", type=int, default=20)
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
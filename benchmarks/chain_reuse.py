@@ -0,0 +1,75 @@
+"""
+Micro-benchmark: per-turn overhead of rebuilding the chains and Gemini clients versus reusing them.
+
+The LLM calls are replaced by a stubbed chat model, so only the LangChain plumbing, client construction
+and the SQLite query are measured. Run from the repository root:
+
+    python -m benchmarks.chain_reuse --turns 200
+"""
+import argparse
+import statistics
+import time
+
+from langchain_core.language_models import FakeListChatModel
+from langchain_google_genai import ChatGoogleGenerativeAI
+
+from chain_factory import buildResponseChain, buildSqlChain
+from engine_registry import getSqlDatabase
+
+QUESTION = {"question": "How many students are there?", "chat_history": []}
+
+
+def stubbedLlms():
+    sql_llm = FakeListChatModel(responses=["SELECT COUNT(*) FROM student;"])
+    answer_llm = FakeListChatModel(responses=["There are 4 students."])
+    return sql_llm, answer_llm
+
+
+def rebuildTurn(db):
+    # What getResponse used to do on every message: two new clients, two prompts, two chain graphs
+    for _ in range(2):
+        ChatGoogleGenerativeAI(model="gemini-pro", google_api_key="benchmark", temperature=0.7, top_p=0.85)
+    sql_llm, answer_llm = stubbedLlms()
+    chain = buildResponseChain(db, answer_llm, buildSqlChain(db, sql_llm))
+    return chain.invoke(QUESTION)
+
+
+def timeTurns(turn, turns: int) -> list:
+    timings = []
+    for _ in range(turns):
+        start = time.perf_counter()
+        turn()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def report(name: str, timings: list):
+    print(f"{name:<10} mean {statistics.mean(timings):7.2f} ms   "
+          f"median {statistics.median(timings):7.2f} ms   max {max(timings):7.2f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database", default="sqlite:///student.db")
+    parser.add_argument("--turns", type=int, default=100)
+    args = parser.parse_args()
+
+    db = getSqlDatabase(args.database)
+
+    sql_llm, answer_llm = stubbedLlms()
+    cached_chain = buildResponseChain(db, answer_llm, buildSqlChain(db, sql_llm))
+
+    # Warm up the schema cache and LangChain's lazy imports so both modes start equal
+    rebuildTurn(db)
+    cached_chain.invoke(QUESTION)
+
+    rebuilt = timeTurns(lambda: rebuildTurn(db), args.turns)
+    reused = timeTurns(lambda: cached_chain.invoke(QUESTION), args.turns)
+
+    report("rebuild", rebuilt)
+    report("reuse", reused)
+    print(f"per-turn overhead saved: {statistics.mean(rebuilt) - statistics.mean(reused):.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
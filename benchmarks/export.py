@@ -0,0 +1,69 @@
+"""
+Benchmark: streaming export of large results, against materializing them with `executeQuery`.
+
+For each result size the export is written to a temporary file in every format. The wall time and, from a
+second run, the peak of Python memory allocations (tracemalloc) are reported. The peak of the exports should
+stay flat as the row count grows. Run from the repository root:
+
+    python -m benchmarks.export --rows 50000 200000 --batch-size 10000
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+# Imported up front so that the first Parquet export doesn't count the import in its memory peak
+import pyarrow.parquet  # noqa: F401
+
+from benchmarks.fixtures import createDatabase
+from engine_registry import disposeAll, getSqlDatabase
+from query_runner import executeQuery
+from result_export import FORMATS, ResultExport
+
+QUERY = ("SELECT oi.order_item_id, oi.quantity, oi.revenue, o.order_date, o.status FROM order_items oi "
+         "JOIN orders o ON o.order_id = oi.order_id")
+
+
+def measure(function) -> tuple:
+    # Timed without tracemalloc, which slows allocations down, then run again for the memory peak
+    start = time.perf_counter()
+    rows = function()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        function()
+        return rows, seconds, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[50000, 200000], help="orders per database")
+    parser.add_argument("--batch-size", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'orders':>10}{'method':>14}{'rows':>10}{'seconds':>10}{'peak MB':>10}")
+    for orders in args.rows:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "benchmark.db")
+            createDatabase(path, tables=6, rows=orders, seed=args.seed)
+            db = getSqlDatabase(f"sqlite:///{path}")
+
+            def materialize():
+                return executeQuery(db, QUERY, maxRows=10 ** 9, maxBytes=10 ** 12).rowCount
+
+            results = {"materialized": measure(materialize)}
+            for format in FORMATS:
+                export = ResultExport(db, QUERY, format, batchSize=args.batch_size)
+                output = os.path.join(directory, "export" + export.extension)
+                results[format] = measure(lambda: export.save(output))
+            for method, (rows, seconds, peak) in results.items():
+                print(f"{orders:>10}{method:>14}{rows:>10}{seconds:>10.2f}{peak / 1e6:>10.1f}")
+            disposeAll()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+Seeded SQLite databases and canned question/SQL pairs for the offline benchmarks.
+
+Rows are generated in bulk with `executemany` inside a single transaction per table.
+"""
+import asyncio
+import random
+import sqlite3
+import time
+from datetime import date, timedelta
+
+from langchain_core.language_models.chat_models import SimpleChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+CORE_TABLES = {
+    "customers": ["customer_id INTEGER PRIMARY KEY", "name TEXT", "email TEXT", "region TEXT", "signup_date DATE"],
+    "products": ["product_id INTEGER PRIMARY KEY", "title TEXT", "category TEXT", "unit_price REAL"],
+    "orders": ["order_id INTEGER PRIMARY KEY", "customer_id INTEGER REFERENCES customers(customer_id)",
+               "order_date DATE", "status TEXT"],
+    "order_items": ["order_item_id INTEGER PRIMARY KEY", "order_id INTEGER REFERENCES orders(order_id)",
+                    "product_id INTEGER REFERENCES products(product_id)", "quantity INTEGER", "revenue REAL"],
+    "employees": ["employee_id INTEGER PRIMARY KEY", "full_name TEXT", "department TEXT", "salary REAL"],
+    "invoices": ["invoice_id INTEGER PRIMARY KEY", "order_id INTEGER REFERENCES orders(order_id)",
+                 "amount REAL", "paid_at DATE"],
+}
+
+# Questions a user would ask about the core tables, with the SQL a well-behaved LLM would write
+QUESTIONS = [
+    ("top 10 customers by revenue",
+     "SELECT c.name, SUM(oi.revenue) AS revenue FROM customers c JOIN orders o ON o.customer_id = c.customer_id "
+     "JOIN order_items oi ON oi.order_id = o.order_id GROUP BY c.customer_id ORDER BY revenue DESC LIMIT 10"),
+    ("how many orders were placed per month",
+     "SELECT strftime('%Y-%m', order_date) AS month, COUNT(*) FROM orders GROUP BY month ORDER BY month"),
+    ("average salary per department",
+     "SELECT department, AVG(salary) FROM employees GROUP BY department"),
+    ("which product category sells the most units",
+     "SELECT p.category, SUM(oi.quantity) AS units FROM order_items oi JOIN products p "
+     "ON p.product_id = oi.product_id GROUP BY p.category ORDER BY units DESC LIMIT 1"),
+    ("total unpaid invoice amount",
+     "SELECT SUM(amount) FROM invoices WHERE paid_at IS NULL"),
+    ("how many customers are there",
+     "SELECT COUNT(*) FROM customers"),
+    ("revenue by region",
+     "SELECT c.region, SUM(oi.revenue) FROM customers c JOIN orders o ON o.customer_id = c.customer_id "
+     "JOIN order_items oi ON oi.order_id = o.order_id GROUP BY c.region"),
+    ("list the 20 most recent orders",
+     "SELECT * FROM orders ORDER BY order_date DESC LIMIT 20"),
+]
+
+FILLER_WORDS = ["audit", "session", "shipment", "warehouse", "supplier", "campaign", "ticket", "refund",
+                "inventory", "payroll", "contract", "vendor", "budget", "asset", "lead", "visit"]
+REGIONS = ["north", "south", "east", "west"]
+CATEGORIES = ["books", "games", "garden", "kitchen", "music", "sports", "tools", "toys"]
+DEPARTMENTS = ["engineering", "finance", "marketing", "sales", "support"]
+STATUSES = ["new", "paid", "shipped", "cancelled"]
+
+
+def _day(index: int) -> str:
+    return (date(2023, 1, 1) + timedelta(days=index % 730)).isoformat()
+
+
+def createDatabase(path: str, tables: int = 20, rows: int = 10000, seed: int = 0):
+    """
+    Create a SQLite database with the core sales tables plus filler tables.
+
+    Args:
+        path (str): The database file to create. It must not exist yet.
+        tables (int): Total number of tables, core tables included.
+        rows (int): Number of orders; the other core tables are sized relative to it.
+        seed (int): Random seed, so that the same arguments always produce the same data.
+    """
+    rng = random.Random(seed)
+    customers = max(rows // 10, 1)
+    products = max(rows // 50, 1)
+    employees = max(rows // 100, 1)
+
+    data = {
+        "customers": ((i, f"customer {i}", f"customer{i}@example.com", rng.choice(REGIONS), _day(i))
+                      for i in range(customers)),
+        "products": ((i, f"product {i}", rng.choice(CATEGORIES), round(rng.uniform(1, 200), 2))
+                     for i in range(products)),
+        "orders": ((i, rng.randrange(customers), _day(rng.randrange(730)), rng.choice(STATUSES))
+                   for i in range(rows)),
+        "order_items": ((i, i // 2, rng.randrange(products), rng.randint(1, 5), round(rng.uniform(1, 500), 2))
+                        for i in range(rows * 2)),
+        "employees": ((i, f"employee {i}", rng.choice(DEPARTMENTS), round(rng.uniform(30000, 150000), 2))
+                      for i in range(employees)),
+        "invoices": ((i, i, round(rng.uniform(1, 1000), 2), _day(i) if rng.random() < 0.8 else None)
+                     for i in range(rows)),
+    }
+
+    connection = sqlite3.connect(path)
+    try:
+        for name, columns in CORE_TABLES.items():
+            with connection:
+                connection.execute(f"CREATE TABLE {name} ({', '.join(columns)})")
+                placeholders = ", ".join("?" * len(columns))
+                connection.executemany(f"INSERT INTO {name} VALUES ({placeholders})", data[name])
+        for number in range(max(tables - len(CORE_TABLES), 0)):
+            word = rng.choice(FILLER_WORDS)
+            columns = [f"{word}_id INTEGER PRIMARY KEY"] + [
+                f"{rng.choice(FILLER_WORDS)}_attr_{column} TEXT" for column in range(rng.randint(3, 10))
+            ]
+            name = f"{word}_log_{number}"
+            with connection:
+                connection.execute(f"CREATE TABLE {name} ({', '.join(columns)})")
+                connection.executemany(f"INSERT INTO {name} ({word}_id) VALUES (?)", [(row,) for row in range(10)])
+    finally:
+        connection.close()
+
+
+# What a failing LLM reply looks like: valid syntax, but the column doesn't exist
+INVALID_SQL = "SELECT order_total FROM orders"
+
+
+class ReplayChatModel(SimpleChatModel):
+    """
+    Deterministic stand-in for the SQL-writing LLM: replays the canned SQL of the question found in the prompt.
+
+    `latency` seconds are spent before each reply, asleep rather than in a thread when called asynchronously.
+    With `jitter`, the latency is multiplied by a log-normal factor of that sigma, which gives a long tail.
+    With `failureRate`, that share of the replies is a query the database can't plan.
+    """
+    answers: dict
+    default: str = "SELECT 1"
+    latency: float = 0.0
+    jitter: float = 0.0
+    failureRate: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "replay"
+
+    def _delay(self) -> float:
+        return self.latency * random.lognormvariate(0, self.jitter) if self.jitter else self.latency
+
+    def _reply(self, messages) -> str:
+        if self.failureRate and random.random() < self.failureRate:
+            return INVALID_SQL
+        # Few-shot examples also start with "Question:", the question being asked is the last one
+        prompt = str(messages[-1].content)
+        asked = prompt.rsplit("Question:", 1)[-1].split("\n", 1)[0].strip()
+        return self.answers.get(asked, self.default)
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs) -> str:
+        time.sleep(self._delay())
+        return self._reply(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        await asyncio.sleep(self._delay())
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self._reply(messages)))])
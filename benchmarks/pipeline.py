@@ -0,0 +1,139 @@
+"""
+Offline benchmark of the chat pipeline on a seeded SQLite database with deterministic fake LLMs.
+
+Reports latency percentiles for schema introspection, query execution and end-to-end turns, plus the
+per-stage breakdown recorded by `metrics`. With --baseline it acts as a regression gate and exits with
+status 1 when a p50 got slower than the tolerance allows. Run from the repository root:
+
+    python -m benchmarks.pipeline --tables 50 --rows 20000 --turns 200 --save baseline.json
+    python -m benchmarks.pipeline --tables 50 --rows 20000 --turns 200 --baseline baseline.json
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from langchain_core.language_models import FakeListChatModel
+from langchain_core.runnables import RunnablePassthrough
+
+from benchmarks.fixtures import QUESTIONS, ReplayChatModel, createDatabase
+from chain_factory import buildAnswerChain, buildSqlChain
+from engine_registry import disposeAll, getSqlDatabase
+from metrics import METRICS, Metrics, recordTurn
+from query_runner import executeQuery
+from result_cache import getResultCache
+from schema_cache import SchemaCache
+from sql_cache import SqlCache, withSqlCache
+from table_selector import selectTables
+
+REPORTED_STAGES = ["schema_introspection", "schema_lookup", "query_execution", "turn",
+                   "schema", "example_retrieval", "sql_generation", "sql_guard", "answer_generation"]
+
+
+def buildChain(db, cached: bool):
+    sql_llm = ReplayChatModel(answers=dict(QUESTIONS))
+    answer_llm = FakeListChatModel(responses=["Here is what I found in the database."])
+    # A zero-sized SQL cache evicts every entry immediately, so every turn pays for SQL generation
+    sql_cache = SqlCache(maxSize=1000 if cached else 0)
+    sql_chain = withSqlCache(db, buildSqlChain(db, sql_llm), sql_cache)
+    return RunnablePassthrough.assign(query=sql_chain) | buildAnswerChain(db, answer_llm)
+
+
+def run(args) -> dict:
+    results = Metrics()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "benchmark.db")
+        start = time.perf_counter()
+        createDatabase(path, tables=args.tables, rows=args.rows, seed=args.seed)
+        print(f"seeded {args.tables} tables, {args.rows} orders in {time.perf_counter() - start:.2f}s")
+
+        db = getSqlDatabase(f"sqlite:///{path}")
+
+        for _ in range(args.introspections):
+            start = time.perf_counter()
+            SchemaCache(db).refresh()
+            results.observe("schema_introspection", time.perf_counter() - start)
+
+        for index in range(args.turns):
+            question = QUESTIONS[index % len(QUESTIONS)][0]
+            start = time.perf_counter()
+            selectTables(db, question)
+            results.observe("schema_lookup", time.perf_counter() - start)
+
+        for index in range(args.turns):
+            start = time.perf_counter()
+            executeQuery(db, QUESTIONS[index % len(QUESTIONS)][1])
+            results.observe("query_execution", time.perf_counter() - start)
+
+        chain = buildChain(db, args.cache)
+        wall_start = time.perf_counter()
+        for index in range(args.turns):
+            if not args.cache:
+                getResultCache().clear()
+            question = QUESTIONS[index % len(QUESTIONS)][0]
+            start = time.perf_counter()
+            with recordTurn(question):
+                chain.invoke({"question": question, "chat_history": []})
+            results.observe("turn", time.perf_counter() - start)
+        throughput = args.turns / (time.perf_counter() - wall_start)
+        disposeAll()
+
+    report = {"throughput_turns_per_second": throughput, "stages": {}}
+    for stage in REPORTED_STAGES:
+        source = results if stage in results.stages() else METRICS
+        if stage not in source.stages():
+            continue
+        report["stages"][stage] = {
+            f"p{int(quantile * 100)}": source.percentile(stage, quantile) * 1000 for quantile in (0.5, 0.95, 0.99)
+        }
+    return report
+
+
+def printReport(report: dict):
+    print(f"\n{'stage':<22}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, percentiles in report["stages"].items():
+        print(f"{stage:<22}{percentiles['p50']:>10.2f}{percentiles['p95']:>10.2f}{percentiles['p99']:>10.2f}")
+    print(f"\nend-to-end throughput: {report['throughput_turns_per_second']:.1f} turns/s")
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for stage, percentiles in baseline["stages"].items():
+        current = report["stages"].get(stage)
+        if current is not None and current["p50"] > percentiles["p50"] * tolerance:
+            regressions.append(f"{stage}: p50 {current['p50']:.2f} ms vs baseline {percentiles['p50']:.2f} ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tables", type=int, default=50)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--turns", type=int, default=100)
+    parser.add_argument("--introspections", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--cache", action="store_true", help="keep the SQL and result caches enabled")
+    parser.add_argument("--save", help="write the report to this JSON file")
+    parser.add_argument("--baseline", help="compare against a report saved with --save")
+    parser.add_argument("--tolerance", type=float, default=1.25, help="allowed p50 slowdown factor")
+    args = parser.parse_args()
+
+    report = run(args)
+    printReport(report)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            regressions = compare(report, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
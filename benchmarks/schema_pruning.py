@@ -0,0 +1,62 @@
+"""
+Benchmark: schema tokens in the SQL-generation prompt with and without relevant-table pruning.
+
+A throwaway SQLite database with many tables is generated, then for each question the full schema
+snapshot is compared with the schema of the tables picked by `table_selector.selectTables`.
+Run from the repository root, with SCHEMA_FORMAT=ddl to measure the CREATE TABLE format:
+
+    python -m benchmarks.schema_pruning --tables 200 --top-k 5
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from benchmarks.fixtures import createDatabase
+from chat_history import estimateTokens
+from engine_registry import getSqlDatabase
+from schema_cache import getSchemaCache
+from table_selector import selectTables
+
+QUESTIONS = [
+    ("top 10 customers by revenue", {"customers", "order_items"}),
+    ("how many orders were placed last month", {"orders"}),
+    ("average salary per department", {"employees"}),
+    ("which product category sells the most units", {"products", "order_items"}),
+    ("total unpaid invoice amount", {"invoices"}),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tables", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "benchmark.db")
+        createDatabase(path, tables=args.tables, rows=100)
+        db = getSqlDatabase(f"sqlite:///{path}")
+        schema_cache = getSchemaCache(db)
+        full_tokens = estimateTokens(schema_cache.refresh())
+
+        pruned_tokens, selection_ms, recall = [], [], []
+        for question, expected in QUESTIONS:
+            start = time.perf_counter()
+            tables = selectTables(db, question, args.top_k)
+            selection_ms.append((time.perf_counter() - start) * 1000)
+            pruned_tokens.append(estimateTokens(schema_cache.getTableInfo(tables)))
+            recall.append(len(expected & set(tables)) / len(expected))
+            print(f"{question:<45} {', '.join(tables)}")
+
+        print(f"\nschema tokens, full:   {full_tokens}")
+        print(f"schema tokens, pruned: {statistics.mean(pruned_tokens):.0f} (mean over {len(QUESTIONS)} questions)")
+        print(f"reduction:             {full_tokens / statistics.mean(pruned_tokens):.1f}x")
+        print(f"expected-table recall: {statistics.mean(recall):.0%}")
+        print(f"selection time:        {statistics.mean(selection_ms):.2f} ms mean")
+        db._engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Benchmark: speculative SQL candidates against sequential retry, with a slow and unreliable fake LLM.
+
+The fake LLM answers after a log-normal latency and writes a query the database can't plan for a share of
+its replies. Every strategy answers the same questions through `buildSqlChain`, and the latency percentiles,
+the share of questions still failing after the retry and the number of LLM calls are reported. Run from the
+repository root:
+
+    python -m benchmarks.speculative --turns 200 --failure-rate 0.3 --candidates 3
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from benchmarks.fixtures import QUESTIONS, ReplayChatModel, createDatabase
+from chain_factory import buildSqlChain
+from engine_registry import disposeAll, getSqlDatabase
+from metrics import Metrics
+from sql_guard import QueryRejected
+
+
+class CallCounter(BaseCallbackHandler):
+    """Counts chat model calls, including those of candidates whose results are dropped."""
+
+    def __init__(self):
+        self.calls = []
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        # list.append is atomic, and candidates call from several threads
+        self.calls.append(kwargs.get("run_id"))
+
+
+def runStrategy(db, args, candidates: int, mode: str) -> dict:
+    os.environ["SQL_CANDIDATES"] = str(candidates)
+    os.environ["SQL_CANDIDATE_MODE"] = mode
+    # The same seed gives every strategy the same questions and the same luck on its first call
+    random.seed(args.seed)
+    llm = ReplayChatModel(answers=dict(QUESTIONS), latency=args.llm_latency, jitter=args.jitter,
+                          failureRate=args.failure_rate)
+    chain = buildSqlChain(db, llm)
+    latencies = Metrics()
+    failures = 0
+    counter = CallCounter()
+    for index in range(args.turns):
+        question = QUESTIONS[index % len(QUESTIONS)][0]
+        start = time.perf_counter()
+        try:
+            chain.invoke({"question": question, "chat_history": []}, config={"callbacks": [counter]})
+        except QueryRejected:
+            failures += 1
+        latencies.observe("sql", time.perf_counter() - start)
+    return {
+        "percentiles": [latencies.percentile("sql", quantile) * 1000 for quantile in (0.5, 0.95, 0.99)],
+        "failures": failures / args.turns,
+        "calls": len(counter.calls) / args.turns,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--candidates", type=int, default=3)
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="median seconds per fake LLM call")
+    parser.add_argument("--jitter", type=float, default=0.5, help="sigma of the log-normal latency factor")
+    parser.add_argument("--failure-rate", type=float, default=0.3, help="share of invalid LLM replies")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "benchmark.db")
+        createDatabase(path, tables=20, rows=2000, seed=args.seed)
+        db = getSqlDatabase(f"sqlite:///{path}")
+        strategies = [("sequential retry", 1, "first"),
+                      (f"{args.candidates} candidates, first", args.candidates, "first"),
+                      (f"{args.candidates} candidates, majority", args.candidates, "majority")]
+        print(f"\n{'strategy':<28}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'failed':>9}{'calls':>8}")
+        for name, candidates, mode in strategies:
+            report = runStrategy(db, args, candidates, mode)
+            print(f"{name:<28}" + "".join(f"{value:>10.1f}" for value in report["percentiles"])
+                  + f"{report['failures']:>9.1%}{report['calls']:>8.2f}")
+        disposeAll()
+
+
+if __name__ == '__main__':
+    main()
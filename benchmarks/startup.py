@@ -0,0 +1,78 @@
+"""
+Benchmark: cold start of the Streamlit pages, measured with `python -X importtime`.
+
+Each page is rendered once in a fresh interpreter with Streamlit's AppTest harness, and the wall time,
+the total import time and the heaviest top-level imports are reported.
+The modules listed in HEAVY_MODULES are expected to be imported lazily. Run from the repository root:
+
+    python -m benchmarks.startup --repeat 5
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+PAGES = ["Homepage.py", "app.py", "pages/Chat_with_Database.py", "pages/Text_To_SQL_Translator.py"]
+
+# LLM and database libraries that should only load once a page needs them
+HEAVY_MODULES = ["langchain_openai", "langchain_google_genai", "google.generativeai", "sqlalchemy",
+                 "langchain_community.utilities.sql_database"]
+
+RUNNER = """
+import sys
+from streamlit.testing.v1 import AppTest
+sys.exit(1 if AppTest.from_file(sys.argv[1], default_timeout=120).run().exception else 0)
+"""
+
+
+def parseImportTimes(stderr: str) -> dict:
+    """
+    Args:
+        stderr (str): The standard error of a `python -X importtime` run.
+
+    Returns:
+        dict: Cumulative import time in microseconds of every imported module.
+    """
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules[name.strip()] = (int(cumulative), (len(name) - len(name.lstrip()) - 1) // 2)
+    return modules
+
+
+def measure(page: str) -> tuple:
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", RUNNER, page],
+                               capture_output=True, text=True, env={**os.environ, "PYTHONWARNINGS": "ignore"})
+    wall = time.perf_counter() - start
+    if completed.returncode != 0:
+        raise RuntimeError(f"{page} failed:\n{completed.stderr[-2000:]}")
+    return wall, parseImportTimes(completed.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--top", type=int, default=5, help="number of heaviest top-level imports listed")
+    args = parser.parse_args()
+
+    for page in PAGES:
+        runs = [measure(page) for _ in range(args.repeat)]
+        walls = [wall for wall, _ in runs]
+        modules = runs[-1][1]
+        top_level = {name: cumulative for name, (cumulative, depth) in modules.items() if depth == 0}
+        heavy = [name for name in HEAVY_MODULES if name in modules]
+        print(f"\n{page}")
+        print(f"  wall time:    {statistics.median(walls) * 1000:.0f} ms (median of {args.repeat})")
+        print(f"  import time:  {sum(top_level.values()) / 1000:.0f} ms")
+        for name, cumulative in sorted(top_level.items(), key=lambda item: -item[1])[:args.top]:
+            print(f"    {cumulative / 1000:8.1f} ms  {name}")
+        print(f"  heavy modules imported eagerly: {', '.join(heavy) or 'none'}")
+
+
+if __name__ == '__main__':
+    main()
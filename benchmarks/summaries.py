@@ -0,0 +1,122 @@
+"""
+Benchmark: aggregate questions answered from the base tables, then from the summary tables mined from the log.
+
+The questions of `fixtures.QUESTIONS` are asked through the SQL and answer chains with the result cache
+cleared before every turn, which fills the query log. The GROUP BY patterns it suggests are materialized with
+`summary_tables.refreshSummaries`, and the same questions are asked again with the fake LLM writing the query
+against the summary tables, as it would with them in its schema. Both answers are checked to return the same
+rows, and the query and turn latencies are reported side by side. Run from the repository root:
+
+    python -m benchmarks.summaries --rows 200000 --turns 20
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from langchain_core.language_models import FakeListChatModel
+from langchain_core.runnables import RunnablePassthrough
+
+from benchmarks.fixtures import QUESTIONS, ReplayChatModel, createDatabase
+from chain_factory import buildAnswerChain, buildSqlChain
+from engine_registry import disposeAll, getSqlDatabase
+from metrics import Metrics
+from query_log import getQueryLog, queryScope
+from query_runner import executeQuery
+from result_cache import getResultCache
+from schema_cache import getSchemaCache
+from summary_tables import refreshSummaries, suggestSummaries
+from table_selector import selectTables
+
+# The queries a well-behaved LLM writes once the summary tables are in its schema
+SUMMARY_ANSWERS = {
+    "top 10 customers by revenue":
+        "SELECT name, sum_revenue AS revenue FROM summary_customers_by_customer_id_name "
+        "ORDER BY revenue DESC LIMIT 10",
+    "how many orders were placed per month":
+        "SELECT month, row_count FROM summary_orders_by_month ORDER BY month",
+    "which product category sells the most units":
+        "SELECT category, sum_quantity AS units FROM summary_order_items_by_category ORDER BY units DESC LIMIT 1",
+    "revenue by region":
+        "SELECT region, sum_revenue FROM summary_customers_by_region",
+}
+
+
+def buildChain(db, answers: dict):
+    answer_llm = FakeListChatModel(responses=["Here is what I found in the database."])
+    return (RunnablePassthrough.assign(query=buildSqlChain(db, ReplayChatModel(answers=answers)))
+            | buildAnswerChain(db, answer_llm))
+
+
+def askAll(db, answers: dict, turns: int) -> Metrics:
+    chain = buildChain(db, answers)
+    latencies = Metrics()
+    log = getQueryLog()
+    for _ in range(turns):
+        for question in SUMMARY_ANSWERS:
+            # Every turn runs its query, as for questions asked for the first time or after data changed
+            getResultCache().clear()
+            start = time.perf_counter()
+            chain.invoke({"question": question, "chat_history": []})
+            latencies.observe(f"turn {question}", time.perf_counter() - start)
+            latencies.observe(f"query {question}", log.entries(queryScope(db))[-1][1])
+    return latencies
+
+
+def sameRows(db, first: str, second: str) -> bool:
+    def rows(sql):
+        result = executeQuery(db, sql, maxRows=10 ** 6)
+        return sorted(tuple(round(value, 6) if isinstance(value, float) else value for value in row)
+                      for row in result.rows())
+
+    return rows(first) == rows(second)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200000, help="orders in the database")
+    parser.add_argument("--turns", type=int, default=20, help="times each question is asked per phase")
+    parser.add_argument("--min-seconds", type=float, default=0.002, help="see SUMMARY_MIN_SECONDS")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "benchmark.db")
+        createDatabase(path, tables=20, rows=args.rows, seed=args.seed)
+        db = getSqlDatabase(f"sqlite:///{path}")
+        getQueryLog().clear()
+
+        base = askAll(db, dict(QUESTIONS), args.turns)
+        start = time.perf_counter()
+        suggestions = suggestSummaries(db, minSeconds=args.min_seconds)
+        print(f"mined {len(getQueryLog().entries(queryScope(db)))} logged queries in "
+              f"{(time.perf_counter() - start) * 1000:.1f} ms")
+        for summary, seconds in refreshSummaries(db, create=True, minSeconds=args.min_seconds):
+            print(f"  built {summary.name}: {summary.rowCount} rows in {seconds:.2f}s")
+        if len(suggestions) < len(SUMMARY_ANSWERS):
+            print("  not every question got a summary; try more --rows or a lower --min-seconds")
+
+        tables = getSchemaCache(db).getTableNames()
+        for question, sql in dict(QUESTIONS).items():
+            summary_sql = SUMMARY_ANSWERS.get(question)
+            if summary_sql is None:
+                continue
+            summary_table = summary_sql.split(" FROM ")[1].split()[0]
+            if summary_table not in tables:
+                raise SystemExit(f"{summary_table} was not built")
+            if summary_table not in selectTables(db, question):
+                print(f"  {summary_table} is not in the schema selected for {question!r}")
+            if not sameRows(db, sql, summary_sql):
+                raise SystemExit(f"{summary_table} answers {question!r} differently")
+
+        summarized = askAll(db, {**dict(QUESTIONS), **SUMMARY_ANSWERS}, args.turns)
+        print(f"\n{'question':<46}{'query p50 ms':>14}{'summary':>10}{'turn p50 ms':>13}{'summary':>10}")
+        for question in SUMMARY_ANSWERS:
+            values = [results.percentile(f"{stage} {question}", 0.5) * 1000
+                      for stage in ("query", "turn") for results in (base, summarized)]
+            print(f"{question:<46}{values[0]:>14.1f}{values[1]:>10.1f}{values[2]:>13.1f}{values[3]:>10.1f}")
+        disposeAll()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,488 @@
+import asyncio
+import os
+import threading
+import time
+import weakref
+from functools import lru_cache
+
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
+
+from chat_history import compactHistory, priorMessages
+from engine_registry import getAsyncEngine
+from example_store import formatExamples, recordExample
+from fast_answer import renderFastAnswer
+from metrics import METRICS_HANDLER, observeStage, recordValue, timed
+from query_log import logQuery, loggedExecute
+from query_runner import aexecuteQuery
+from result_cache import extractTables, getResultCache
+from schema_cache import getSchemaCache
+from sql_cache import getSqlCache, settleExecution, withSqlCache
+from sql_candidates import CandidatesRejected, aspeculativeQuery, candidateSettings, speculativeQuery
+from sql_guard import QueryRejected, guardQuery
+from table_selector import selectTables
+
+SQL_TEMPLATE = """You are a data analyst at a company. You are interacting with a user who is asking you questions
+    about the company's database. Based on the table schema below, write a SQL query that would answer the user's
+    question. Take the conversation history into account.
+
+    <SCHEMA>{schema}</SCHEMA>
+
+    Conversation History: {chat_history}
+
+    Write only the SQL query and nothing else. Do not wrap the SQL query in any other text, not even backticks.
+
+    {examples}
+
+    Your turn:
+
+    Question: {question}
+    SQL Query:
+    """
+
+SQL_RETRY_TEMPLATE = """You are a data analyst at a company. You are interacting with a user who is asking you questions
+    about the company's database. The SQL query you wrote for the question below was rejected before it ran.
+
+    <SCHEMA>{schema}</SCHEMA>
+
+    Conversation History: {chat_history}
+
+    Question: {question}
+    Rejected SQL Query: {query}
+    Reason: {error}
+
+    Write a corrected SQL query that avoids the problem, for example with join conditions, filters or a LIMIT.
+    Write only the SQL query and nothing else. Do not wrap the SQL query in any other text, not even backticks.
+    SQL Query:
+    """
+
+RESPONSE_TEMPLATE = """You are a data analyst at a company. You are interacting with a user who is asking you questions
+    about the company's database. Based on the table schema below, question, sql query, and sql response,
+    write a natural language response. <SCHEMA>{schema}</SCHEMA>
+
+    Conversation History: {chat_history}
+    SQL Query: <SQL>{query}</SQL>
+    User question: {question}
+    SQL Response: {response}"""
+
+# Prompt templates are immutable, so a single instance serves every connection
+SQL_PROMPT = ChatPromptTemplate.from_template(SQL_TEMPLATE)
+SQL_RETRY_PROMPT = ChatPromptTemplate.from_template(SQL_RETRY_TEMPLATE)
+RESPONSE_PROMPT = ChatPromptTemplate.from_template(RESPONSE_TEMPLATE)
+
+
+def formatHistory(variables: dict) -> str:
+    """
+    Render the chat history of a turn as a bounded, compact prompt section.
+
+    Args:
+        variables (dict): The chain input, with "question" and "chat_history".
+
+    Returns:
+        str: The compact chat history.
+    """
+    return compactHistory(priorMessages(variables.get("chat_history"), variables["question"]))
+
+
+@lru_cache(maxsize=None)
+def getLlm(model: str = "gemini-pro", temperature: float = 0.7, topP: float = 0.85):
+    """
+    Return the process-wide Gemini chat client for the given settings.
+
+    Args:
+        model (str): The Gemini model name.
+        temperature (float): Sampling temperature.
+        topP (float): Nucleus sampling probability mass.
+
+    Returns:
+        ChatGoogleGenerativeAI: The shared chat client.
+    """
+    # Imported here: the Gemini client library takes longer to import than the rest of the pipeline together
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+    return ChatGoogleGenerativeAI(model=model,
+                                  google_api_key=os.getenv("GOOGLE_API_KEY"),
+                                  temperature=temperature, top_p=topP)
+
+
+def buildSqlChain(db, llm):
+    """
+    Build the chain of operations that generates an SQL query from a user's natural language question.
+
+    The query is validated by `sql_guard.guardQuery` before it is returned. A rejected query gets one retry with
+    the reason fed back to the LLM; if the retry is rejected too, `QueryRejected` is raised.
+    With SQL_CANDIDATES above 1, that many candidates are generated concurrently and the first valid one is
+    used (see `sql_candidates`); the retry only happens when all of them are rejected.
+
+    The chain also runs with `ainvoke`: the LLM calls are then async, and the steps that query the database
+    run in worker threads.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        llm: The chat model used to write the SQL query.
+
+    Returns:
+        RunnableSerializable: A chain of operations that generate the SQL query.
+    """
+    def getSchema(variables):
+        """
+        Retrieve the schema information of the tables relevant to the question.
+
+        Args:
+            variables (dict): The chain input, with "question".
+
+        Returns:
+            str: The schema information.
+        """
+        with timed("schema"):
+            return getSchemaCache(db).getTableInfo(selectTables(db, variables["question"]))
+
+    generate = SQL_PROMPT | instrumented(llm, "sql_generation") | StrOutputParser()
+    retry = SQL_RETRY_PROMPT | instrumented(llm, "sql_retry") | StrOutputParser()
+
+    def generateGuarded(variables, config):
+        """
+        Generate the query and validate it, retrying once with the rejection reason.
+
+        Args:
+            variables (dict): The chain input, with "question", "schema" and "chat_history".
+
+        Returns:
+            str: The validated SQL query.
+        """
+        if candidateSettings()[0] > 1:
+            try:
+                return speculativeQuery(db, lambda: generate.invoke(variables, config))
+            except CandidatesRejected as error:
+                query, reason = error.query, error
+        else:
+            query = generate.invoke(variables, config)
+            try:
+                return guardQuery(db, query)
+            except QueryRejected as error:
+                reason = error
+        query = retry.invoke({**variables, "query": query, "error": str(reason)}, config)
+        return guardQuery(db, query)
+
+    async def agenerateGuarded(variables, config):
+        """
+        Async counterpart of `generateGuarded`.
+
+        Args:
+            variables (dict): The chain input, with "question", "schema" and "chat_history".
+
+        Returns:
+            str: The validated SQL query.
+        """
+        if candidateSettings()[0] > 1:
+            try:
+                return await aspeculativeQuery(db, lambda: generate.ainvoke(variables, config))
+            except CandidatesRejected as error:
+                query, reason = error.query, error
+        else:
+            query = await generate.ainvoke(variables, config)
+            try:
+                return await asyncio.to_thread(guardQuery, db, query)
+            except QueryRejected as error:
+                reason = error
+        query = await retry.ainvoke({**variables, "query": query, "error": str(reason)}, config)
+        return await asyncio.to_thread(guardQuery, db, query)
+
+    return (
+            RunnablePassthrough.assign(
+                schema=getSchema,
+                chat_history=formatHistory,
+                # Verified question/SQL pairs of this database that are closest to the question
+                examples=lambda variables: formatExamples(db, variables["question"]),
+            )
+            | RunnableLambda(generateGuarded, afunc=agenerateGuarded)
+    )
+
+
+def instrumented(llm, stage: str):
+    """
+    Attach the metrics callback handler to a chat model, labelled with the pipeline stage it serves.
+
+    Args:
+        llm: The chat model.
+        stage (str): The stage name, e.g. "sql_generation".
+
+    Returns:
+        Runnable: The chat model bound to the callback handler.
+    """
+    return llm.with_config(callbacks=[METRICS_HANDLER], metadata={"stage": stage})
+
+
+def runQuery(db, query: str, question: str = None):
+    """
+    Run a generated query through the result cache, recording its latency and row count.
+
+    Executions (not cache hits) are logged with their duration for `summary_tables`, and the SQL cache learns
+    whether the query ran.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        query (str): The SQL query.
+        question (str): Optional question the query answers. When given and the query returns rows,
+            the pair is kept as a few-shot example.
+
+    Returns:
+        QueryResult: The capped, columnar query result.
+    """
+    try:
+        with timed("query_execution"):
+            result = getResultCache().run(db, query, execute=loggedExecute)
+    except Exception:
+        settleExecution(db, query, succeeded=False)
+        raise
+    settleExecution(db, query, succeeded=True)
+    recordValue("rows_returned", result.rowCount)
+    if question is not None:
+        recordExample(db, question, query, result)
+    return result
+
+
+async def arunQuery(db, query: str, question: str = None, timeout: float = None):
+    """
+    Async counterpart of `runQuery`, executing on the async engine of the connection.
+
+    The result cache, the query log, the SQL cache and the example store may be SQLite files, so they are
+    read and written in worker threads.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        query (str): The SQL query.
+        question (str): Optional question the query answers, kept with it as a few-shot example.
+        timeout (float): Statement timeout in seconds. Defaults to QUERY_TIMEOUT or 30.
+
+    Returns:
+        QueryResult: The capped, columnar query result.
+
+    Raises:
+        asyncio.TimeoutError: If the query runs longer than `timeout`.
+    """
+    engine = getAsyncEngine(db._engine.url.render_as_string(hide_password=False))
+
+    async def execute(sql: str):
+        start = time.perf_counter()
+        result = await aexecuteQuery(engine, sql, timeout=timeout)
+        await asyncio.to_thread(logQuery, db, sql, time.perf_counter() - start, result.rowCount)
+        return result
+
+    try:
+        with timed("query_execution"):
+            result = await getResultCache().arun(db, query, execute)
+    except Exception:
+        await asyncio.to_thread(settleExecution, db, query, False)
+        raise
+    await asyncio.to_thread(settleExecution, db, query, True)
+    recordValue("rows_returned", result.rowCount)
+    if question is not None:
+        await asyncio.to_thread(recordExample, db, question, query, result)
+    return result
+
+
+def getAnswerSchema(db, variables: dict) -> str:
+    """
+    Retrieve the schema information of the tables the generated query reads from.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        variables (dict): The chain input, with "question" and "query".
+
+    Returns:
+        str: The schema information.
+    """
+    with timed("schema"):
+        schema_cache = getSchemaCache(db)
+        referenced = extractTables(variables["query"])
+        table_names = [name for name in schema_cache.getTableNames() if name.lower() in referenced]
+        return schema_cache.getTableInfo(table_names or selectTables(db, variables["question"]))
+
+
+def buildAnswerChain(db, llm):
+    """
+    Build the chain of operations that runs an already generated SQL query and answers in natural language.
+
+    Empty results, single values and small tables are answered from templates by `fast_answer.renderFastAnswer`
+    without calling the LLM. With `ainvoke` or `astream`, the query runs through `arunQuery`.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        llm: The chat model used to write the answer.
+
+    Returns:
+        RunnableSerializable: A chain of operations that generate the natural language response.
+    """
+    def getResult(variables):
+        """
+        Run the generated query, unless the caller already did and passed its result in.
+
+        Args:
+            variables (dict): The chain input, with "query" and optionally "result".
+
+        Returns:
+            QueryResult: The capped, columnar query result.
+        """
+        if "result" in variables:
+            return variables["result"]
+        return runQuery(db, variables["query"], variables["question"])
+
+    async def agetResult(variables):
+        """
+        Async counterpart of `getResult`.
+
+        Args:
+            variables (dict): The chain input, with "query" and optionally "result".
+
+        Returns:
+            QueryResult: The capped, columnar query result.
+        """
+        if "result" in variables:
+            return variables["result"]
+        return await arunQuery(db, variables["query"], variables["question"])
+
+    summarize = (
+            RunnablePassthrough.assign(
+                schema=lambda variables: getAnswerSchema(db, variables),
+                # Only a compact summary of the rows goes into the prompt
+                response=lambda variables: variables["result"].summary(),
+                chat_history=formatHistory,
+            )
+            | RESPONSE_PROMPT
+            | instrumented(llm, "answer_generation")
+            | StrOutputParser()
+    )
+
+    def answer(variables):
+        """
+        Render simple results from a template and leave the rest to the answer LLM.
+
+        Args:
+            variables (dict): The chain input, with "question", "result" and optionally "inline_table".
+
+        Returns:
+            str | Runnable: The templated answer, or the LLM chain, which LangChain then runs on the same input.
+        """
+        text = renderFastAnswer(variables["question"], variables["result"], variables.get("inline_table", True))
+        if text is None:
+            return summarize
+        recordValue("fast_path_answers")
+        return text
+
+    return RunnablePassthrough.assign(result=RunnableLambda(getResult, afunc=agetResult)) | RunnableLambda(answer)
+
+
+def buildResponseChain(db, llm, sqlChain):
+    """
+    Build the chain of operations that answers a user's question in natural language.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        llm: The chat model used to write the answer.
+        sqlChain (RunnableSerializable): The chain that generates the SQL query.
+
+    Returns:
+        RunnableSerializable: A chain of operations that generate the natural language response.
+    """
+    return RunnablePassthrough.assign(query=sqlChain) | buildAnswerChain(db, llm)
+
+
+_chains = weakref.WeakKeyDictionary()
+_chainsLock = threading.Lock()
+
+
+def _getChains(db, llm=None) -> dict:
+    # One set per connection and chat model, so that requests with a custom model (api.py) reuse their chains
+    with _chainsLock:
+        by_llm = _chains.setdefault(db, {})
+        entry = by_llm.get(id(llm))
+        if entry is None:
+            model = getLlm() if llm is None else llm
+            # Near-identical questions are answered from the SQL cache instead of a Gemini round-trip
+            sql_chain = withSqlCache(db, buildSqlChain(db, model), getSqlCache())
+            answer_chain = buildAnswerChain(db, model)
+            # The model is kept alongside its chains so that its id can't be reused while they are cached
+            entry = by_llm[id(llm)] = (llm, {
+                "sql": sql_chain,
+                "answer": answer_chain,
+                "response": RunnablePassthrough.assign(query=sql_chain) | answer_chain,
+            })
+        return entry[1]
+
+
+def getSqlChain(db, llm=None):
+    """
+    Return the SQL-generation chain of a connection, building it on first use.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        llm: Optional chat model. Defaults to the shared Gemini client.
+
+    Returns:
+        RunnableSerializable: A chain of operations that generate the SQL query.
+    """
+    return _getChains(db, llm)["sql"]
+
+
+def getResponseChain(db):
+    """
+    Return the full question-answering chain of a connection, building it on first use.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+
+    Returns:
+        RunnableSerializable: A chain of operations that generate the natural language response.
+    """
+    return _getChains(db)["response"]
+
+
+def getAnswerChain(db, llm=None):
+    """
+    Return the answer stage of a connection, which expects the generated query under "query".
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        llm: Optional chat model. Defaults to the shared Gemini client.
+
+    Returns:
+        RunnableSerializable: A chain of operations that generate the natural language response.
+    """
+    return _getChains(db, llm)["answer"]
+
+
+def streamResponse(userQuery: str, db, chatHistory: list, timings: dict = None):
+    """
+    Generate and run the SQL query, then stream the natural language answer token by token.
+
+    Args:
+        userQuery (str): The user's natural language question.
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        chatHistory (list): The history of the chat interaction.
+        timings (dict): Optional dictionary filled with "sql_generation", "query_execution",
+            "time_to_first_token" and "total", in seconds since the start of the turn.
+
+    Returns:
+        tuple: The generated SQL query, its QueryResult and a generator of answer tokens.
+    """
+    timings = {} if timings is None else timings
+    start = time.perf_counter()
+    variables = {"question": userQuery, "chat_history": chatHistory}
+    query = getSqlChain(db).invoke(variables)
+    timings["sql_generation"] = time.perf_counter() - start
+    result = runQuery(db, query, userQuery)
+    timings["query_execution"] = time.perf_counter() - start
+
+    def tokens():
+        # The caller shows the result itself, so templated answers don't repeat the table
+        for token in getAnswerChain(db).stream({**variables, "query": query, "result": result,
+                                                "inline_table": False}):
+            if "time_to_first_token" not in timings:
+                timings["time_to_first_token"] = time.perf_counter() - start
+                observeStage("time_to_first_token", timings["time_to_first_token"])
+            yield token
+        timings["total"] = time.perf_counter() - start
+
+    return query, result, tokens()
@@ -0,0 +1,99 @@
+import os
+
+
+def formatMessage(message) -> str:
+    """
+    Return a compact "role: content" line for a chat message.
+
+    Args:
+        message: A LangChain message, or any object with `type` and `content` attributes.
+
+    Returns:
+        str: The compact representation of the message.
+    """
+    role = {"human": "User", "ai": "Assistant"}.get(getattr(message, "type", None), "Message")
+    content = " ".join(str(getattr(message, "content", message)).split())
+    return f"{role}: {content}"
+
+
+def estimateTokens(text: str) -> int:
+    """
+    Cheaply approximate the number of LLM tokens in a text (about four characters per token).
+
+    Args:
+        text (str): The text to measure.
+
+    Returns:
+        int: The approximate token count.
+    """
+    return len(text) // 4 + 1
+
+
+def priorMessages(chatHistory: list, question: str) -> list:
+    """
+    Return the history without the trailing copy of the current question.
+
+    The pages append the question to the history before asking, but the prompts already carry it separately.
+
+    Args:
+        chatHistory (list): The history of the chat interaction.
+        question (str): The user's current question.
+
+    Returns:
+        list: The messages that precede the current question.
+    """
+    history = list(chatHistory or [])
+    if history and getattr(history[-1], "content", None) == question:
+        history.pop()
+    return history
+
+
+def compactHistory(chatHistory: list, keepMessages: int = None, tokenBudget: int = None, mode: str = None) -> str:
+    """
+    Render the chat history for a prompt within a token budget.
+
+    The last `keepMessages` messages are kept verbatim, newest first, as long as they fit in the budget.
+    Older messages are either dropped or, in "summary" mode, compacted into a single line listing the
+    earlier user questions, which is trimmed from the oldest end until it fits in what is left of the budget.
+
+    Args:
+        chatHistory (list): The history of the chat interaction.
+        keepMessages (int): Number of trailing messages kept verbatim. Defaults to CHAT_HISTORY_MESSAGES or 6.
+        tokenBudget (int): Approximate token budget. Defaults to CHAT_HISTORY_TOKENS or 1000.
+        mode (str): "summary" or "drop". Defaults to CHAT_HISTORY_MODE or "summary".
+
+    Returns:
+        str: The compact chat history, one message per line.
+    """
+    if isinstance(chatHistory, str):
+        return chatHistory
+    keepMessages = int(os.getenv("CHAT_HISTORY_MESSAGES", "6")) if keepMessages is None else keepMessages
+    tokenBudget = int(os.getenv("CHAT_HISTORY_TOKENS", "1000")) if tokenBudget is None else tokenBudget
+    mode = os.getenv("CHAT_HISTORY_MODE", "summary") if mode is None else mode
+
+    history = list(chatHistory or [])
+    recent = history[-keepMessages:] if keepMessages > 0 else []
+
+    lines = []
+    budget = tokenBudget
+    for message in reversed(recent):
+        line = formatMessage(message)
+        cost = estimateTokens(line)
+        if cost > budget:
+            break
+        lines.append(line)
+        budget -= cost
+    lines.reverse()
+    older = history[:len(history) - len(lines)]
+
+    if mode == "summary":
+        questions = [" ".join(str(message.content).split()) for message in older
+                     if getattr(message, "type", None) == "human"]
+        while questions:
+            summary = "Earlier questions: " + "; ".join(questions)
+            if estimateTokens(summary) <= budget:
+                lines.insert(0, summary)
+                break
+            questions.pop(0)
+
+    return "\n".join(lines)
@@ -0,0 +1,150 @@
+import math
+import os
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import streamlit as st
+
+
+@dataclass(slots=True)
+class ChatMessage:
+    """
+    One chat message. `type` and `content` follow LangChain's message attributes, so the history can be
+    passed to the chains as it is.
+    """
+    id: int
+    type: str
+    content: str
+    query: str = None
+    rowCount: int = 0
+    truncated: bool = False
+
+
+class ChatStore:
+    """
+    Chat history of a Streamlit session: compact messages plus the result tables of the most recent turns.
+
+    Tables are turned into DataFrames on first display and kept for the last `maxTables` turns only.
+    """
+
+    def __init__(self, maxTables: int = None):
+        """
+        Args:
+            maxTables (int): Number of turns whose result table is kept. Defaults to CHAT_RESULT_TABLES or 10.
+        """
+        self.maxTables = int(os.getenv("CHAT_RESULT_TABLES", "10")) if maxTables is None else maxTables
+        self.messages = []
+        self._results = OrderedDict()
+        self._frames = {}
+
+    def add(self, type: str, content: str, query: str = None, result=None) -> ChatMessage:
+        """
+        Append a message.
+
+        Args:
+            type (str): "human" or "ai".
+            content (str): The text of the message.
+            query (str): The SQL query of an answer, if any.
+            result (QueryResult): The result of that query, if any.
+
+        Returns:
+            ChatMessage: The stored message.
+        """
+        message = ChatMessage(id=len(self.messages), type=type, content=content, query=query)
+        if result is not None and result.columns:
+            message.rowCount, message.truncated = result.rowCount, result.truncated
+            self._results[message.id] = result
+            while len(self._results) > self.maxTables:
+                evicted, _ = self._results.popitem(last=False)
+                self._frames.pop(evicted, None)
+        self.messages.append(message)
+        return message
+
+    def table(self, message: ChatMessage):
+        """
+        Returns:
+            DataFrame: The result table of a message, built once, or None if it has none or it was evicted.
+        """
+        if message.id not in self._results:
+            return None
+        frame = self._frames.get(message.id)
+        if frame is None:
+            import pandas as pd
+
+            result = self._results[message.id]
+            frame = self._frames[message.id] = pd.DataFrame(result.data, columns=result.columns)
+        return frame
+
+    def split(self, windowSize: int) -> tuple:
+        """
+        Returns:
+            tuple: The archived messages and the `windowSize` most recent ones.
+        """
+        cut = max(len(self.messages) - windowSize, 0)
+        return self.messages[:cut], self.messages[cut:]
+
+
+def _renderExport(db, message: ChatMessage):
+    from result_export import ExportError, ResultExport
+    from sql_guard import QueryRejected
+
+    # The download button keeps the whole file in the session's memory, so exports from the page are capped;
+    # larger ones are streamed by the API's /v1/export
+    maxRows = int(os.getenv("CHAT_EXPORT_MAX_ROWS", "100000"))
+    format = st.radio("Export format", ["parquet", "csv"], format_func=str.upper, horizontal=True,
+                      key=f"export_format_{message.id}")
+    if not st.button("Export the full result", key=f"export_{message.id}"):
+        return
+    try:
+        with st.spinner("Exporting..."):
+            result_export = ResultExport(db, message.query, format, maxRows=maxRows)
+            data = b"".join(result_export)
+    except (QueryRejected, ExportError) as error:
+        st.warning(f"The result could not be exported: {error}")
+        return
+    if result_export.truncated:
+        st.info(f"Only the first {maxRows} rows are included. Export the full result with the /v1/export "
+                f"endpoint of the API (api.py), which streams it.")
+    st.download_button(f"Download {result_export.rowCount} rows", data, file_name=f"result{result_export.extension}",
+                       mime=result_export.contentType, key=f"download_{message.id}")
+
+
+def _renderMessage(store: ChatStore, message: ChatMessage, db):
+    with st.chat_message("AI" if message.type == "ai" else "Human"):
+        st.markdown(message.content)
+        if store.table(message) is None:
+            return
+        label = f"Show result ({'more than ' if message.truncated else ''}{message.rowCount} rows)"
+        # Past result tables are only sent to the browser again when asked for
+        if st.toggle(label, key=f"show_result_{message.id}"):
+            if message.query:
+                st.code(message.query, language="sql")
+            st.dataframe(store.table(message))
+            if db is not None and message.query:
+                _renderExport(db, message)
+
+
+def renderChat(store: ChatStore, db=None, windowSize: int = None, pageSize: int = None):
+    """
+    Render the recent messages in full and older ones in a collapsed, paginated archive.
+
+    Args:
+        store (ChatStore): The session's chat history.
+        db (SQLDatabase): The connection answers were computed on, if any; their full results can be exported.
+        windowSize (int): Number of recent messages rendered in full. Defaults to CHAT_WINDOW or 20.
+        pageSize (int): Number of archived messages per page. Defaults to CHAT_ARCHIVE_PAGE or 20.
+    """
+    windowSize = int(os.getenv("CHAT_WINDOW", "20")) if windowSize is None else windowSize
+    pageSize = int(os.getenv("CHAT_ARCHIVE_PAGE", "20")) if pageSize is None else pageSize
+    archive, recent = store.split(windowSize)
+    if archive:
+        with st.expander(f"Earlier messages ({len(archive)})"):
+            pages = math.ceil(len(archive) / pageSize)
+            page = pages
+            if pages > 1:
+                page = st.number_input("Page", min_value=1, max_value=pages, value=pages, key="archive_page")
+            for message in archive[(page - 1) * pageSize:page * pageSize]:
+                speaker = "Assistant" if message.type == "ai" else "You"
+                st.markdown(f"**{speaker}:** {message.content}")
+    for message in recent:
+        _renderMessage(store, message, db)
@@ -0,0 +1,18 @@
+import os
+from functools import lru_cache
+
+from dotenv import load_dotenv
+
+
+@lru_cache(maxsize=None)
+def loadConfig():
+    """
+    Load the .env file and start the process-wide services, once per process.
+
+    Streamlit re-executes page scripts on every rerun, so pages call this instead of `load_dotenv()`.
+    The Prometheus endpoint is started when METRICS_PORT is set; `metrics` is only imported in that case.
+    """
+    load_dotenv()
+    if os.getenv("METRICS_PORT"):
+        from metrics import startMetricsServer
+        startMetricsServer()
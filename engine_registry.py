@@ -0,0 +1,145 @@
+import os
+import threading
+
+from langchain_community.utilities import SQLDatabase
+from sqlalchemy.engine import create_engine
+
+_databases = {}
+_lock = threading.Lock()
+
+
+def _poolKey(dbUri: str, poolSize, maxOverflow, poolPrePing, poolRecycle):
+    # Defaults come from the environment (.env) and are read lazily, after load_dotenv() has run
+    if poolSize is None:
+        poolSize = int(os.getenv("DB_POOL_SIZE", "5"))
+    if maxOverflow is None:
+        maxOverflow = int(os.getenv("DB_MAX_OVERFLOW", "5"))
+    if poolPrePing is None:
+        poolPrePing = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+    if poolRecycle is None:
+        poolRecycle = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+    return dbUri, poolSize, maxOverflow, poolPrePing, poolRecycle
+
+
+def getSqlDatabase(dbUri: str, poolSize: int = None, maxOverflow: int = None,
+                   poolPrePing: bool = None, poolRecycle: int = None) -> SQLDatabase:
+    """
+    Return the process-wide SQLDatabase for a connection URI, creating its engine on first use.
+
+    Every Streamlit session connecting with the same parameters shares the same bounded pool.
+
+    Args:
+        dbUri (str): The SQLAlchemy connection URI.
+        poolSize (int): Number of connections kept open in the pool.
+        maxOverflow (int): Number of extra connections allowed above `poolSize`.
+        poolPrePing (bool): Whether to test connections for liveness on checkout.
+        poolRecycle (int): Number of seconds after which a connection is recycled.
+
+    Returns:
+        SQLDatabase: The SQLDatabase object built on top of the shared engine.
+    """
+    key = _poolKey(dbUri, poolSize, maxOverflow, poolPrePing, poolRecycle)
+    with _lock:
+        sql_database = _databases.get(key)
+        if sql_database is None:
+            _, size, overflow, pre_ping, recycle = key
+            options = {"pool_pre_ping": pre_ping, "pool_recycle": recycle}
+            # SQLite uses its own pool classes which don't accept size limits
+            if not dbUri.startswith("sqlite"):
+                options.update(pool_size=size, max_overflow=overflow)
+            engine = create_engine(dbUri, **options)
+            sql_database = _databases[key] = SQLDatabase(engine)
+        return sql_database
+
+
+def getEngine(dbUri: str, **poolOptions):
+    """
+    Return the process-wide SQLAlchemy engine for a connection URI.
+
+    Args:
+        dbUri (str): The SQLAlchemy connection URI.
+        **poolOptions: Pool settings accepted by `getSqlDatabase`.
+
+    Returns:
+        Engine: The shared engine.
+    """
+    return getSqlDatabase(dbUri, **poolOptions)._engine
+
+
+# Async drivers used in place of the synchronous ones of the connection URI
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+_asyncEngines = {}
+
+
+def toAsyncUri(dbUri: str) -> str:
+    """
+    Swap the driver of a connection URI for its asyncio counterpart.
+
+    Args:
+        dbUri (str): The SQLAlchemy connection URI, e.g. "mysql+pymysql://...".
+
+    Returns:
+        str: The same URI with an async driver, e.g. "mysql+aiomysql://...".
+    """
+    scheme, rest = dbUri.split("://", 1)
+    dialect = scheme.split("+", 1)[0]
+    if dialect not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver known for the {dialect} dialect")
+    return f"{ASYNC_DRIVERS[dialect]}://{rest}"
+
+
+def getAsyncEngine(dbUri: str, poolSize: int = None, maxOverflow: int = None,
+                   poolPrePing: bool = None, poolRecycle: int = None):
+    """
+    Return the process-wide async engine for a connection URI, with the same pool settings as `getSqlDatabase`.
+
+    Args:
+        dbUri (str): The SQLAlchemy connection URI, with a synchronous or an async driver.
+        poolSize (int): Number of connections kept open in the pool.
+        maxOverflow (int): Number of extra connections allowed above `poolSize`.
+        poolPrePing (bool): Whether to test connections for liveness on checkout.
+        poolRecycle (int): Number of seconds after which a connection is recycled.
+
+    Returns:
+        AsyncEngine: The shared async engine.
+    """
+    # Imported here so that the async drivers stay optional for the Streamlit pages
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    key = _poolKey(toAsyncUri(dbUri), poolSize, maxOverflow, poolPrePing, poolRecycle)
+    with _lock:
+        engine = _asyncEngines.get(key)
+        if engine is None:
+            async_uri, size, overflow, pre_ping, recycle = key
+            options = {"pool_pre_ping": pre_ping, "pool_recycle": recycle}
+            if not async_uri.startswith("sqlite"):
+                options.update(pool_size=size, max_overflow=overflow)
+            engine = _asyncEngines[key] = create_async_engine(async_uri, **options)
+        return engine
+
+
+def disposeAll() -> list:
+    """
+    Close every pooled connection of the synchronous engines and forget all registered engines.
+
+    Returns:
+        list: The forgotten async engines, whose connections must be closed from their event loop.
+    """
+    with _lock:
+        for sql_database in _databases.values():
+            sql_database._engine.dispose()
+        _databases.clear()
+        async_engines = list(_asyncEngines.values())
+        _asyncEngines.clear()
+    return async_engines
+
+
+async def adisposeAll():
+    """Like `disposeAll`, and also close the pooled connections of the async engines."""
+    for engine in disposeAll():
+        await engine.dispose()
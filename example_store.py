@@ -0,0 +1,277 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from functools import lru_cache
+
+import numpy as np
+
+from metrics import recordValue, timed
+from sql_cache import normalizeQuestion
+from sql_guard import stripAddedLimit
+from table_selector import identifierTokens
+
+
+# Words that say nothing about the query a question needs
+STOPWORDS = {"a", "an", "the", "of", "by", "per", "for", "in", "on", "at", "to", "from", "is", "are", "was",
+             "were", "be", "what", "which", "me", "and", "or", "with", "do", "doe", "did", "there", "i", "we"}
+
+
+def _terms(question: str) -> list:
+    # Word bigrams keep "total revenue" apart from "total" and "revenue" on their own
+    words = [word for word in identifierTokens(question) if word not in STOPWORDS]
+    return words + [f"{first} {second}" for first, second in zip(words, words[1:])]
+
+
+# Examples added or replaced since the last rebuild are scored one by one until there are this many
+REBUILD_AFTER = 32
+
+
+class _ScopeIndex:
+    """
+    TF-IDF matrix over the examples of one database.
+
+    Examples added after the matrix was built are kept in `pending` and scored with the matrix's IDF weights,
+    and removed ones are listed in `removed`, so that the matrix is only rebuilt every `REBUILD_AFTER` changes.
+    """
+
+    def __init__(self, examples: OrderedDict):
+        self.keys = list(examples)
+        self.pending = {}
+        self.removed = set()
+        documents = [examples[key][2] for key in self.keys]
+        frequencies = Counter(term for document in documents for term in document)
+        self.vocabulary = {term: column for column, term in enumerate(frequencies)}
+        count = len(documents)
+        # Terms unknown to the matrix get the weight of the rarest possible term
+        self.unknownIdf = math.log(1 + count) + 1
+        self.idf = np.array([math.log((1 + count) / (1 + frequencies[term])) + 1 for term in self.vocabulary],
+                            dtype=np.float32)
+        # Filled with a single fancy-indexing assignment rather than cell by cell
+        rows, columns, weights = [], [], []
+        for row, document in enumerate(documents):
+            for term, frequency in document.items():
+                rows.append(row)
+                columns.append(self.vocabulary[term])
+                weights.append(1 + math.log(frequency))
+        self.matrix = np.zeros((count, len(self.vocabulary)), dtype=np.float32)
+        self.matrix[rows, columns] = weights
+        self.matrix *= self.idf
+        norms = np.linalg.norm(self.matrix, axis=1, keepdims=True)
+        self.matrix /= np.where(norms > 0, norms, 1)
+
+    @property
+    def changes(self) -> int:
+        return len(self.pending) + len(self.removed)
+
+    def _weights(self, terms: Counter) -> dict:
+        weights = {}
+        for term, frequency in terms.items():
+            column = self.vocabulary.get(term)
+            weights[term] = (1 + math.log(frequency)) * (self.unknownIdf if column is None else self.idf[column])
+        return weights
+
+    def search(self, question: str, topK: int) -> list:
+        query = self._weights(Counter(_terms(question)))
+        norm = math.sqrt(sum(weight * weight for weight in query.values()))
+        if not norm:
+            return []
+        scored = []
+        if self.keys:
+            vector = np.zeros(len(self.vocabulary), dtype=np.float32)
+            for term, weight in query.items():
+                if term in self.vocabulary:
+                    vector[self.vocabulary[term]] = weight / norm
+            scores = self.matrix @ vector
+            wanted = topK + len(self.removed)
+            best = np.argpartition(-scores, wanted - 1)[:wanted] if len(scores) > wanted else range(len(scores))
+            scored = [(self.keys[row], float(scores[row])) for row in best if self.keys[row] not in self.removed]
+        for key, terms in self.pending.items():
+            weights = self._weights(terms)
+            length = math.sqrt(sum(weight * weight for weight in weights.values()))
+            dot = sum(weight * weights[term] for term, weight in query.items() if term in weights)
+            scored.append((key, dot / (norm * length) if length else 0.0))
+        return sorted(scored, key=lambda item: -item[1])[:topK]
+
+
+class ExampleStore:
+    """
+    Verified question→SQL pairs per database, retrieved by TF-IDF cosine similarity as few-shot examples.
+
+    Each database keeps at most `maxSize` examples; the least recently used one is evicted first.
+    Examples are optionally written through to a SQLite file so that they survive restarts.
+    """
+
+    def __init__(self, maxSize: int = 500, path: str = None):
+        """
+        Args:
+            maxSize (int): Maximum number of examples kept per database.
+            path (str): Optional SQLite file used as a persistent backend.
+        """
+        self.maxSize = maxSize
+        self._examples = {}
+        self._indexes = {}
+        self._lock = threading.Lock()
+        self._disk = None
+        if path:
+            self._disk = sqlite3.connect(path, check_same_thread=False)
+            self._disk.execute("""
+                CREATE TABLE IF NOT EXISTS examples (
+                    scope TEXT, key TEXT, question TEXT, sql TEXT, used REAL, PRIMARY KEY (scope, key)
+                )
+            """)
+            self._disk.commit()
+            for scope, key, question, sql in self._disk.execute(
+                    "SELECT scope, key, question, sql FROM examples ORDER BY used").fetchall():
+                self._examples.setdefault(scope, OrderedDict())[key] = (question, sql, Counter(_terms(question)))
+            for scope in list(self._examples):
+                self._evict(scope)
+            self._disk.commit()
+
+    def add(self, scope: str, question: str, sql: str):
+        """
+        Store a question with the SQL query that answered it, replacing an earlier query for the same question.
+
+        Args:
+            scope (str): Identifies the database.
+            question (str): The user's natural language question.
+            sql (str): The SQL query that ran successfully.
+        """
+        key = normalizeQuestion(question)
+        if not key:
+            return
+        with self._lock:
+            examples = self._examples.setdefault(scope, OrderedDict())
+            index = self._indexes.get(scope)
+            if index is not None and key in examples:
+                # The matrix row of the replaced example must no longer match
+                index.removed.add(key)
+            examples[key] = (question, sql, Counter(_terms(question)))
+            examples.move_to_end(key)
+            if index is not None:
+                index.pending[key] = examples[key][2]
+            if self._disk is not None:
+                self._disk.execute("INSERT OR REPLACE INTO examples VALUES (?, ?, ?, ?, ?)",
+                                   (scope, key, question, sql, time.time()))
+            self._evict(scope)
+            if self._disk is not None:
+                self._disk.commit()
+
+    def _evict(self, scope: str):
+        examples = self._examples[scope]
+        index = self._indexes.get(scope)
+        while len(examples) > self.maxSize:
+            key, _ = examples.popitem(last=False)
+            if index is not None:
+                index.removed.add(key)
+                index.pending.pop(key, None)
+            if self._disk is not None:
+                self._disk.execute("DELETE FROM examples WHERE scope = ? AND key = ?", (scope, key))
+        if index is not None and index.changes > REBUILD_AFTER:
+            del self._indexes[scope]
+
+    def search(self, scope: str, question: str, topK: int = 3, minScore: float = 0.1) -> list:
+        """
+        Find the stored examples closest to a question.
+
+        Args:
+            scope (str): Identifies the database.
+            question (str): The user's natural language question.
+            topK (int): Maximum number of examples returned.
+            minScore (float): Minimum cosine similarity, between 0 and 1.
+
+        Returns:
+            list: (question, sql) pairs, most similar first.
+        """
+        with self._lock:
+            examples = self._examples.get(scope)
+            if not examples or topK <= 0:
+                return []
+            index = self._indexes.get(scope)
+            if index is None:
+                index = self._indexes[scope] = _ScopeIndex(examples)
+            found = [(key, score) for key, score in index.search(question, topK) if score >= minScore]
+            for key, _ in found:
+                examples.move_to_end(key)
+            return [examples[key][:2] for key, _ in found]
+
+    def clear(self):
+        """Drop every example, including the persisted ones."""
+        with self._lock:
+            self._examples.clear()
+            self._indexes.clear()
+            if self._disk is not None:
+                self._disk.execute("DELETE FROM examples")
+                self._disk.commit()
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: The number of examples per scope.
+        """
+        with self._lock:
+            return {scope: len(examples) for scope, examples in self._examples.items()}
+
+
+@lru_cache(maxsize=None)
+def getExampleStore() -> ExampleStore:
+    """
+    Return the process-wide example store, configured from the environment (.env).
+
+    EXAMPLE_STORE_SIZE and EXAMPLE_STORE_PATH (SQLite file) are honoured.
+
+    Returns:
+        ExampleStore: The shared store.
+    """
+    return ExampleStore(maxSize=int(os.getenv("EXAMPLE_STORE_SIZE", "500")),
+                        path=os.getenv("EXAMPLE_STORE_PATH") or None)
+
+
+def exampleScope(db) -> str:
+    """
+    Returns:
+        str: The scope of a connection's examples, its URL without the password.
+    """
+    return db._engine.url.render_as_string(hide_password=True)
+
+
+def recordExample(db, question: str, query: str, result):
+    """
+    Keep a turn as a future few-shot example if its query ran and returned rows.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        question (str): The user's natural language question.
+        query (str): The SQL query that ran.
+        result (QueryResult): Its result.
+    """
+    if result.columns and result.rowCount:
+        # Without the LIMIT the guard added, which examples would otherwise teach the LLM to write
+        getExampleStore().add(exampleScope(db), question, stripAddedLimit(query))
+        recordValue("examples_recorded")
+
+
+def formatExamples(db, question: str, topK: int = None) -> str:
+    """
+    Render the examples closest to a question as the few-shot section of the SQL prompt.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        question (str): The user's natural language question.
+        topK (int): Maximum number of examples. Defaults to EXAMPLES_TOP_K or 3.
+
+    Returns:
+        str: The examples, or an empty string when the store has none for this database.
+    """
+    topK = int(os.getenv("EXAMPLES_TOP_K", "3")) if topK is None else topK
+    with timed("example_retrieval"):
+        examples = getExampleStore().search(exampleScope(db), question, topK)
+    if not examples:
+        return ""
+    lines = ["For example:"]
+    for example_question, example_sql in examples:
+        lines.append(f"Question: {example_question}")
+        lines.append(f"SQL Query: {' '.join(example_sql.split())}")
+    return "\n    ".join(lines)
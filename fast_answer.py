@@ -0,0 +1,89 @@
+import math
+import os
+import re
+from datetime import date, datetime
+from decimal import Decimal
+
+# Questions asking for these want prose, whatever the shape of the result
+NARRATIVE_WORDS = {"why", "explain", "describe", "summarize", "summarise", "compare", "comparison", "trend",
+                   "trends", "insight", "insights", "analyze", "analyse", "analysis", "recommend", "suggest"}
+
+_IDENTIFIER = re.compile(r"[A-Za-z_]\w*")
+
+
+def _fastPathSettings(maxRows, maxColumns):
+    maxRows = int(os.getenv("FAST_PATH_MAX_ROWS", "20")) if maxRows is None else maxRows
+    maxColumns = int(os.getenv("FAST_PATH_MAX_COLUMNS", "6")) if maxColumns is None else maxColumns
+    return maxRows, maxColumns
+
+
+def formatValue(value) -> str:
+    """
+    Returns:
+        str: A value as shown to the user. Decimals get thousands separators and at most two decimals; integers
+            are left as they are, since they are as often years or identifiers as quantities.
+    """
+    if value is None:
+        return "NULL"
+    if isinstance(value, (bool, int)):
+        return str(value)
+    if isinstance(value, (float, Decimal)):
+        if not math.isfinite(value):
+            return str(value)
+        return f"{value:,.2f}" if abs(value) >= 1 or value == 0 else f"{float(value):.4g}"
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    text = " ".join(str(value).split())
+    return text if len(text) <= 100 else text[:100] + "..."
+
+
+def _label(column: str) -> str:
+    return column.replace("_", " ").lower() if _IDENTIFIER.fullmatch(column) else None
+
+
+def _markdownTable(result) -> str:
+    lines = ["| " + " | ".join(result.columns) + " |", "|" + " --- |" * len(result.columns)]
+    for row in result.rows():
+        lines.append("| " + " | ".join(formatValue(value).replace("|", "\\|") for value in row) + " |")
+    return "\n".join(lines)
+
+
+def renderFastAnswer(question: str, result, inlineTable: bool = True, maxRows: int = None,
+                     maxColumns: int = None):
+    """
+    Answer directly from the shape of a query result when no LLM summary is needed.
+
+    Empty results, single values, single rows and small tables are rendered from templates. Large, truncated
+    or wide results, and questions asking for an explanation, return None and go to the answer LLM.
+
+    Args:
+        question (str): The user's natural language question.
+        result (QueryResult): The result of the generated query.
+        inlineTable (bool): Whether small tables are included as Markdown. Set it to False when the caller
+            already displays the result, e.g. with `st.dataframe`.
+        maxRows (int): Largest table answered directly. Defaults to FAST_PATH_MAX_ROWS or 20.
+        maxColumns (int): Widest table answered directly. Defaults to FAST_PATH_MAX_COLUMNS or 6.
+
+    Returns:
+        str: The Markdown answer, or None if the answer LLM should write it.
+    """
+    if os.getenv("ANSWER_FAST_PATH", "true").lower() not in ("1", "true", "yes"):
+        return None
+    maxRows, maxColumns = _fastPathSettings(maxRows, maxColumns)
+    if NARRATIVE_WORDS & set(re.findall(r"[a-z]+", question.lower())):
+        return None
+    if not result.columns:
+        return "The statement ran but returned no rows."
+    if result.truncated or result.rowCount > maxRows or len(result.columns) > maxColumns:
+        return None
+    if result.rowCount == 0:
+        return "No rows match your question."
+    if result.rowCount == 1 and len(result.columns) == 1:
+        label = _label(result.columns[0])
+        value = formatValue(result.data[result.columns[0]][0])
+        return f"The {label} is **{value}**." if label else f"The result is **{value}**."
+    if result.rowCount == 1:
+        return "\n".join(f"- **{column}**: {formatValue(result.data[column][0])}" for column in result.columns)
+    if not inlineTable:
+        return f"Here are the {result.rowCount} matching rows."
+    return f"Here are the {result.rowCount} matching rows:\n\n{_markdownTable(result)}"
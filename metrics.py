@@ -0,0 +1,239 @@
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from chat_history import estimateTokens
+
+# Number of recent samples per stage used for the percentiles
+WINDOW = 2048
+QUANTILES = (0.5, 0.9, 0.99)
+
+_currentTurn = contextvars.ContextVar("currentTurn", default=None)
+
+
+class Metrics:
+    """Process-wide latency samples per stage and counters, exposed in the Prometheus text format."""
+
+    def __init__(self, window: int = WINDOW):
+        self._samples = defaultdict(lambda: deque(maxlen=window))
+        self._sums = defaultdict(float)
+        self._counts = defaultdict(int)
+        self._counters = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def observe(self, stage: str, seconds: float):
+        """Record the duration of one run of a stage."""
+        with self._lock:
+            self._samples[stage].append(seconds)
+            self._sums[stage] += seconds
+            self._counts[stage] += 1
+
+    def increment(self, name: str, value: float = 1):
+        """Add to a counter, such as tokens or cache hits."""
+        with self._lock:
+            self._counters[name] += value
+
+    def percentile(self, stage: str, quantile: float) -> float:
+        """
+        Args:
+            stage (str): The stage name.
+            quantile (float): Between 0 and 1, e.g. 0.99.
+
+        Returns:
+            float: The quantile over the recent samples, in seconds, or None without samples.
+        """
+        with self._lock:
+            samples = sorted(self._samples.get(stage, ()))
+        if not samples:
+            return None
+        # Nearest-rank percentile
+        return samples[max(math.ceil(quantile * len(samples)) - 1, 0)]
+
+    def stages(self) -> list:
+        with self._lock:
+            return sorted(self._samples)
+
+    def toPrometheus(self) -> str:
+        """
+        Returns:
+            str: Stage latency summaries and counters in the Prometheus text exposition format.
+        """
+        lines = ["# TYPE askdb_stage_seconds summary"]
+        for stage in self.stages():
+            for quantile in QUANTILES:
+                lines.append(f'askdb_stage_seconds{{stage="{stage}",quantile="{quantile}"}} '
+                             f'{self.percentile(stage, quantile):.6f}')
+            with self._lock:
+                lines.append(f'askdb_stage_seconds_sum{{stage="{stage}"}} {self._sums[stage]:.6f}')
+                lines.append(f'askdb_stage_seconds_count{{stage="{stage}"}} {self._counts[stage]}')
+        with self._lock:
+            counters = sorted(self._counters.items())
+        for name, value in counters:
+            lines.append(f"# TYPE askdb_{name}_total counter")
+            lines.append(f"askdb_{name}_total {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+@contextmanager
+def recordTurn(question: str = None):
+    """
+    Collect the stage timings and counters of one question into a dictionary.
+
+    On exit the turn is appended to the JSONL log named by METRICS_LOG, if set.
+
+    Args:
+        question (str): The user's question, stored with the turn.
+
+    Yields:
+        dict: The turn, with "stages" (seconds per stage) and "values" (tokens, rows, cache hits).
+    """
+    turn = {"question": question, "started": time.time(), "stages": {}, "values": defaultdict(float)}
+    token = _currentTurn.set(turn)
+    start = time.perf_counter()
+    try:
+        yield turn
+    finally:
+        _currentTurn.reset(token)
+        turn["stages"]["total"] = time.perf_counter() - start
+        METRICS.observe("total", turn["stages"]["total"])
+        log_path = os.getenv("METRICS_LOG")
+        if log_path:
+            with open(log_path, "a", encoding="utf-8") as log:
+                log.write(json.dumps(turn, default=str) + "\n")
+
+
+def observeStage(stage: str, seconds: float):
+    """Record a stage duration in the current turn, if any, and in the process-wide metrics."""
+    METRICS.observe(stage, seconds)
+    turn = _currentTurn.get()
+    if turn is not None:
+        turn["stages"][stage] = turn["stages"].get(stage, 0.0) + seconds
+
+
+def recordValue(name: str, value: float = 1):
+    """Add to a per-turn value, if a turn is being recorded, and to the process-wide counter."""
+    METRICS.increment(name, value)
+    turn = _currentTurn.get()
+    if turn is not None:
+        turn["values"][name] += value
+
+
+@contextmanager
+def timed(stage: str):
+    """Time the enclosed block as one run of `stage`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observeStage(stage, time.perf_counter() - start)
+
+
+def turnTable(turn: dict) -> dict:
+    """
+    Lay out the stage timings of a turn next to the process-wide percentiles, for `st.table`.
+
+    Args:
+        turn (dict): A turn collected by `recordTurn`.
+
+    Returns:
+        dict: Columns "stage", "this turn (ms)", "p50 (ms)" and "p99 (ms)".
+    """
+    def milliseconds(seconds):
+        return None if seconds is None else round(seconds * 1000, 1)
+
+    stages = list(turn["stages"])
+    return {
+        "stage": stages,
+        "this turn (ms)": [milliseconds(turn["stages"][stage]) for stage in stages],
+        "p50 (ms)": [milliseconds(METRICS.percentile(stage, 0.5)) for stage in stages],
+        "p99 (ms)": [milliseconds(METRICS.percentile(stage, 0.99)) for stage in stages],
+    }
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    """
+    LangChain callback handler timing every chat model call and counting its tokens.
+
+    The stage is read from the "stage" metadata of the call, e.g. "sql_generation" or "answer_generation".
+    Token counts come from the model's usage metadata when available and are estimated otherwise.
+    """
+
+    def __init__(self):
+        self._starts = {}
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+        prompt = "\n".join(str(message.content) for batch in messages for message in batch)
+        self._starts[run_id] = (time.perf_counter(), (metadata or {}).get("stage", "llm"), estimateTokens(prompt))
+
+    def on_llm_start(self, serialized, prompts, *, run_id, metadata=None, **kwargs):
+        self._starts[run_id] = (time.perf_counter(), (metadata or {}).get("stage", "llm"),
+                                estimateTokens("\n".join(prompts)))
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        start = self._starts.pop(run_id, None)
+        if start is None:
+            return
+        started, stage, prompt_tokens = start
+        observeStage(stage, time.perf_counter() - started)
+        completion = "".join(generation.text for generations in response.generations for generation in generations)
+        completion_tokens = estimateTokens(completion)
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    prompt_tokens = usage.get("input_tokens", prompt_tokens)
+                    completion_tokens = usage.get("output_tokens", completion_tokens)
+        recordValue(f"{stage}_prompt_tokens", prompt_tokens)
+        recordValue(f"{stage}_completion_tokens", completion_tokens)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        start = self._starts.pop(run_id, None)
+        if start is not None:
+            recordValue(f"{start[1]}_errors")
+
+
+METRICS_HANDLER = MetricsCallbackHandler()
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = METRICS.toPrometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_server = None
+_serverLock = threading.Lock()
+
+
+def startMetricsServer(port: int = None):
+    """
+    Serve the Prometheus text endpoint from a background thread, once per process.
+
+    Args:
+        port (int): The port to listen on. Defaults to METRICS_PORT; nothing is started if neither is set.
+    """
+    global _server
+    port = port or int(os.getenv("METRICS_PORT", "0"))
+    with _serverLock:
+        if _server is not None or not port:
+            return
+        _server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsRequestHandler)
+        threading.Thread(target=_server.serve_forever, daemon=True).start()
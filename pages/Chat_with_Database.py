@@ -1,170 +1,16 @@
 import streamlit as st
-from dotenv import load_dotenv
-import os
-from sqlalchemy.engine import create_engine
-from urllib.parse import quote_plus
-from langchain_core.messages import AIMessage, HumanMessage
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
-from langchain_community.utilities import SQLDatabase
-from langchain_core.output_parsers import StrOutputParser
-from langchain_openai import ChatOpenAI
-from langchain_google_genai import ChatGoogleGenerativeAI
-
-
-def initPostgresDatabase(user: str, password: str, host: str, port: str, database: str):
-    """
-    Initialize the connection to the PostgreSQL database.
-
-    Args:
-        user (str): The database user.
-        password (str): The database user's password.
-        host (str): The database host.
-        port (str): The database port.
-        database (str): The name of the database.
-
-    Returns:
-        SQLDatabase: The SQLDatabase object representing the connection.
-    """
-    encoded_password = quote_plus(password)
-    db_uri = f"postgresql+psycopg2://{user}:{encoded_password}@{host}:{port}/{database}"
-    engine = create_engine(db_uri)
-    sql_database = SQLDatabase.from_uri(db_uri)
-    return sql_database, engine
-
-
-def initMysqlDatabase(user: str, password: str, host: str, port: str, database: str):
-    """
-    Initialize the connection to the MySQL database.
-
-    Args:
-        user (str): The database user.
-        password (str): The database user's password.
-        host (str): The database host.
-        port (str): The database port.
-        database (str): The name of the database.
-
-    Returns:
-        tuple: A tuple containing the SQLDatabase object and the SQLAlchemy engine.
-    """
-    encoded_password = quote_plus(password)
-    db_uri = f"mysql+mysqlconnector://{user}:{encoded_password}@{host}:{port}/{database}"
-    engine = create_engine(db_uri)
-    sql_database = SQLDatabase.from_uri(db_uri)
-    return sql_database, engine
-
-
-def getSqlChain(db):
-    """
-    Create a chain of operations to generate an SQL query from a user's natural language question.
-
-    Args:
-        db (SQLDatabase): The SQLDatabase object representing the connection.
-
-    Returns:
-        RunnablePassthrough: A chain of operations that generate the SQL query.
-    """
-    template = """You are a data analyst at a company. You are interacting with a user who is asking you questions 
-    about the company's database. Based on the table schema below, write a SQL query that would answer the user's 
-    question. Take the conversation history into account.
-
-    <SCHEMA>{schema}</SCHEMA>
-
-    Conversation History: {chat_history}
-
-    Write only the SQL query and nothing else. Do not wrap the SQL query in any other text, not even backticks.
-
-    For example:
-    Question: which 3 artists have the most tracks?
-    SQL Query: SELECT ArtistId, COUNT(*) as track_count FROM Track GROUP BY ArtistId ORDER BY track_count DESC LIMIT 3;
-    Question: Name 10 artists
-    SQL Query: SELECT Name FROM Artist LIMIT 10;
-
-    Your turn:
-
-    Question: {question}
-    SQL Query:
-    """
-
-    prompt = ChatPromptTemplate.from_template(template)
-
-    llm = ChatGoogleGenerativeAI(model="gemini-pro",
-                                 google_api_key=os.getenv("GOOGLE_API_KEY"),
-                                 temperature=0.7, top_p=0.85)
-
-    def getSchema(_):
-        """
-        Retrieve the schema information from the database.
-
-        Args:
-            _ : Placeholder for the argument.
-
-        Returns:
-            str: The schema information.
-        """
-        return db.get_table_info()
-
-    return (
-            RunnablePassthrough.assign(schema=getSchema)
-            | prompt
-            | llm
-            | StrOutputParser()
-    )
 
+from chat_store import ChatStore, renderChat
+from config import loadConfig
+# LLM, database and metrics modules are imported where they are first needed, which keeps cold start short
 
-def getResponse(userQuery: str, db: SQLDatabase, chatHistory: list):
-    """
-    Generate a natural language response to the user's question based on the database content.
-
-    Args:
-        userQuery (str): The user's natural language question.
-        db (SQLDatabase): The SQLDatabase object representing the connection.
-        chatHistory (list): The history of the chat interaction.
-
-    Returns:
-        str: The natural language response to the user's question.
-    """
-    sql_chain = getSqlChain(db)
-
-    template = """You are a data analyst at a company. You are interacting with a user who is asking you questions 
-    about the company's database. Based on the table schema below, question, sql query, and sql response, 
-    write a natural language response. <SCHEMA>{schema}</SCHEMA>
-
-    Conversation History: {chat_history}
-    SQL Query: <SQL>{query}</SQL>
-    User question: {question}
-    SQL Response: {response}"""
-
-    prompt = ChatPromptTemplate.from_template(template)
-
-    llm = ChatGoogleGenerativeAI(model="gemini-pro",
-                                 google_api_key=os.getenv("GOOGLE_API_KEY"),
-                                 temperature=0.7, top_p=0.85)
-
-    chain = (
-            RunnablePassthrough.assign(query=sql_chain).assign(
-                schema=lambda _: db.get_table_info(),
-                response=lambda variables: db.run(variables["query"]),
-            )
-            | prompt
-            | llm
-            | StrOutputParser()
-    )
-
-    return chain.invoke({
-        "question": userQuery,
-        "chat_history": chatHistory,
-    })
-
+# Load environment variables from .env file and start the metrics endpoint, once per process
+loadConfig()
 
 # Check if chat history is initialized in session state
-if "chat_history" not in st.session_state:
-    st.session_state.chat_history = [
-        AIMessage(content="Hello! I'm a SQL assistant. Ask me anything about your database."),
-    ]
-
-# Load environment variables from .env file
-load_dotenv()
+if "chat" not in st.session_state:
+    st.session_state.chat = ChatStore()
+    st.session_state.chat.add("ai", "Hello! I'm a SQL assistant. Ask me anything about your database.")
 
 # Configure Streamlit page settings
 st.set_page_config(page_title="Chat with Database", page_icon=":robot_face:")
@@ -186,10 +32,13 @@ with st.sidebar:
     st.text_input("User", value="root", key="User")
     st.text_input("Password", type="password", value="", key="Password")
     st.text_input("Database", value="", key="Database")
+    st.toggle("Stream responses", value=True, key="stream_responses")
 
     # Button to connect to the selected database
     if st.button("Connect"):
         with st.spinner("Connecting to database..."):
+            from assistant import initMysqlDatabase, initPostgresDatabase
+
             try:
                 if database == 'MySQL':
                     sql_db, engine = initMysqlDatabase(
@@ -207,32 +56,65 @@ with st.sidebar:
                         st.session_state["Port"],
                         st.session_state["Database"]
                     )
+                from schema_cache import getSchemaCache
+
+                # Build the schema snapshot once so the first question doesn't pay for it
+                getSchemaCache(sql_db).refresh()
                 st.session_state.db = sql_db
                 st.session_state.engine = engine
                 st.success("Connected to database!")
             except Exception as e:
                 st.error(f"Failed to connect to the database: {e}")
 
-# Display chat history
-for message in st.session_state.chat_history:
-    if isinstance(message, AIMessage):
-        with st.chat_message("AI"):
-            st.markdown(message.content)
-    elif isinstance(message, HumanMessage):
-        with st.chat_message("Human"):
-            st.markdown(message.content)
+# Display chat history: recent messages in full, older ones in a collapsed, paginated archive
+renderChat(st.session_state.chat, st.session_state.get("db"))
 
 # Input field for user query
 user_query = st.chat_input("Type a message...")
 if user_query is not None and user_query.strip() != "":
-    st.session_state.chat_history.append(HumanMessage(content=user_query))
+    from assistant import getResponse
+    from chain_factory import streamResponse
+    from metrics import recordTurn
+    from sql_guard import QueryRejected
+
+    st.session_state.chat.add("human", user_query)
 
     with st.chat_message("Human"):
         st.markdown(user_query)
 
     # Generate response based on user query and display AI message
-    with st.chat_message("AI"):
-        response = getResponse(user_query, st.session_state.db, st.session_state.chat_history)
-        st.markdown(response)
-
-    st.session_state.chat_history.append(AIMessage(content=response))
+    with st.chat_message("AI"), recordTurn(user_query) as turn:
+        query, result = None, None
+        try:
+            if st.session_state.stream_responses:
+                # Show the SQL as soon as it is generated, then stream the answer into the bubble
+                timings = {}
+                query, result, tokens = streamResponse(user_query, st.session_state.db, st.session_state.chat.messages,
+                                                       timings)
+                st.code(query, language="sql")
+                if result.columns:
+                    st.dataframe(result.data)
+                    if result.truncated:
+                        st.caption(f"Showing the first {result.rowCount} rows.")
+                response = st.write_stream(tokens)
+                if "time_to_first_token" in timings:
+                    st.caption(f"Time to first token: {timings['time_to_first_token']:.2f}s")
+            else:
+                response = getResponse(user_query, st.session_state.db, st.session_state.chat.messages)
+                st.markdown(response)
+        except QueryRejected as error:
+            # The generated SQL was refused twice by the pre-execution guard, so nothing ran
+            response = f"I could not run a query for that question: {error}"
+            st.warning(response)
+
+    st.session_state.chat.add("ai", response, query=query, result=result)
+    st.session_state.last_turn = turn
+
+# Per-turn timing panel, next to the process-wide percentiles
+if "last_turn" in st.session_state:
+    from metrics import turnTable
+
+    with st.sidebar:
+        st.subheader("Last turn")
+        st.table(turnTable(st.session_state.last_turn))
+        st.caption(", ".join(f"{name}: {value:g}" for name, value in st.session_state.last_turn["values"].items()))
@@ -1,18 +1,25 @@
-from dotenv import load_dotenv
-import streamlit as st
 import os
-import google.generativeai as genai
 
-# Load environment variables
-load_dotenv()
+import streamlit as st
+
+from config import loadConfig
+
+# Load environment variables, once per process
+loadConfig()
+
+
+# Import and configure the Generative AI SDK on first use, and build the model once per process
+@st.cache_resource
+def getGeminiModel():
+    import google.generativeai as genai
 
-# Configure the Generative AI API
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+    return genai.GenerativeModel('gemini-pro')
 
 
 # Function to get response from Generative AI model
 def getGeminiResponse(prompt):
-    model = genai.GenerativeModel('gemini-pro')
+    model = getGeminiModel()
     query = model.generate_content([prompt])
     # Remove backticks and the "sql" keyword from the response text
     sql_query = query.text.strip().replace('`', '').replace('sql', '')
@@ -0,0 +1,144 @@
+"""
+Log of the generated queries that actually ran, with their execution time, for `summary_tables` to mine.
+
+Only executions are logged: result cache hits cost nothing and say nothing about the database. The log is
+kept in memory, or in a SQLite file when QUERY_LOG_PATH is set. The file is what lets a separate process,
+such as the scheduled `python summary_tables.py refresh --create`, read what the app and the API ran; the
+command refuses to run without it.
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+from functools import lru_cache
+
+from query_runner import executeQuery
+
+# The file is pruned to the newest `maxSize` entries once every this many inserts
+PRUNE_EVERY = 100
+
+
+class QueryLog:
+    """The newest executed queries of every database, optionally written through to a SQLite file."""
+
+    def __init__(self, maxSize: int = 10000, path: str = None):
+        """
+        Args:
+            maxSize (int): Maximum number of entries kept, over all databases.
+            path (str): Optional SQLite file shared with other processes.
+        """
+        self.maxSize = maxSize
+        self._entries = deque(maxlen=maxSize)
+        self._lock = threading.Lock()
+        self._inserts = 0
+        self._disk = None
+        if path:
+            self._disk = sqlite3.connect(path, check_same_thread=False, timeout=5)
+            # Written on every execution: WAL keeps writers from blocking the miner and skips most fsyncs
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute("PRAGMA synchronous=NORMAL")
+            self._disk.execute("""
+                CREATE TABLE IF NOT EXISTS queries (
+                    scope TEXT, sql TEXT, seconds REAL, row_count INTEGER, ran_at REAL
+                )
+            """)
+            self._disk.commit()
+
+    def add(self, scope: str, sql: str, seconds: float, rowCount: int):
+        """
+        Log one execution.
+
+        Args:
+            scope (str): Identifies the database.
+            sql (str): The SQL query that ran.
+            seconds (float): Its execution time.
+            rowCount (int): The number of rows it returned.
+        """
+        entry = (scope, sql, seconds, rowCount, time.time())
+        with self._lock:
+            if self._disk is None:
+                self._entries.append(entry)
+                return
+            try:
+                self._disk.execute("INSERT INTO queries VALUES (?, ?, ?, ?, ?)", entry)
+                self._inserts += 1
+                if self._inserts % PRUNE_EVERY == 0:
+                    self._disk.execute("DELETE FROM queries WHERE rowid <= (SELECT MAX(rowid) FROM queries) - ?",
+                                       (self.maxSize,))
+                self._disk.commit()
+            except sqlite3.Error:
+                # Losing a log entry must never fail the user's turn
+                self._disk.rollback()
+
+    def entries(self, scope: str, since: float = 0.0) -> list:
+        """
+        Args:
+            scope (str): Identifies the database.
+            since (float): Only entries logged after this UNIX time.
+
+        Returns:
+            list: (sql, seconds, row count, UNIX time) tuples, oldest first.
+        """
+        with self._lock:
+            if self._disk is None:
+                return [entry[1:] for entry in self._entries if entry[0] == scope and entry[4] > since]
+            return self._disk.execute("SELECT sql, seconds, row_count, ran_at FROM queries "
+                                      "WHERE scope = ? AND ran_at > ? ORDER BY rowid", (scope, since)).fetchall()
+
+    def clear(self):
+        """Drop every entry."""
+        with self._lock:
+            self._entries.clear()
+            if self._disk is not None:
+                self._disk.execute("DELETE FROM queries")
+                self._disk.commit()
+
+
+@lru_cache(maxsize=None)
+def getQueryLog() -> QueryLog:
+    """
+    Return the process-wide query log, configured from the environment (.env).
+
+    QUERY_LOG_SIZE (0 turns logging off) and QUERY_LOG_PATH (SQLite file) are honoured.
+
+    Returns:
+        QueryLog: The shared log.
+    """
+    return QueryLog(maxSize=int(os.getenv("QUERY_LOG_SIZE", "10000")), path=os.getenv("QUERY_LOG_PATH") or None)
+
+
+def queryScope(db) -> str:
+    """
+    Returns:
+        str: The scope of a connection's log entries, its URL without the password.
+    """
+    return db._engine.url.render_as_string(hide_password=True)
+
+
+def logQuery(db, sql: str, seconds: float, rowCount: int):
+    """
+    Log an execution of a generated query, unless QUERY_LOG_SIZE is 0.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        sql (str): The SQL query that ran.
+        seconds (float): Its execution time.
+        rowCount (int): The number of rows it returned.
+    """
+    log = getQueryLog()
+    if log.maxSize:
+        log.add(queryScope(db), sql, seconds, rowCount)
+
+
+def loggedExecute(db, sql: str):
+    """
+    `executeQuery` that logs the execution, for `ResultCache.run`.
+
+    Returns:
+        QueryResult: The result of `executeQuery`.
+    """
+    start = time.perf_counter()
+    result = executeQuery(db, sql)
+    logQuery(db, sql, time.perf_counter() - start, result.rowCount)
+    return result
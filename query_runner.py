@@ -0,0 +1,312 @@
+import asyncio
+import os
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+
+from sqlalchemy import text
+from sqlalchemy.exc import ResourceClosedError
+
+# Cells longer than this are cut in the LLM summary, like SQLDatabase.run does
+MAX_CELL_LENGTH = 100
+
+# Server-side statement timeouts, in milliseconds, so that a runaway query is cancelled by the database itself.
+# SET LOCAL ends with the transaction; MySQL has no transaction-scoped variable, so a session SET would stay
+# on the pooled connection, and the timeout is given as an optimizer hint of the statement instead
+STATEMENT_TIMEOUTS = {
+    "postgresql": "SET LOCAL statement_timeout = {milliseconds}",
+}
+STATEMENT_HINTS = {
+    "mysql": "/*+ MAX_EXECUTION_TIME({milliseconds}) */",
+}
+
+# Quoted text, parentheses and SELECT keywords, to find the SELECT of the statement's outer query block
+_SELECT_TOKENS = re.compile(r"'(?:[^']|'')*'|\"[^\"]*\"|`[^`]*`|\(|\)|\bselect\b", re.IGNORECASE)
+
+
+def _cellSize(value) -> int:
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return 8
+
+
+def _cellText(value) -> str:
+    value = str(value)
+    return value if len(value) <= MAX_CELL_LENGTH else value[:MAX_CELL_LENGTH] + "..."
+
+
+@dataclass
+class QueryResult:
+    """
+    Columnar result of a query, capped in rows and bytes.
+
+    `data` maps each column name to its list of values, which `st.dataframe` renders directly.
+    """
+    columns: list
+    data: dict = field(default_factory=dict)
+    rowCount: int = 0
+    truncated: bool = False
+    byteCount: int = 0
+
+    def rows(self, limit: int = None) -> list:
+        """
+        Args:
+            limit (int): Optional maximum number of rows.
+
+        Returns:
+            list: The result as a list of row tuples.
+        """
+        count = self.rowCount if limit is None else min(limit, self.rowCount)
+        return [tuple(self.data[column][index] for column in self.columns) for index in range(count)]
+
+    def aggregates(self) -> dict:
+        """
+        Returns:
+            dict: A short description of each column, such as its range and mean or its most frequent value.
+        """
+        descriptions = {}
+        for column in self.columns:
+            values = [value for value in self.data[column] if value is not None]
+            nulls = self.rowCount - len(values)
+            if values and all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in values):
+                total = sum(values)
+                description = (f"min {min(values)}, max {max(values)}, "
+                               f"mean {total / len(values):.4g}, sum {total:.6g}")
+            elif values:
+                value, count = Counter(map(str, values)).most_common(1)[0]
+                description = f"{len(set(map(str, values)))} distinct, most frequent {_cellText(value)!r} ({count})"
+            else:
+                description = "no values"
+            descriptions[column] = description + (f", {nulls} nulls" if nulls else "")
+        return descriptions
+
+    def summary(self, headRows: int = 5) -> str:
+        """
+        Build the compact description of the result that is given to the LLM instead of the full rows.
+
+        Args:
+            headRows (int): Number of leading rows included verbatim.
+
+        Returns:
+            str: Row count, first rows and per-column aggregates.
+        """
+        if not self.columns:
+            return "The statement returned no rows."
+        if self.truncated:
+            lines = [f"Rows: more than {self.rowCount} (only the first {self.rowCount} were fetched)"]
+        else:
+            lines = [f"Rows: {self.rowCount}"]
+        if self.rowCount <= headRows:
+            lines.append(" | ".join(self.columns))
+            lines.extend(" | ".join(_cellText(value) for value in row) for row in self.rows())
+            return "\n".join(lines)
+        lines.append(f"First {headRows} rows:")
+        lines.append(" | ".join(self.columns))
+        lines.extend(" | ".join(_cellText(value) for value in row) for row in self.rows(headRows))
+        lines.append("Column aggregates over the fetched rows:")
+        lines.extend(f"{column}: {description}" for column, description in self.aggregates().items())
+        return "\n".join(lines)
+
+    def __str__(self) -> str:
+        return self.summary()
+
+
+def uniqueColumns(names) -> list:
+    """
+    Make column names unique, so that "SELECT a.id, b.id" keeps both columns.
+
+    Args:
+        names: The column names of a result.
+
+    Returns:
+        list: The names, with "_2", "_3"... appended to repeated ones.
+    """
+    seen = Counter()
+    columns = []
+    for name in names:
+        seen[name] += 1
+        columns.append(name if seen[name] == 1 else f"{name}_{seen[name]}")
+    return columns
+
+
+def _queryLimits(maxRows, maxBytes, timeout):
+    maxRows = int(os.getenv("QUERY_MAX_ROWS", "1000")) if maxRows is None else maxRows
+    maxBytes = int(os.getenv("QUERY_MAX_BYTES", str(5 * 1024 * 1024))) if maxBytes is None else maxBytes
+    timeout = float(os.getenv("QUERY_TIMEOUT", "30")) if timeout is None else timeout
+    return maxRows, maxBytes, timeout
+
+
+def _timeoutStatement(dialect: str, timeout: float):
+    statement = STATEMENT_TIMEOUTS.get(dialect)
+    if statement is None or not timeout:
+        return None
+    return text(statement.format(milliseconds=int(timeout * 1000)))
+
+
+def _hintedQuery(dialect: str, sql: str, timeout: float) -> str:
+    hint = STATEMENT_HINTS.get(dialect)
+    if hint is None or not timeout:
+        return sql
+    if not re.match(r"\s*(select|with)\b", sql, re.IGNORECASE):
+        # Only SELECT statements take an execution time hint
+        return sql
+    depth = 0
+    for match in _SELECT_TOKENS.finditer(sql):
+        token = match.group()
+        depth += (token == "(") - (token == ")")
+        if depth == 0 and token.lower() == "select":
+            # Hints are read right after the SELECT keyword of the outer query block, not of a CTE
+            return f"{sql[:match.end()]} {hint.format(milliseconds=int(timeout * 1000))}{sql[match.end():]}"
+    return sql
+
+
+def _appendRows(result: QueryResult, values: list, rows, maxRows: int, maxBytes: int):
+    for row in rows:
+        if result.rowCount >= maxRows or result.byteCount >= maxBytes:
+            result.truncated = True
+            return
+        for index, value in enumerate(row):
+            values[index].append(value)
+            result.byteCount += _cellSize(value)
+        result.rowCount += 1
+
+
+def executeQuery(db, sql: str, maxRows: int = None, maxBytes: int = None, fetchSize: int = 500,
+                 timeout: float = None) -> QueryResult:
+    """
+    Execute a query with a server-side cursor and stop fetching once a row or byte cap is reached.
+
+    The cursor is only server-side with drivers that support it, e.g. psycopg2 and pymysql; mysqlconnector
+    buffers the whole result client-side whatever the cap, which is why the pages connect with pymysql.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        sql (str): The SQL query.
+        maxRows (int): Maximum number of rows fetched. Defaults to QUERY_MAX_ROWS or 1000.
+        maxBytes (int): Approximate maximum size of the fetched values. Defaults to QUERY_MAX_BYTES or 5 MB.
+        fetchSize (int): Number of rows fetched per round-trip.
+        timeout (float): Statement timeout in seconds on MySQL and PostgreSQL. Defaults to QUERY_TIMEOUT or 30.
+
+    Returns:
+        QueryResult: The columnar, possibly truncated, result.
+    """
+    maxRows, maxBytes, timeout = _queryLimits(maxRows, maxBytes, timeout)
+    timeout_statement = _timeoutStatement(db.dialect, timeout)
+
+    # Like SQLDatabase.run, statements run in a transaction that is committed on success
+    with db._engine.begin() as connection:
+        if timeout_statement is not None:
+            connection.execute(timeout_statement)
+        cursor = connection.execution_options(stream_results=True, max_row_buffer=fetchSize).execute(
+            text(_hintedQuery(db.dialect, sql, timeout)))
+        if not cursor.returns_rows:
+            return QueryResult(columns=[])
+        result = QueryResult(columns=uniqueColumns(cursor.keys()))
+        values = [[] for _ in result.columns]
+        while not result.truncated:
+            rows = cursor.fetchmany(min(fetchSize, maxRows - result.rowCount + 1))
+            if not rows:
+                break
+            _appendRows(result, values, rows, maxRows, maxBytes)
+        # Closing the cursor early lets the server stop producing the rest of the result
+        cursor.close()
+    result.data = dict(zip(result.columns, values))
+    return result
+
+
+def iterQuery(db, sql: str, batchSize: int = 10000, timeout: float = None):
+    """
+    Execute a query with a server-side cursor and yield its rows batch by batch, without keeping them.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        sql (str): The SQL query.
+        batchSize (int): Number of rows fetched per round-trip and yielded at a time.
+        timeout (float): Statement timeout in seconds on MySQL and PostgreSQL. Defaults to QUERY_TIMEOUT or 30.
+
+    Yields:
+        list: The column names first, then the rows, in lists of at most `batchSize`.
+    """
+    timeout = float(os.getenv("QUERY_TIMEOUT", "30")) if timeout is None else timeout
+    timeout_statement = _timeoutStatement(db.dialect, timeout)
+    with db._engine.begin() as connection:
+        if timeout_statement is not None:
+            connection.execute(timeout_statement)
+        cursor = connection.execution_options(stream_results=True, max_row_buffer=batchSize).execute(
+            text(_hintedQuery(db.dialect, sql, timeout)))
+        if not cursor.returns_rows:
+            yield []
+            return
+        try:
+            yield uniqueColumns(cursor.keys())
+            while True:
+                rows = cursor.fetchmany(batchSize)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            # Also reached when the caller stops early, so that the server stops producing rows
+            cursor.close()
+
+
+async def aexecuteQuery(engine, sql: str, maxRows: int = None, maxBytes: int = None, fetchSize: int = 500,
+                        timeout: float = None) -> QueryResult:
+    """
+    Async counterpart of `executeQuery`, running on an async SQLAlchemy engine.
+
+    Besides the server-side statement timeout, the whole execution is cancelled client-side once `timeout`
+    has elapsed, which also covers SQLite.
+
+    Args:
+        engine (AsyncEngine): The async engine of the connection.
+        sql (str): The SQL query.
+        maxRows (int): Maximum number of rows fetched. Defaults to QUERY_MAX_ROWS or 1000.
+        maxBytes (int): Approximate maximum size of the fetched values. Defaults to QUERY_MAX_BYTES or 5 MB.
+        fetchSize (int): Number of rows fetched per round-trip.
+        timeout (float): Statement timeout in seconds. Defaults to QUERY_TIMEOUT or 30.
+
+    Returns:
+        QueryResult: The columnar, possibly truncated, result.
+
+    Raises:
+        asyncio.TimeoutError: If the query runs longer than `timeout`.
+    """
+    maxRows, maxBytes, timeout = _queryLimits(maxRows, maxBytes, timeout)
+    timeout_statement = _timeoutStatement(engine.dialect.name, timeout)
+    interrupts = []
+
+    async def run() -> QueryResult:
+        async with engine.begin() as connection:
+            if timeout_statement is not None:
+                await connection.execute(timeout_statement)
+            elif engine.dialect.name == "sqlite":
+                # SQLite has no statement timeout, but its driver can abort the running statement
+                raw_connection = await connection.get_raw_connection()
+                interrupts.append(raw_connection.driver_connection.interrupt)
+            cursor = await connection.stream(text(_hintedQuery(engine.dialect.name, sql, timeout)))
+            try:
+                columns = cursor.keys()
+            except ResourceClosedError:
+                # The statement doesn't return rows
+                return QueryResult(columns=[])
+            result = QueryResult(columns=uniqueColumns(columns))
+            values = [[] for _ in result.columns]
+            while not result.truncated:
+                rows = await cursor.fetchmany(min(fetchSize, maxRows - result.rowCount + 1))
+                if not rows:
+                    break
+                _appendRows(result, values, rows, maxRows, maxBytes)
+            await cursor.close()
+        result.data = dict(zip(result.columns, values))
+        return result
+
+    task = asyncio.ensure_future(run())
+    done, _ = await asyncio.wait({task}, timeout=timeout or None)
+    if not done:
+        # Abort the statement first, otherwise cancelling waits for the rollback queued behind it
+        for interrupt in interrupts:
+            await interrupt()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        raise asyncio.TimeoutError(f"Query cancelled after {timeout} seconds")
+    return task.result()
@@ -0,0 +1,404 @@
+import asyncio
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+from sqlalchemy import bindparam, text
+from sqlalchemy.exc import DBAPIError
+
+from metrics import recordValue
+from query_runner import executeQuery
+
+# Per-table markers that change whenever rows are written.
+# MySQL only maintains UPDATE_TIME for some engines, so TABLE_ROWS is added as a fallback signal.
+CHANGE_MARKER_QUERIES = {
+    "mysql": """
+        SELECT LOWER(table_name), CONCAT_WS('|', UPDATE_TIME, TABLE_ROWS)
+        FROM information_schema.tables
+        WHERE table_schema = DATABASE() AND table_type = 'BASE TABLE' AND LOWER(table_name) IN :tables
+    """,
+    "postgresql": """
+        SELECT LOWER(relname), n_tup_ins + n_tup_upd + n_tup_del
+        FROM pg_stat_user_tables
+        WHERE LOWER(relname) IN :tables
+    """,
+}
+
+# MySQL 8 caches the UPDATE_TIME and TABLE_ROWS of information_schema.tables for information_schema_stats_expiry
+# seconds (a day by default), so the session reads live statistics while the markers are read. MySQL 5.7 has
+# no such cache, nor the variable, and the statement failing there is ignored
+CHANGE_MARKER_SESSIONS = {
+    "mysql": ("SET SESSION information_schema_stats_expiry = 0",
+              "SET SESSION information_schema_stats_expiry = DEFAULT"),
+}
+
+# Quoted text is matched before comments, so that "--" or "/*" inside a literal doesn't start one
+_QUOTED = r"'(?:[^']|'')*'|\"[^\"]*\"|`[^`]*`"
+_COMMENT = r"--[^\n]*|/\*.*?(?:\*/|$)"
+_COMMENTS = re.compile(rf"({_QUOTED})|{_COMMENT}", re.DOTALL)
+_TOKENS = re.compile(rf"{_QUOTED}|(?P<comment>{_COMMENT})|\s+|(?:[^\s'\"`/-]|-(?!-)|/(?!\*))+|.", re.DOTALL)
+# String literals, dotted and possibly quoted identifiers, parentheses, commas and anything else
+_SCAN_TOKENS = re.compile(r"'(?:[^']|'')*'|(?:\"[^\"]*\"|`[^`]*`|[\w$]+)(?:\s*\.\s*(?:\"[^\"]*\"|`[^`]*`|[\w$]+|\*))*"
+                          r"|[(),]|[^\s\w'\"`(),]+")
+_CTE_NAMES = re.compile(r"(?:\bwith|,)\s*(?:recursive\s+)?([\w$]+)(?:\s*\([^)]*\))?\s+as\s*\(", re.IGNORECASE)
+# Words that end the FROM clause of a query block
+_CLAUSE_ENDS = {"where", "group", "order", "having", "limit", "union", "intersect", "except", "window", "offset",
+                "fetch", "select", "for", "qualify"}
+# Words that may follow FROM or JOIN but aren't a plain table, so the tables read can't be told for sure
+_NOT_TABLES = {"lateral", "unnest", "values", "table", "select", "with", "only"}
+
+
+def stripComments(sql: str) -> str:
+    """
+    Replace the comments of a query with spaces, leaving string literals and quoted identifiers untouched.
+
+    Args:
+        sql (str): The SQL query.
+
+    Returns:
+        str: The query without comments, of the same length.
+    """
+    return _COMMENTS.sub(lambda match: match.group(1) or " " * len(match.group()), sql)
+
+
+def canonicalizeSql(sql: str) -> str:
+    """
+    Canonicalize SQL text so that formatting differences don't produce distinct cache keys.
+
+    Comments are removed, whitespace outside string literals is collapsed and trailing semicolons are dropped.
+
+    Args:
+        sql (str): The SQL query.
+
+    Returns:
+        str: The canonical SQL text.
+    """
+    tokens = []
+    for match in _TOKENS.finditer(sql):
+        token = " " if match.group("comment") or match.group().isspace() else match.group()
+        if token != " " or (tokens and tokens[-1] != " "):
+            tokens.append(token)
+    canonical = "".join(tokens).strip()
+    return canonical.rstrip(";").strip()
+
+
+def _tablesWithSqlglot(sql: str, dialect: str):
+    try:
+        import sqlglot
+        from sqlglot import expressions
+    except ImportError:
+        return None
+
+    # Imported here: sql_guard itself builds on this module
+    from sql_guard import SQLGLOT_DIALECTS
+
+    try:
+        statement = sqlglot.parse_one(sql, read=SQLGLOT_DIALECTS.get(dialect))
+    except sqlglot.errors.ParseError:
+        return set(), False
+    ctes = {cte.alias_or_name.lower() for cte in statement.find_all(expressions.CTE)}
+    tables = set()
+    certain = True
+    for table in statement.find_all(expressions.Table):
+        if not isinstance(table.this, expressions.Identifier):
+            # A table function, such as generate_series(...)
+            certain = False
+        elif table.name.lower() not in ctes:
+            tables.add(table.name.lower())
+    others = tuple(getattr(expressions, name) for name in ("Lateral", "Unnest", "Values") if hasattr(expressions, name))
+    if others and statement.find(*others) is not None:
+        certain = False
+    return tables, certain
+
+
+def _tablesWithTokens(sql: str):
+    code = stripComments(sql)
+    ctes = {name.lower() for name in _CTE_NAMES.findall(code)}
+    tokens = _SCAN_TOKENS.findall(code)
+    tables = set()
+    certain = True
+    # One frame per open parenthesis: whether it holds a query block, whether its FROM clause is being read
+    # and whether a table reference comes next. FROM inside function arguments, as in EXTRACT(YEAR FROM d),
+    # is in a frame that isn't a query block and is skipped
+    frames = [{"query": True, "from": False, "expect": False}]
+    for index, token in enumerate(tokens):
+        frame = frames[-1]
+        word = token.lower()
+        following = tokens[index + 1].lower() if index + 1 < len(tokens) else ""
+        if token == "(":
+            if frame["query"] and frame["expect"]:
+                frame["expect"] = False
+                # A derived table is read like any subquery; a parenthesized join opens a FROM clause
+                nested = following in ("select", "with")
+                frames.append({"query": True, "from": not nested, "expect": not nested})
+            else:
+                frames.append({"query": following in ("select", "with"), "from": False, "expect": False})
+        elif token == ")":
+            if len(frames) == 1:
+                return tables, False
+            frames.pop()
+        elif not frame["query"]:
+            continue
+        elif frame["expect"]:
+            frame["expect"] = False
+            if token.startswith("'") or word in _NOT_TABLES or following == "(":
+                certain = False
+                continue
+            name = re.split(r"\s*\.\s*", token)[-1].strip('`"').lower()
+            if name not in ctes:
+                tables.add(name)
+        elif word in ("from", "join"):
+            frame["from"] = frame["expect"] = True
+        elif token == "," and frame["from"]:
+            # Comma joins, also after a JOIN ... ON condition
+            frame["expect"] = True
+        elif word in _CLAUSE_ENDS:
+            frame["from"] = False
+    if len(frames) != 1:
+        certain = False
+    return tables, certain
+
+
+def _scanTables(sql: str, dialect: str = None):
+    return _tablesWithSqlglot(sql, dialect) or _tablesWithTokens(sql)
+
+
+def extractTables(sql: str, dialect: str = None) -> set:
+    """
+    Extract the names of the tables a query reads from.
+
+    sqlglot is used when it is installed; otherwise the query is scanned token by token.
+
+    Args:
+        sql (str): The SQL query.
+        dialect (str): Optional SQLAlchemy dialect name, e.g. "mysql", for sqlglot.
+
+    Returns:
+        set: Lower-cased table names, without schema qualifiers or quotes.
+    """
+    return _scanTables(sql, dialect)[0]
+
+
+def cacheableTables(sql: str, dialect: str = None):
+    """
+    Extract the tables of a query whose result may be cached.
+
+    Args:
+        sql (str): The SQL query.
+        dialect (str): Optional SQLAlchemy dialect name, e.g. "mysql", for sqlglot.
+
+    Returns:
+        set: Lower-cased table names, or None when the query isn't read-only, reads no table or reads from
+            something the extraction can't be sure of, such as a table function; its result isn't cached then.
+    """
+    if not isReadOnly(sql):
+        return None
+    tables, certain = _scanTables(sql, dialect)
+    return tables if certain and tables else None
+
+
+def isReadOnly(sql: str) -> bool:
+    """
+    Returns:
+        bool: Whether the statement is a query whose result may be cached.
+    """
+    return canonicalizeSql(sql).split(" ", 1)[0].lower() in ("select", "with")
+
+
+class ResultCache:
+    """
+    Cache of query results keyed on canonical SQL, invalidated per referenced table.
+
+    An entry is dropped when it is older than the TTL, when one of its tables is invalidated explicitly,
+    or, on MySQL and PostgreSQL, when the change markers of its tables differ from those seen at store time.
+    """
+
+    def __init__(self, maxSize: int = 256, ttl: float = 300.0, useChangeMarkers: bool = True):
+        """
+        Args:
+            maxSize (int): Maximum number of results kept.
+            ttl (float): Number of seconds after which a result expires.
+            useChangeMarkers (bool): Whether to validate entries against the per-table change markers.
+        """
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.useChangeMarkers = useChangeMarkers
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._byTable = {}
+        self._lock = threading.Lock()
+
+    def changeMarkers(self, db, tables: set) -> dict:
+        """
+        Read the change markers of some tables.
+
+        Args:
+            db (SQLDatabase): The SQLDatabase object representing the connection.
+            tables (set): Lower-cased table names.
+
+        Returns:
+            dict: The marker of each table, or None if the dialect has no marker query.
+        """
+        query = CHANGE_MARKER_QUERIES.get(db.dialect)
+        if not self.useChangeMarkers or query is None or not tables:
+            return None
+        statement = text(query).bindparams(bindparam("tables", expanding=True))
+        session = CHANGE_MARKER_SESSIONS.get(db.dialect)
+        with db._engine.connect() as connection:
+            if session is not None:
+                try:
+                    connection.execute(text(session[0]))
+                except DBAPIError:
+                    session = None
+            try:
+                rows = connection.execute(statement, {"tables": sorted(tables)}).fetchall()
+            finally:
+                if session is not None:
+                    # Restored before the connection goes back to the pool
+                    connection.execute(text(session[1]))
+        return {name: str(marker) for name, marker in rows}
+
+    @staticmethod
+    def _tracked(tables: set, markers) -> bool:
+        # Views, and tables the statistics don't list yet, have no marker: their changes would go unnoticed
+        if markers is not None and not tables <= markers.keys():
+            recordValue("result_cache_untracked")
+            return False
+        return True
+
+    def _lookup(self, db, sql: str, tables: set, markers):
+        key = (db._engine.url.render_as_string(hide_password=True), canonicalizeSql(sql))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                result, _, stored_markers, created = entry
+                if time.time() - created <= self.ttl and stored_markers == markers:
+                    self.hits += 1
+                    recordValue("result_cache_hits")
+                    self._entries.move_to_end(key)
+                    return key, result
+                if markers is not None and stored_markers is not None:
+                    changed = {table for table in tables if stored_markers.get(table) != markers.get(table)}
+                    self._invalidate(changed)
+                self._remove(key)
+            self.misses += 1
+            recordValue("result_cache_misses")
+        return key, None
+
+    def _store(self, key, tables: set, markers, result):
+        with self._lock:
+            self._entries[key] = (result, tables, markers, time.time())
+            for table in tables:
+                self._byTable.setdefault(table, set()).add(key)
+            while len(self._entries) > self.maxSize:
+                self._remove(next(iter(self._entries)))
+
+    def run(self, db, sql: str, execute=executeQuery):
+        """
+        Execute a query through the cache.
+
+        Queries that `cacheableTables` can't vouch for, or that read a table without a change marker such as
+        a view, are executed without it.
+
+        Args:
+            db (SQLDatabase): The SQLDatabase object representing the connection.
+            sql (str): The SQL query.
+            execute: Function called as `execute(db, sql)` on a miss.
+
+        Returns:
+            QueryResult: The result of `execute`.
+        """
+        tables = cacheableTables(sql, db.dialect)
+        if tables is None:
+            return execute(db, sql)
+        markers = self.changeMarkers(db, tables)
+        if not self._tracked(tables, markers):
+            return execute(db, sql)
+        key, result = self._lookup(db, sql, tables, markers)
+        if result is None:
+            result = execute(db, sql)
+            self._store(key, tables, markers, result)
+        return result
+
+    async def arun(self, db, sql: str, execute):
+        """
+        Async counterpart of `run`.
+
+        Args:
+            db (SQLDatabase): The SQLDatabase object representing the connection.
+            sql (str): The SQL query.
+            execute: Coroutine function called as `await execute(sql)` on a miss.
+
+        Returns:
+            QueryResult: The result of `execute`.
+        """
+        tables = cacheableTables(sql, db.dialect)
+        if tables is None:
+            return await execute(sql)
+        # The marker query is a single catalog lookup on the synchronous pool
+        markers = await asyncio.to_thread(self.changeMarkers, db, tables)
+        if not self._tracked(tables, markers):
+            return await execute(sql)
+        key, result = self._lookup(db, sql, tables, markers)
+        if result is None:
+            result = await execute(sql)
+            self._store(key, tables, markers, result)
+        return result
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        for table in entry[1]:
+            keys = self._byTable.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._byTable[table]
+
+    def _invalidate(self, tables):
+        for table in tables:
+            for key in list(self._byTable.get(table, ())):
+                self._remove(key)
+
+    def invalidateTables(self, *tables: str):
+        """
+        Drop every cached result that reads from one of the given tables.
+
+        Args:
+            *tables (str): Table names.
+        """
+        with self._lock:
+            self._invalidate(table.lower() for table in tables)
+
+    def clear(self):
+        """Drop every cached result."""
+        with self._lock:
+            self._entries.clear()
+            self._byTable.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: Hit and miss counters and the current number of entries.
+        """
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+@lru_cache(maxsize=None)
+def getResultCache() -> ResultCache:
+    """
+    Return the process-wide result cache, configured from the environment (.env).
+
+    RESULT_CACHE_SIZE, RESULT_CACHE_TTL and RESULT_CACHE_MARKERS are honoured.
+
+    Returns:
+        ResultCache: The shared cache.
+    """
+    return ResultCache(maxSize=int(os.getenv("RESULT_CACHE_SIZE", "256")),
+                       ttl=float(os.getenv("RESULT_CACHE_TTL", "300")),
+                       useChangeMarkers=os.getenv("RESULT_CACHE_MARKERS", "true").lower() in ("1", "true", "yes"))
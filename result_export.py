@@ -0,0 +1,228 @@
+"""
+Export of the full result of a query as Parquet, Arrow or CSV, streamed one `fetchmany` batch at a time.
+
+Rows are read with a server-side cursor and each batch is encoded as soon as it is fetched, so memory use
+depends on EXPORT_BATCH_SIZE and not on the size of the result.
+"""
+import csv
+import io
+import os
+
+from metrics import recordValue
+from query_runner import iterQuery
+from sql_guard import guardQuery, stripAddedLimit
+
+FORMATS = {
+    "parquet": ("application/vnd.apache.parquet", ".parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", ".arrow"),
+    "csv": ("text/csv", ".csv"),
+}
+
+
+class ExportError(ValueError):
+    """Raised when a batch can't be written with the column types taken from the first batch."""
+
+
+def _exportSettings(batchSize, timeout, maxRows):
+    batchSize = int(os.getenv("EXPORT_BATCH_SIZE", "10000")) if batchSize is None else batchSize
+    timeout = float(os.getenv("EXPORT_TIMEOUT", "300")) if timeout is None else timeout
+    maxRows = int(os.getenv("EXPORT_MAX_ROWS", "0")) if maxRows is None else maxRows
+    return batchSize, timeout, maxRows
+
+
+def exportableQuery(db, sql: str) -> str:
+    """
+    Validate a query from the pipeline again for export, without the LIMIT it got for display.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        sql (str): The SQL query, as generated and guarded by the pipeline.
+
+    Returns:
+        str: The query to export.
+
+    Raises:
+        QueryRejected: If the query is not a single read-only statement or is too expensive.
+    """
+    # The LIMIT the guard added for display must not cap the export
+    return guardQuery(db, stripAddedLimit(sql), limit=0)
+
+
+def _exportType(inferred):
+    import pyarrow as pa
+
+    # Column types come from the first batch; columns that are all NULL in it are exported as text
+    if pa.types.is_null(inferred):
+        return pa.string()
+    if pa.types.is_decimal(inferred):
+        # Later batches may hold larger numbers than the first one
+        return pa.decimal128(38, inferred.scale)
+    return inferred
+
+
+def _toArray(column, type):
+    import pyarrow as pa
+
+    try:
+        return pa.array(column, type=type)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # Text columns take any value, e.g. from a column SQLite stores with mixed types
+        if not pa.types.is_string(type):
+            raise
+        return pa.array([None if value is None else str(value) for value in column], type=type)
+
+
+class _Chunks:
+    """Write-only file object collecting what a pyarrow writer produces for one batch."""
+
+    def __init__(self):
+        self.closed = False
+        self._parts = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def tell(self) -> int:
+        return self._position
+
+    def close(self):
+        # The writer's output is handed over by `take`, never closed by it
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+
+class ResultExport:
+    """
+    The full result of a query, encoded batch by batch when iterated.
+
+    Iterating yields the bytes of the file in pieces, one per fetched batch, which suits both file writes and
+    chunked HTTP responses. Once iteration is done, `rowCount` and `truncated` describe what was exported.
+    """
+
+    def __init__(self, db, sql: str, format: str = "parquet", batchSize: int = None, timeout: float = None,
+                 maxRows: int = None):
+        """
+        Args:
+            db (SQLDatabase): The SQLDatabase object representing the connection.
+            sql (str): The query; see `exportableQuery`.
+            format (str): "parquet", "arrow" (IPC stream) or "csv".
+            batchSize (int): Rows fetched and encoded at a time. Defaults to EXPORT_BATCH_SIZE or 10000.
+            timeout (float): Statement timeout in seconds on MySQL and PostgreSQL. Defaults to EXPORT_TIMEOUT
+                or 300.
+            maxRows (int): Rows exported at most, 0 for all of them. Defaults to EXPORT_MAX_ROWS or 0.
+
+        Raises:
+            QueryRejected: If the query may not run.
+        """
+        if format not in FORMATS:
+            raise ValueError(f"Unknown export format {format!r}, expected one of {', '.join(FORMATS)}")
+        self.db = db
+        self.format = format
+        self.batchSize, self.timeout, self.maxRows = _exportSettings(batchSize, timeout, maxRows)
+        self.sql = exportableQuery(db, sql)
+        self.rowCount = 0
+        self.truncated = False
+
+    @property
+    def contentType(self) -> str:
+        return FORMATS[self.format][0]
+
+    @property
+    def extension(self) -> str:
+        return FORMATS[self.format][1]
+
+    def _batches(self):
+        batches = iterQuery(self.db, self.sql, batchSize=self.batchSize, timeout=self.timeout)
+        yield next(batches)
+        for rows in batches:
+            if self.maxRows and self.rowCount + len(rows) > self.maxRows:
+                rows = rows[:self.maxRows - self.rowCount]
+                self.truncated = True
+            if rows:
+                self.rowCount += len(rows)
+                yield rows
+            if self.truncated:
+                # Closing the generator closes the cursor
+                batches.close()
+                return
+
+    def _csv(self, batches):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(next(batches))
+        yield buffer.getvalue().encode()
+        for rows in batches:
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(rows)
+            yield buffer.getvalue().encode()
+
+    def _openWriter(self, sink, schema):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        return pq.ParquetWriter(sink, schema) if self.format == "parquet" else pa.ipc.new_stream(sink, schema)
+
+    def _arrow(self, batches):
+        # pyarrow is only needed for columnar exports
+        import pyarrow as pa
+
+        columns = next(batches)
+        sink = _Chunks()
+        writer = schema = None
+        for rows in batches:
+            values = list(zip(*rows))
+            if schema is None:
+                schema = pa.schema([pa.field(name, _exportType(pa.array(column).type))
+                                    for name, column in zip(columns, values)])
+                writer = self._openWriter(sink, schema)
+            try:
+                arrays = [_toArray(column, field.type) for field, column in zip(schema, values)]
+            except (pa.ArrowInvalid, pa.ArrowTypeError, OverflowError) as error:
+                raise ExportError(f"A column no longer fits the types of the first {self.batchSize} rows after "
+                                  f"{self.rowCount - len(rows)} rows ({error}); export it as CSV instead.")
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+            yield sink.take()
+        if writer is None:
+            # No rows: the file still carries the column names
+            writer = self._openWriter(sink, pa.schema([pa.field(name, pa.string()) for name in columns]))
+        writer.close()
+        yield sink.take()
+
+    def __iter__(self):
+        self.rowCount = 0
+        self.truncated = False
+        batches = self._batches()
+        if self.format == "csv":
+            encoded = self._csv(batches)
+        else:
+            encoded = self._arrow(batches)
+        for chunk in encoded:
+            if chunk:
+                yield chunk
+        recordValue("rows_exported", self.rowCount)
+
+    def save(self, path: str) -> int:
+        """
+        Write the export to a file.
+
+        Args:
+            path (str): The output file.
+
+        Returns:
+            int: The number of rows written.
+        """
+        with open(path, "wb") as file:
+            for chunk in self:
+                file.write(chunk)
+        return self.rowCount
@@ -0,0 +1,199 @@
+import hashlib
+import os
+import threading
+import time
+import weakref
+from dataclasses import replace
+
+from langchain_community.utilities import SQLDatabase
+from sqlalchemy import text
+
+from summary_tables import isInternalTable, loadSummaries, summaryNotes
+from utils import loadSchemaIndex
+
+# Cheap queries whose result changes whenever tables or columns are added, dropped or altered.
+# They only touch the catalog, so they are far cheaper than reflecting every table.
+FINGERPRINT_QUERIES = {
+    "postgresql": """
+        SELECT count(*), md5(string_agg(table_name || '.' || column_name || ':' || data_type, ','
+                                        ORDER BY table_name, ordinal_position))
+        FROM information_schema.columns
+        WHERE table_schema = current_schema()
+    """,
+    "mysql": """
+        SELECT COUNT(*), COALESCE(SUM(CRC32(CONCAT_WS('.', table_name, column_name, column_type))), 0)
+        FROM information_schema.columns
+        WHERE table_schema = DATABASE()
+    """,
+    "sqlite": "PRAGMA schema_version",
+}
+
+
+class SchemaCache:
+    """
+    Snapshot of the schema information shared by every prompt stage of a connection.
+
+    Tables are described in the compact `table(col:type,...)` format of `utils.SchemaIndex`, or with
+    `SQLDatabase.get_table_info()` (CREATE TABLE plus sample rows) when SCHEMA_FORMAT is "ddl". Every table of
+    the default schema is described but the internal ones of `summary_tables`; summary tables and the tables
+    they summarize carry a note saying so. The snapshot is rebuilt when the catalog fingerprint changes or
+    when it is older than the TTL. The fingerprint itself is only re-checked every `checkInterval` seconds.
+    """
+
+    def __init__(self, db, ttl: float = 600.0, checkInterval: float = 30.0):
+        """
+        Args:
+            db (SQLDatabase): The SQLDatabase object representing the connection.
+            ttl (float): Maximum age of a snapshot in seconds.
+            checkInterval (float): Minimum number of seconds between two fingerprint queries.
+        """
+        self.db = db
+        # SQLDatabase has no public accessor for its engine
+        self.engine = db._engine
+        self.ttl = ttl
+        self.checkInterval = checkInterval
+        self.fingerprint = None
+        self.version = 0
+        self.index = None
+        self.summaries = {}
+        self._tableInfo = None
+        self._separator = "\n"
+        self._builtAt = 0.0
+        self._checkedAt = 0.0
+        self._lock = threading.Lock()
+
+    def computeFingerprint(self) -> str:
+        """
+        Run the catalog fingerprint query for the connection's dialect.
+
+        Returns:
+            str: A short hash identifying the current schema, or None if the dialect is unsupported.
+        """
+        query = FINGERPRINT_QUERIES.get(self.db.dialect)
+        if query is None:
+            return None
+        with self.engine.connect() as connection:
+            row = connection.execute(text(query)).fetchone()
+        return hashlib.sha1(repr(tuple(row)).encode()).hexdigest()[:16]
+
+    def refresh(self) -> str:
+        """
+        Rebuild the snapshot unconditionally.
+
+        Returns:
+            str: The schema information.
+        """
+        with self._lock:
+            return self._rebuild()
+
+    def _rebuild(self) -> str:
+        now = time.monotonic()
+        self.fingerprint = self.computeFingerprint()
+        # Loaded from SCHEMA_INDEX_DIR when the fingerprint is unchanged, which skips introspection at startup
+        self.index = loadSchemaIndex(self.engine, self.fingerprint)
+        self.summaries = loadSummaries(self.db, self.index)
+        notes = summaryNotes(self.summaries)
+        # One entry per table, so that prompts can carry only the tables relevant to a question
+        table_names = [name for name in self.index.tables if not isInternalTable(name)]
+        if os.getenv("SCHEMA_FORMAT", "compact").lower() == "ddl":
+            # A new SQLDatabase per snapshot: one reflects its tables once and never sees them change
+            reflected = SQLDatabase(self.engine, include_tables=table_names, lazy_table_reflection=True)
+            self._separator = "\n\n"
+            self._tableInfo = {name: reflected.get_table_info([name]) for name in table_names}
+            for name, note in notes.items():
+                if name in self._tableInfo:
+                    self._tableInfo[name] += f"\n/* {note} */"
+        else:
+            self._separator = "\n"
+            self._tableInfo = {}
+            for name in table_names:
+                table = self.index.tables[name]
+                if name in notes:
+                    # Only in the prompt: the index keeps the comment from the catalog
+                    table = replace(table, comment="; ".join(filter(None, [table.comment, notes[name]])))
+                self._tableInfo[name] = table.serialize()
+        self.version += 1
+        self._builtAt = now
+        self._checkedAt = now
+        return self._join(None)
+
+    def _join(self, tableNames) -> str:
+        if tableNames is None:
+            tableNames = self._tableInfo
+        return self._separator.join(self._tableInfo[name] for name in tableNames if name in self._tableInfo)
+
+    def _ensureFresh(self):
+        now = time.monotonic()
+        if self._tableInfo is None or now - self._builtAt > self.ttl:
+            self._rebuild()
+        elif now - self._checkedAt > self.checkInterval:
+            self._checkedAt = now
+            if self.computeFingerprint() != self.fingerprint:
+                self._rebuild()
+
+    def getTableInfo(self, tableNames: list = None) -> str:
+        """
+        Return the cached schema information, rebuilding it if it is stale.
+
+        Args:
+            tableNames (list): Optional subset of tables to include. Defaults to every usable table.
+
+        Returns:
+            str: The schema information.
+        """
+        with self._lock:
+            self._ensureFresh()
+            return self._join(tableNames)
+
+    def getTableNames(self) -> list:
+        """
+        Returns:
+            list: The names of the usable tables in the current snapshot.
+        """
+        with self._lock:
+            self._ensureFresh()
+            return list(self._tableInfo)
+
+    def getIndex(self):
+        """
+        Returns:
+            SchemaIndex: The columns, keys and row estimates of every table in the current snapshot.
+        """
+        with self._lock:
+            self._ensureFresh()
+            return self.index
+
+    def getSummaries(self) -> dict:
+        """
+        Returns:
+            dict: The summary tables of the current snapshot by name, see `summary_tables.loadSummaries`.
+        """
+        with self._lock:
+            self._ensureFresh()
+            return self.summaries
+
+    def invalidate(self):
+        """Drop the snapshot so that the next read rebuilds it."""
+        with self._lock:
+            self._tableInfo = None
+
+
+_caches = weakref.WeakKeyDictionary()
+_cachesLock = threading.Lock()
+
+
+def getSchemaCache(db) -> SchemaCache:
+    """
+    Return the schema cache of a connection, creating it on first use.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+
+    Returns:
+        SchemaCache: The cache shared by every prompt stage of this connection.
+    """
+    with _cachesLock:
+        cache = _caches.get(db)
+        if cache is None:
+            cache = _caches[db] = SchemaCache(db)
+        return cache
@@ -0,0 +1,377 @@
+import asyncio
+import hashlib
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict
+from functools import lru_cache
+
+from langchain_core.runnables import RunnableLambda
+
+from chat_history import formatMessage, priorMessages
+from metrics import recordValue
+from schema_cache import getSchemaCache
+
+# Words by which a question refers back to the conversation, e.g. "and what about those in 2023?"
+_FOLLOW_UP = re.compile(r"^(?:and|but|or|then|now|what about|how about)\b|\b(?:it|its|they|them|their|those|these|that"
+                        r"|this|he|him|his|she|her|same|above|previous|instead|also|too|again|else|ones)\b")
+# Recency of cache hits is written to the file in batches of this many
+USED_FLUSH_EVERY = 100
+
+
+def normalizeQuestion(question: str) -> str:
+    """
+    Normalize a question so that trivially different phrasings share a cache key.
+
+    Args:
+        question (str): The user's natural language question.
+
+    Returns:
+        str: The lower-cased question without punctuation and with collapsed whitespace.
+    """
+    question = re.sub(r"[^\w\s]", " ", question.lower())
+    return " ".join(question.split())
+
+
+def isFollowUp(question: str) -> bool:
+    """
+    Tell whether a question may depend on the preceding messages, e.g. "and for them?".
+
+    Args:
+        question (str): The normalized question.
+
+    Returns:
+        bool: Whether it refers back to the conversation.
+    """
+    return _FOLLOW_UP.search(question) is not None
+
+
+def historyDigest(chatHistory: list, messages: int = 4) -> str:
+    """
+    Hash the tail of the conversation that can change the meaning of a follow-up question.
+
+    Args:
+        chatHistory (list): The history of the chat interaction.
+        messages (int): Number of trailing messages taken into account.
+
+    Returns:
+        str: A short digest of the relevant chat history.
+    """
+    tail = "\n".join(formatMessage(message) for message in (chatHistory or [])[-messages:])
+    return hashlib.sha1(tail.encode()).hexdigest()[:16]
+
+
+def _trigrams(text: str) -> Counter:
+    padded = f"  {text} "
+    return Counter(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def _cosine(a: Counter, b: Counter) -> float:
+    dot = sum(count * b[gram] for gram, count in a.items() if gram in b)
+    norm = math.sqrt(sum(v * v for v in a.values())) * math.sqrt(sum(v * v for v in b.values()))
+    return dot / norm if norm else 0.0
+
+
+class SqlCache:
+    """
+    LRU/TTL cache of generated SQL keyed on normalized question, schema fingerprint and, for follow-up
+    questions, history digest.
+
+    Entries are optionally written through to a SQLite file so that a warm cache survives restarts. Hits only
+    update the recency in memory; it reaches the file every `USED_FLUSH_EVERY` hits and with the next write.
+    With `similarity` set, a question that misses exactly can still hit an entry of the same scope
+    whose character-trigram cosine similarity is above the threshold.
+    """
+
+    def __init__(self, maxSize: int = 1000, ttl: float = 86400.0, path: str = None, similarity: float = None):
+        """
+        Args:
+            maxSize (int): Maximum number of entries kept.
+            ttl (float): Number of seconds after which an entry expires.
+            path (str): Optional SQLite file used as a persistent backend.
+            similarity (float): Optional cosine similarity threshold for fuzzy matching, between 0 and 1.
+        """
+        self.maxSize = maxSize
+        self.ttl = ttl
+        self.similarity = similarity
+        self.hits = 0
+        self.fuzzyHits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._used = {}
+        self._lock = threading.Lock()
+        self._disk = None
+        if path:
+            self._disk = sqlite3.connect(path, check_same_thread=False)
+            self._disk.execute("""
+                CREATE TABLE IF NOT EXISTS sql_cache (
+                    key TEXT PRIMARY KEY, scope TEXT, question TEXT, sql TEXT, created REAL, used REAL
+                )
+            """)
+            self._disk.commit()
+            self._load()
+
+    @staticmethod
+    def makeKey(scope: str, question: str) -> str:
+        return hashlib.sha1(f"{scope}\n{question}".encode()).hexdigest()
+
+    def _load(self):
+        cutoff = time.time() - self.ttl
+        self._disk.execute("DELETE FROM sql_cache WHERE created < ?", (cutoff,))
+        rows = self._disk.execute(
+            "SELECT key, scope, question, sql, created FROM sql_cache ORDER BY used DESC LIMIT ?", (self.maxSize,)
+        ).fetchall()
+        for key, scope, question, sql, created in reversed(rows):
+            self._entries[key] = (scope, question, sql, created, _trigrams(question))
+        self._disk.commit()
+
+    def get(self, scope: str, question: str):
+        """
+        Look up the SQL generated for a question.
+
+        Args:
+            scope (str): The cache scope, see `cacheScope`.
+            question (str): The normalized question.
+
+        Returns:
+            str: The cached SQL query, or None on a miss.
+        """
+        key = self.makeKey(scope, question)
+        with self._lock:
+            now = time.time()
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[3] > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None and self.similarity:
+                key, entry = self._nearest(scope, question)
+                if entry is not None:
+                    self.fuzzyHits += 1
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            if self._disk is not None:
+                self._used[key] = now
+                if len(self._used) >= USED_FLUSH_EVERY:
+                    self._flushUsed()
+                    self._disk.commit()
+            return entry[2]
+
+    def _flushUsed(self):
+        self._disk.executemany("UPDATE sql_cache SET used = ? WHERE key = ?",
+                               [(used, key) for key, used in self._used.items()])
+        self._used.clear()
+
+    def _nearest(self, scope: str, question: str):
+        grams = _trigrams(question)
+        best_key, best_entry, best_score = None, None, self.similarity
+        now = time.time()
+        for key, entry in self._entries.items():
+            if entry[0] != scope or now - entry[3] > self.ttl:
+                continue
+            score = _cosine(grams, entry[4])
+            if score >= best_score:
+                best_key, best_entry, best_score = key, entry, score
+        return best_key, best_entry
+
+    def put(self, scope: str, question: str, sql: str):
+        """
+        Store the SQL generated for a question.
+
+        Args:
+            scope (str): The cache scope, see `cacheScope`.
+            question (str): The normalized question.
+            sql (str): The generated SQL query.
+        """
+        key = self.makeKey(scope, question)
+        with self._lock:
+            now = time.time()
+            self._entries[key] = (scope, question, sql, now, _trigrams(question))
+            self._entries.move_to_end(key)
+            if self._disk is not None:
+                self._disk.execute("INSERT OR REPLACE INTO sql_cache VALUES (?, ?, ?, ?, ?, ?)",
+                                   (key, scope, question, sql, now, now))
+            while len(self._entries) > self.maxSize:
+                self._remove(next(iter(self._entries)))
+            if self._disk is not None:
+                self._flushUsed()
+                self._disk.commit()
+
+    def _remove(self, key: str):
+        self._entries.pop(key, None)
+        self._used.pop(key, None)
+        if self._disk is not None:
+            self._disk.execute("DELETE FROM sql_cache WHERE key = ?", (key,))
+
+    def discard(self, scope: str, sql: str):
+        """
+        Drop the entries of a scope that hold a query, e.g. because it failed to run.
+
+        Args:
+            scope (str): The cache scope, see `cacheScope`.
+            sql (str): The SQL query. Fuzzy hits can serve it for several questions, so all of them are dropped.
+        """
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry[0] == scope and entry[2] == sql]:
+                self._remove(key)
+            if self._disk is not None:
+                self._disk.commit()
+
+    def clear(self):
+        """Drop every entry, including the persisted ones."""
+        with self._lock:
+            self._entries.clear()
+            self._used.clear()
+            if self._disk is not None:
+                self._disk.execute("DELETE FROM sql_cache")
+                self._disk.commit()
+
+    def stats(self) -> dict:
+        """
+        Returns:
+            dict: Hit, fuzzy hit and miss counters and the current number of entries.
+        """
+        return {"hits": self.hits, "fuzzy_hits": self.fuzzyHits, "misses": self.misses, "size": len(self._entries)}
+
+
+@lru_cache(maxsize=None)
+def getSqlCache() -> SqlCache:
+    """
+    Return the process-wide SQL cache, configured from the environment (.env).
+
+    SQL_CACHE_SIZE, SQL_CACHE_TTL, SQL_CACHE_PATH (SQLite file) and SQL_CACHE_SIMILARITY are honoured.
+
+    Returns:
+        SqlCache: The shared cache.
+    """
+    similarity = os.getenv("SQL_CACHE_SIMILARITY")
+    return SqlCache(maxSize=int(os.getenv("SQL_CACHE_SIZE", "1000")),
+                    ttl=float(os.getenv("SQL_CACHE_TTL", "86400")),
+                    path=os.getenv("SQL_CACHE_PATH") or None,
+                    similarity=float(similarity) if similarity else None)
+
+
+# Queries generated or served by a cache whose execution hasn't finished yet, by database and SQL text
+_pending = OrderedDict()
+_pendingLock = threading.Lock()
+PENDING_SIZE = 1024
+
+
+def _pendingKey(db, sql: str) -> tuple:
+    return db._engine.url.render_as_string(hide_password=True), sql
+
+
+def expectExecution(db, sql: str, cache: SqlCache, scope: str, question: str, cached: bool):
+    """
+    Remember where a query came from until `settleExecution` reports whether it ran.
+
+    A freshly generated query is only cached once it ran, so that a failing one is regenerated by the next
+    turn instead of being served for the whole TTL; a cached one is dropped if it fails.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        sql (str): The SQL query.
+        cache (SqlCache): The cache it was looked up in.
+        scope (str): The cache scope, see `cacheScope`.
+        question (str): The normalized question.
+        cached (bool): Whether it was served by the cache rather than generated.
+    """
+    key = _pendingKey(db, sql)
+    with _pendingLock:
+        _pending.setdefault(key, []).append((cache, scope, question, cached))
+        _pending.move_to_end(key)
+        # Queries that are never executed (e.g. only translated) must not pile up
+        while len(_pending) > PENDING_SIZE:
+            _pending.popitem(last=False)
+
+
+def settleExecution(db, sql: str, succeeded: bool):
+    """
+    Cache the generated query once it ran, or drop a cached one that failed.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        sql (str): The SQL query that was executed.
+        succeeded (bool): Whether it ran without an error.
+    """
+    with _pendingLock:
+        sources = _pending.pop(_pendingKey(db, sql), ())
+    for cache, scope, question, cached in sources:
+        if succeeded and not cached:
+            cache.put(scope, question, sql)
+        elif not succeeded and cached:
+            cache.discard(scope, sql)
+            recordValue("sql_cache_discards")
+
+
+def cacheScope(db, question: str, chatHistory: list) -> str:
+    """
+    Build the part of the cache key that identifies the database, its schema and, for follow-up questions,
+    the conversation.
+
+    A self-contained question means the same whatever was said before, so it shares its entry across sessions
+    and with the API.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        question (str): The user's natural language question.
+        chatHistory (list): The history of the chat interaction.
+
+    Returns:
+        str: The cache scope.
+    """
+    schema_cache = getSchemaCache(db)
+    # Make sure the fingerprint is current before it becomes part of the key
+    schema_cache.getTableInfo()
+    database = db._engine.url.render_as_string(hide_password=True)
+    if not isFollowUp(normalizeQuestion(question)):
+        return f"{database}|{schema_cache.fingerprint}"
+    # The current question is already part of the key, only the preceding messages go into the digest
+    history = priorMessages(chatHistory, question)
+    return f"{database}|{schema_cache.fingerprint}|{historyDigest(history)}"
+
+
+def withSqlCache(db, sqlChain, cache: SqlCache):
+    """
+    Put a cache in front of the SQL-generation chain.
+
+    Generated queries are cached once `settleExecution` reports that they ran (see `chain_factory.runQuery`).
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        sqlChain (RunnableSerializable): The chain that generates the SQL query.
+        cache (SqlCache): The cache to read from and write to.
+
+    Returns:
+        RunnableLambda: A runnable with the same input and output as `sqlChain`.
+    """
+    def lookup(variables: dict) -> tuple:
+        scope = cacheScope(db, variables["question"], variables.get("chat_history"))
+        question = normalizeQuestion(variables["question"])
+        sql = cache.get(scope, question)
+        recordValue("sql_cache_hits" if sql is not None else "sql_cache_misses")
+        return scope, question, sql
+
+    def generateSql(variables: dict, config) -> str:
+        scope, question, sql = lookup(variables)
+        cached = sql is not None
+        if not cached:
+            sql = sqlChain.invoke(variables, config)
+        expectExecution(db, sql, cache, scope, question, cached)
+        return sql
+
+    async def agenerateSql(variables: dict, config) -> str:
+        # The scope reads the schema fingerprint and the cache may be a SQLite file
+        scope, question, sql = await asyncio.to_thread(lookup, variables)
+        cached = sql is not None
+        if not cached:
+            sql = await sqlChain.ainvoke(variables, config)
+        expectExecution(db, sql, cache, scope, question, cached)
+        return sql
+
+    return RunnableLambda(generateSql, afunc=agenerateSql)
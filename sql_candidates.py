@@ -0,0 +1,207 @@
+"""
+Speculative SQL generation: several candidate queries are requested at once and validated as they arrive.
+
+Each candidate is dry-run by `sql_guard.guardQuery`, whose EXPLAIN plans the query on the connection pool
+without running it. In "first" mode the first valid candidate wins; in "majority" mode the candidates are
+grouped by their canonical SQL and the largest group wins, as soon as it can no longer be outvoted.
+Candidates still running are cancelled once a winner is chosen.
+"""
+import asyncio
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, wait
+from functools import lru_cache
+
+from langchain_core.runnables.config import ContextThreadPoolExecutor
+
+from metrics import recordValue
+from result_cache import canonicalizeSql
+from sql_guard import QueryRejected, guardQuery
+
+MODES = ("first", "majority")
+
+
+class CandidatesRejected(QueryRejected):
+    """
+    Raised when no candidate was valid and at least one was rejected. `query` is the last rejected candidate,
+    for the retry prompt.
+    """
+
+    def __init__(self, message: str, query: str):
+        super().__init__(message)
+        self.query = query
+
+
+def candidateSettings(count: int = None, mode: str = None) -> tuple:
+    """
+    Returns:
+        tuple: The number of candidates, from SQL_CANDIDATES or 1 (speculation off), and the selection mode,
+            from SQL_CANDIDATE_MODE or "first".
+    """
+    count = int(os.getenv("SQL_CANDIDATES", "1")) if count is None else count
+    mode = os.getenv("SQL_CANDIDATE_MODE", "first") if mode is None else mode
+    if mode not in MODES:
+        raise ValueError(f"Unknown candidate selection mode {mode!r}, expected one of {', '.join(MODES)}")
+    return count, mode
+
+
+@lru_cache(maxsize=None)
+def _executor() -> ContextThreadPoolExecutor:
+    # Shared by all sessions; the context is copied so that the current turn's metrics are recorded
+    return ContextThreadPoolExecutor(max_workers=int(os.getenv("SQL_CANDIDATE_WORKERS", "16")),
+                                     thread_name_prefix="sql-candidate")
+
+
+class _Ballot:
+    """Collects validated candidates and decides when one has won."""
+
+    def __init__(self, count: int, mode: str):
+        self.count = count
+        self.mode = mode
+        self.pending = count
+        self.votes = {}
+        self.error = None
+        self.failure = None
+        self._lock = threading.Lock()
+
+    def add(self, query: str = None, error: Exception = None) -> str:
+        """
+        Args:
+            query (str): A validated candidate.
+            error (Exception): Why there is none: QueryRejected, or the error of the LLM call.
+
+        Returns:
+            str: The winning query, or None while the outcome is still open.
+        """
+        with self._lock:
+            self.pending -= 1
+            if isinstance(error, QueryRejected):
+                recordValue("sql_candidates_rejected")
+                self.error = error
+            elif error is not None:
+                # e.g. a rate limit on one call: the other candidates can still win
+                recordValue("sql_candidates_failed")
+                self.failure = error
+            else:
+                self.votes.setdefault(canonicalizeSql(query), []).append(query)
+            if not self.votes:
+                return None
+            leader = max(self.votes.values(), key=len)
+            if self.mode == "first":
+                return leader[0]
+            runner_up = max((len(queries) for queries in self.votes.values() if queries is not leader), default=0)
+            # The leader wins once the pending candidates can no longer outvote it
+            if len(leader) > runner_up + self.pending or not self.pending:
+                return leader[0]
+            return None
+
+    def lost(self, query: str) -> Exception:
+        """
+        Returns:
+            Exception: What to raise when no candidate won: CandidatesRejected if a candidate was rejected,
+                else the error of the last failed LLM call.
+        """
+        if query is None:
+            return self.failure
+        return CandidatesRejected(str(self.error), query)
+
+
+def speculativeQuery(db, generate, count: int = None, mode: str = None) -> str:
+    """
+    Generate candidate queries concurrently in worker threads and return the winning valid one.
+
+    Candidates that haven't started yet are cancelled once there is a winner; running LLM calls can't be
+    interrupted from another thread, so their results are dropped.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        generate: Called without arguments in a worker thread; returns one candidate query.
+        count (int): Number of candidates. Defaults to SQL_CANDIDATES.
+        mode (str): "first" or "majority". Defaults to SQL_CANDIDATE_MODE.
+
+    Returns:
+        str: The validated query.
+
+    Raises:
+        CandidatesRejected: If no candidate was valid and at least one was rejected.
+        Exception: The error of the last LLM call, if every call failed.
+    """
+    count, mode = candidateSettings(count, mode)
+    ballot = _Ballot(count, mode)
+    recordValue("sql_candidates", count)
+
+    def candidate():
+        try:
+            query = generate()
+        except Exception as error:
+            return None, None, error
+        try:
+            return query, guardQuery(db, query), None
+        except QueryRejected as error:
+            return query, None, error
+
+    futures = {_executor().submit(candidate) for _ in range(count)}
+    last_query = None
+    try:
+        while futures:
+            done, futures = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                query, valid, error = future.result()
+                winner = ballot.add(valid, error)
+                if winner is not None:
+                    return winner
+                last_query = query or last_query
+        raise ballot.lost(last_query)
+    finally:
+        for future in futures:
+            if not future.cancel():
+                recordValue("sql_candidates_discarded")
+
+
+async def aspeculativeQuery(db, agenerate, count: int = None, mode: str = None) -> str:
+    """
+    Async counterpart of `speculativeQuery`: candidates still generating are cancelled once there is a winner.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        agenerate: Coroutine function called without arguments; returns one candidate query.
+        count (int): Number of candidates. Defaults to SQL_CANDIDATES.
+        mode (str): "first" or "majority". Defaults to SQL_CANDIDATE_MODE.
+
+    Returns:
+        str: The validated query.
+
+    Raises:
+        CandidatesRejected: If no candidate was valid and at least one was rejected.
+        Exception: The error of the last LLM call, if every call failed.
+    """
+    count, mode = candidateSettings(count, mode)
+    ballot = _Ballot(count, mode)
+    recordValue("sql_candidates", count)
+
+    async def candidate():
+        try:
+            query = await agenerate()
+        except Exception as error:
+            return None, None, error
+        try:
+            return query, await asyncio.to_thread(guardQuery, db, query), None
+        except QueryRejected as error:
+            return query, None, error
+
+    tasks = {asyncio.ensure_future(candidate()) for _ in range(count)}
+    last_query = None
+    try:
+        while tasks:
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                query, valid, error = task.result()
+                winner = ballot.add(valid, error)
+                if winner is not None:
+                    return winner
+                last_query = query or last_query
+        raise ballot.lost(last_query)
+    finally:
+        for task in tasks:
+            task.cancel()
+            recordValue("sql_candidates_discarded")
@@ -0,0 +1,206 @@
+"""
+Pre-execution checks for generated SQL: a single read-only statement, a row LIMIT, and an EXPLAIN-based cost ceiling.
+"""
+import json
+import os
+import re
+
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+
+from metrics import recordValue, timed
+from result_cache import isReadOnly, stripComments
+
+# Keywords that only appear in statements which write, change the schema or take locks.
+# REPLACE is left out because it is also a string function.
+FORBIDDEN_KEYWORDS = {"insert", "update", "delete", "merge", "drop", "alter", "create", "truncate", "grant",
+                      "revoke", "attach", "detach", "pragma", "vacuum", "copy", "into", "call", "exec", "execute"}
+
+SQLGLOT_DIALECTS = {"postgresql": "postgres", "mysql": "mysql", "sqlite": "sqlite"}
+SQLGLOT_WRITE_EXPRESSIONS = ("Insert", "Update", "Delete", "Merge", "Drop", "Create", "Alter", "AlterTable",
+                             "TruncateTable", "Command", "Into", "Lock")
+
+_FENCE = re.compile(r"^```(?:sql)?\s*|\s*```$", re.IGNORECASE)
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\"[^\"]*\"|`[^`]*`")
+_TRAILING_LIMIT = re.compile(r"\b(?:limit\s+\d+(?:\s*(?:,|offset)\s*\d+)?|fetch\s+(?:first|next)\b.*)$",
+                             re.IGNORECASE)
+
+
+class QueryRejected(ValueError):
+    """Raised when a generated query is not allowed to run. The message is meant to be fed back to the LLM."""
+
+
+def cleanSql(sql: str) -> str:
+    """
+    Returns:
+        str: The query without the Markdown code fence LLMs sometimes wrap it in.
+    """
+    return _FENCE.sub("", sql.strip()).strip()
+
+
+def _guardSettings(maxCost, maxRows, limit):
+    maxCost = float(os.getenv("SQL_GUARD_MAX_COST", "10000000")) if maxCost is None else maxCost
+    maxRows = float(os.getenv("SQL_GUARD_MAX_ROWS", "100000000")) if maxRows is None else maxRows
+    if limit is None and os.getenv("SQL_GUARD_LIMIT", "true").lower() in ("1", "true", "yes"):
+        # One row more than the query runner keeps, so that truncation is still detected
+        limit = int(os.getenv("QUERY_MAX_ROWS", "1000")) + 1
+    return maxCost, maxRows, limit
+
+
+def stripAddedLimit(sql: str) -> str:
+    """
+    Remove the LIMIT `guardQuery` adds to queries without one, to keep or re-run a query as the LLM wrote it.
+
+    Args:
+        sql (str): A query returned by `guardQuery`.
+
+    Returns:
+        str: The query without a trailing LIMIT of QUERY_MAX_ROWS + 1.
+    """
+    limit = _guardSettings(None, None, None)[2]
+    if not limit:
+        return sql
+    return re.sub(rf"\s+LIMIT\s+{limit}\s*$", "", sql.strip(), flags=re.IGNORECASE)
+
+
+def _checkWithSqlglot(sql: str, dialect: str, limit: int):
+    try:
+        import sqlglot
+        from sqlglot import expressions
+    except ImportError:
+        return None
+
+    try:
+        statements = [statement for statement in sqlglot.parse(sql, read=SQLGLOT_DIALECTS.get(dialect))
+                      if statement is not None]
+    except sqlglot.errors.ParseError as error:
+        raise QueryRejected(f"The query does not parse: {error}")
+    if len(statements) != 1:
+        raise QueryRejected("Only a single SQL statement is allowed.")
+    statement = statements[0]
+    queries = getattr(expressions, "Query", None) or (expressions.Select, expressions.Union)
+    writes = tuple(getattr(expressions, name) for name in SQLGLOT_WRITE_EXPRESSIONS if hasattr(expressions, name))
+    if not isinstance(statement, queries) or statement.find(*writes) is not None:
+        raise QueryRejected("Only read-only SELECT queries are allowed.")
+    if limit and statement.args.get("limit") is None and statement.args.get("fetch") is None:
+        statement = statement.limit(limit)
+    return statement.sql(dialect=SQLGLOT_DIALECTS.get(dialect))
+
+
+def _checkWithTokens(sql: str, limit: int) -> str:
+    # The checks run on a copy with comments and the text of literals blanked out, of the same length, so
+    # that the query itself is returned unchanged but for trailing semicolons and the LIMIT
+    code = _LITERALS.sub(lambda match: match.group()[0] + " " * (len(match.group()) - 2) + match.group()[-1],
+                         stripComments(sql))
+    end = re.search(r"[\s;]*$", code).start()
+    sql, code = sql[:end], code[:end]
+    if ";" in code:
+        raise QueryRejected("Only a single SQL statement is allowed.")
+    if not isReadOnly(code) or FORBIDDEN_KEYWORDS & set(re.findall(r"[a-z_]+", code.lower())):
+        raise QueryRejected("Only read-only SELECT queries are allowed.")
+    if limit and not _TRAILING_LIMIT.search(code):
+        sql = f"{sql} LIMIT {limit}"
+    return sql
+
+
+def checkStatement(sql: str, dialect: str, limit: int = None) -> str:
+    """
+    Make sure a query is a single read-only statement and give it a LIMIT if it has none.
+
+    sqlglot is used when it is installed; otherwise a token-level check is applied.
+
+    Args:
+        sql (str): The generated SQL query.
+        dialect (str): The SQLAlchemy dialect name, e.g. "postgresql".
+        limit (int): The LIMIT added to queries without one, or None to leave them unchanged.
+
+    Returns:
+        str: The query to run.
+
+    Raises:
+        QueryRejected: If the query is not a single read-only statement.
+    """
+    sql = cleanSql(sql)
+    if not sql:
+        raise QueryRejected("The query is empty.")
+    checked = _checkWithSqlglot(sql, dialect, limit)
+    return checked if checked is not None else _checkWithTokens(sql, limit)
+
+
+def explainEstimate(db, sql: str) -> dict:
+    """
+    Ask the database for the planner's estimate of a query, without running it.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        sql (str): The SQL query.
+
+    Returns:
+        dict: "cost" (PostgreSQL total cost), "rows" (MySQL rows examined) and "fullScans" (SQLite: the largest
+            number of full table scans nested in the same loop); estimates a dialect doesn't provide are None.
+
+    Raises:
+        QueryRejected: If the database cannot plan the query, e.g. because of an unknown column.
+    """
+    estimate = {"cost": None, "rows": None, "fullScans": None}
+    try:
+        with db._engine.connect() as connection:
+            if db.dialect == "postgresql":
+                plan = connection.execute(text(f"EXPLAIN (FORMAT JSON) {sql}")).scalar()
+                root = (json.loads(plan) if isinstance(plan, str) else plan)[0]["Plan"]
+                estimate["cost"] = float(root["Total Cost"])
+            elif db.dialect == "mysql":
+                # Tables with the same select id are joined, so their row estimates multiply
+                products = {}
+                for row in connection.execute(text(f"EXPLAIN {sql}")).mappings():
+                    rows = float(row.get("rows") or 1) * float(row.get("filtered") or 100) / 100
+                    products[row["id"]] = products.get(row["id"], 1.0) * max(rows, 1.0)
+                estimate["rows"] = sum(products.values())
+            elif db.dialect == "sqlite":
+                scans = {}
+                for _, parent, _, detail in connection.execute(text(f"EXPLAIN QUERY PLAN {sql}")):
+                    if detail.startswith("SCAN ") and not detail.startswith("SCAN CONSTANT"):
+                        scans[parent] = scans.get(parent, 0) + 1
+                estimate["fullScans"] = max(scans.values(), default=0)
+    except SQLAlchemyError as error:
+        raise QueryRejected(f"The database cannot plan the query: {getattr(error, 'orig', None) or error}")
+    return estimate
+
+
+def guardQuery(db, sql: str, maxCost: float = None, maxRows: float = None, limit: int = None) -> str:
+    """
+    Validate a generated query before it runs and refuse the ones the planner expects to be expensive.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        sql (str): The generated SQL query.
+        maxCost (float): Highest PostgreSQL plan cost allowed. Defaults to SQL_GUARD_MAX_COST or 1e7.
+        maxRows (float): Highest number of rows MySQL may examine. Defaults to SQL_GUARD_MAX_ROWS or 1e8.
+        limit (int): LIMIT added to queries without one. Defaults to QUERY_MAX_ROWS + 1,
+            unless SQL_GUARD_LIMIT is false.
+
+    Returns:
+        str: The query to run, with the LIMIT added if needed.
+
+    Raises:
+        QueryRejected: With a reason the LLM can act on.
+    """
+    maxCost, maxRows, limit = _guardSettings(maxCost, maxRows, limit)
+    with timed("sql_guard"):
+        try:
+            sql = checkStatement(sql, db.dialect, limit)
+            if os.getenv("SQL_GUARD_EXPLAIN", "true").lower() in ("1", "true", "yes"):
+                estimate = explainEstimate(db, sql)
+                if estimate["cost"] is not None and estimate["cost"] > maxCost:
+                    raise QueryRejected(f"The estimated cost {estimate['cost']:.0f} exceeds the limit of {maxCost:.0f}."
+                                        " Add filters or join conditions.")
+                if estimate["rows"] is not None and estimate["rows"] > maxRows:
+                    raise QueryRejected(f"The query would examine about {estimate['rows']:.0f} rows, more than the "
+                                        f"limit of {maxRows:.0f}. Add filters or join conditions.")
+                if estimate["fullScans"] and estimate["fullScans"] > 1:
+                    raise QueryRejected("The query joins full table scans without a join condition "
+                                        "(a cartesian product). Add join conditions.")
+        except QueryRejected:
+            recordValue("sql_guard_rejections")
+            raise
+    return sql
@@ -0,0 +1,554 @@
+"""
+Summary tables for the GROUP BY queries users keep asking, mined from `query_log`.
+
+A logged query qualifies when it is a single SELECT ... FROM ... [WHERE ...] GROUP BY ... whose aggregates can
+be re-aggregated (COUNT, SUM, MIN, MAX, and AVG kept as a sum and a count). Queries with the same FROM clause,
+WHERE clause and grouping keys form a pattern; patterns run often enough and slowly enough are suggested.
+
+Summary tables are only created on request, then refreshed on a schedule, e.g. from cron or with --every.
+The commands that mine the log run in a process of their own, so they need QUERY_LOG_PATH, the file the app
+and the API write the log to:
+
+    python summary_tables.py suggest
+    python summary_tables.py refresh --create --every 3600
+    python summary_tables.py drop summary_orders_by_month
+
+They are listed in the REGISTRY_TABLE table of the database itself, so that every process sees the same
+ones, and `schema_cache` describes them in the prompt with what they pre-aggregate and when they were built.
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import statistics
+import time
+from dataclasses import asdict, dataclass, field
+
+from sqlalchemy import Column, Float, Integer, MetaData, String, Table, Text, delete, inspect, insert, select, text
+
+from query_log import getQueryLog, queryScope
+from result_cache import canonicalizeSql, extractTables
+
+REGISTRY_TABLE = "askdb_summaries"
+SUMMARY_PREFIX = "summary_"
+STAGING_SUFFIX = "__staging"
+
+_REGISTRY = Table(
+    REGISTRY_TABLE, MetaData(),
+    Column("name", String(128), primary_key=True),
+    Column("base_table", String(128)),
+    Column("definition", Text),
+    Column("refreshed_at", Float),
+    Column("row_count", Integer),
+)
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\"[^\"]*\"|`[^`]*`")
+_CLAUSES = re.compile(r"\b(select|from|where|group\s+by|having|order\s+by|limit|offset|fetch|union|intersect|except"
+                      r"|window|into)\b", re.IGNORECASE)
+_CALLS = re.compile(r"\b(count|sum|avg|min|max)\s*\(", re.IGNORECASE)
+_ALIAS = re.compile(r"\s+(as\s+)?([\w$]+|\"_*\"|`_*`)\s*$", re.IGNORECASE)
+_KEYWORDS = {"end", "null", "true", "false", "and", "or", "not", "then", "else", "distinct", "asc", "desc", "is",
+             "in", "like", "between", "case", "when"}
+
+
+def _mask(sql: str, parentheses: bool = True) -> str:
+    # Same length as `sql`, with string literals and (optionally) everything inside parentheses blanked out,
+    # so that keywords and commas found in the mask are at the top level of the original
+    masked = _LITERALS.sub(lambda match: match.group(0)[0] + "_" * (len(match.group(0)) - 2) + match.group(0)[-1],
+                           sql)
+    if not parentheses:
+        return masked
+    characters, depth = [], 0
+    for character in masked:
+        if character == ")":
+            depth -= 1
+        characters.append(character if depth <= 0 else "_")
+        if character == "(":
+            depth += 1
+    return "".join(characters)
+
+
+def _split(sql: str) -> list:
+    items, start = [], 0
+    for match in re.finditer(",", _mask(sql)):
+        items.append(sql[start:match.start()].strip())
+        start = match.end()
+    items.append(sql[start:].strip())
+    return items
+
+
+def _clauses(sql: str) -> dict:
+    masked = _mask(sql)
+    matches = list(_CLAUSES.finditer(masked))
+    names = [re.sub(r"\s+", " ", match.group(1).lower()) for match in matches]
+    if not names or names[0] != "select" or masked[:matches[0].start()].strip() or len(set(names)) != len(names):
+        return None
+    clauses = {}
+    for match, name, following in zip(matches, names, matches[1:] + [None]):
+        clauses[name] = sql[match.end():following.start() if following else len(sql)].strip()
+    return clauses
+
+
+def _columnName(expression: str) -> str:
+    # "oi.revenue" -> "revenue", anything else -> a slug of the expression
+    reference = re.fullmatch(r"(?:[\w$]+\.)?\"?([\w$]+)\"?", expression.strip().strip("`"))
+    name = reference.group(1) if reference else re.sub(r"\W+", "_", expression).strip("_")
+    return name.lower()[:40] or "value"
+
+
+def _alias(item: str) -> tuple:
+    """
+    Returns:
+        tuple: The expression of a select item and its alias, or None when it has none.
+    """
+    masked = _mask(item)
+    match = _ALIAS.search(masked)
+    if match is None:
+        return item, None
+    before = masked[:match.start()].rstrip()
+    name = item[match.start(2):match.end(2)].strip('"`')
+    if not match.group(1):
+        # Without AS, only a plain word after a complete expression is an alias, not "CASE ... END" or "NOT x"
+        last_word = re.search(r"([\w$]+)$", before)
+        if (not before or name.lower() in _KEYWORDS or not re.search(r"[\w$)'\"`\]]$", before)
+                or (last_word and last_word.group(1).lower() in _KEYWORDS)):
+            return item, None
+    return item[:match.start()].strip(), name
+
+
+def _calls(expression: str) -> list:
+    """
+    Returns:
+        list: (function, argument) of every aggregate call in an expression, or None if one can't be summarized.
+    """
+    masked = _mask(expression, parentheses=False)
+    if re.search(r"\bover\s*\(", masked, re.IGNORECASE):
+        return None
+    calls = []
+    for match in _CALLS.finditer(masked):
+        depth, end = 1, match.end()
+        while depth and end < len(masked):
+            depth += {"(": 1, ")": -1}.get(masked[end], 0)
+            end += 1
+        argument = expression[match.end():end - 1].strip()
+        if re.match(r"distinct\b", argument, re.IGNORECASE) or _CALLS.search(argument):
+            # COUNT(DISTINCT x) can't be added up across groups, and nested aggregates aren't valid SQL anyway
+            return None
+        calls.append((match.group(1).lower(), argument))
+    return calls
+
+
+def _digest(*parts) -> str:
+    return hashlib.sha1("\x00".join(parts).encode()).hexdigest()[:6]
+
+
+@dataclass
+class Summary:
+    """
+    A summary table: the result of grouping `source` by `keys`, with the measures the mined queries aggregate.
+
+    `keys` are [expression, column] pairs and `measures` [function, argument] pairs, where the function is one
+    of count, sum, min or max and "*" is the argument of COUNT(*).
+    """
+    name: str
+    baseTable: str
+    source: str
+    where: str = None
+    keys: list = field(default_factory=list)
+    measures: list = field(default_factory=list)
+    refreshedAt: float = None
+    rowCount: int = None
+
+    @property
+    def pattern(self) -> tuple:
+        """The identity of the grouping: queries with the same one can be answered from the same table."""
+        return (canonicalizeSql(self.source), canonicalizeSql(self.where or ""),
+                tuple(sorted(canonicalizeSql(expression) for expression, _ in self.keys)))
+
+    def measureColumns(self) -> list:
+        """
+        Returns:
+            list: (function, argument, column) of every measure, e.g. ("sum", "oi.revenue", "sum_revenue").
+        """
+        columns, taken = [], {column for _, column in self.keys}
+        for function, argument in sorted(self.measures):
+            column = "row_count" if argument == "*" else f"{function}_{_columnName(argument)}"
+            while column in taken:
+                column += "_"
+            taken.add(column)
+            columns.append((function, argument, column))
+        return columns
+
+    def selectSql(self, quote=lambda name: name) -> str:
+        """
+        Args:
+            quote: Quotes a column name for the dialect.
+
+        Returns:
+            str: The query computing the table's content.
+        """
+        items = [f"{expression} AS {quote(column)}" for expression, column in self.keys]
+        items += [f"{function.upper()}({argument}) AS {quote(column)}"
+                  for function, argument, column in self.measureColumns()]
+        where = f" WHERE {self.where}" if self.where else ""
+        group_by = ", ".join(expression for expression, _ in self.keys)
+        return f"SELECT {', '.join(items)} FROM {self.source}{where} GROUP BY {group_by}"
+
+    def describe(self) -> str:
+        """
+        Returns:
+            str: What the table pre-aggregates, for the schema given to the LLM.
+        """
+        keys = ", ".join(column if _columnName(expression) == column else f"{column}={expression}"
+                         for expression, column in self.keys)
+        measures = ", ".join(f"{column}={function.upper()}({argument})"
+                             for function, argument, column in self.measureColumns())
+        where = f" WHERE {self.where}" if self.where else ""
+        refreshed = time.strftime("%Y-%m-%d %H:%M UTC", time.gmtime(self.refreshedAt)) if self.refreshedAt else "never"
+        rows = f", {self.rowCount} rows" if self.rowCount is not None else ""
+        return (f"summary of {self.baseTable}: one row per {keys} over {self.source}{where}{rows}; {measures}; "
+                f"refreshed {refreshed}. Prefer it to aggregating {self.baseTable} by these keys (SUM the sum_/"
+                f"count_ columns, MIN/MAX the min_/max_ ones, averages are sum_x/count_x)")
+
+    def merge(self, other: "Summary"):
+        """Add the measures of a query with the same pattern."""
+        self.measures = sorted({tuple(measure) for measure in self.measures + other.measures})
+
+
+def parseAggregate(sql: str) -> Summary:
+    """
+    Read the grouping of a query, if a summary table could answer it.
+
+    Args:
+        sql (str): The SQL query.
+
+    Returns:
+        Summary: An unnamed summary of the query's FROM clause, WHERE clause and keys, or None when the query
+            is not a single GROUP BY query over tables with re-aggregatable aggregates.
+    """
+    clauses = _clauses(canonicalizeSql(sql))
+    if clauses is None or set(clauses) - {"select", "from", "where", "group by", "having", "order by", "limit"}:
+        return None
+    if not {"from", "group by"} <= set(clauses) or re.match(r"distinct\b", clauses["select"], re.IGNORECASE):
+        return None
+    base = re.match(r"([\w$.\"`]+)", clauses["from"])
+    if base is None:
+        # Subqueries in FROM are left alone
+        return None
+
+    items, measures = [], set()
+    for item in _split(clauses["select"]):
+        expression, alias = _alias(item)
+        calls = _calls(expression)
+        if calls is None or expression == "*" or expression.endswith(".*"):
+            return None
+        items.append((expression, alias, bool(calls)))
+        for function, argument in calls:
+            if function == "avg":
+                measures |= {("sum", argument), ("count", argument)}
+            else:
+                measures.add((function, argument))
+
+    # HAVING filters the groups with aggregates of its own, which the summary must carry as well
+    having = _calls(clauses.get("having", ""))
+    if having is None:
+        return None
+    for function, argument in having:
+        measures |= {("sum", argument), ("count", argument)} if function == "avg" else {(function, argument)}
+
+    keys, seen = [], set()
+    grouped = []
+    for key in _split(clauses["group by"]):
+        if key.isdigit() and 0 < int(key) <= len(items):
+            key = items[int(key) - 1][0]
+        # Output aliases are allowed in GROUP BY by SQLite, MySQL and PostgreSQL
+        key = next((expression for expression, alias, _ in items if alias and alias.lower() == key.lower()), key)
+        grouped.append(key)
+    # Plain select items depend on the keys (or the query is invalid), so they are kept as keys too
+    grouped += [expression for expression, _, aggregated in items if not aggregated]
+    for expression in grouped:
+        if _calls(expression):
+            return None
+        if canonicalizeSql(expression) in seen:
+            continue
+        seen.add(canonicalizeSql(expression))
+        alias = next((alias for item, alias, _ in items
+                      if alias and canonicalizeSql(item) == canonicalizeSql(expression)), None)
+        column = (alias or _columnName(expression)).lower()
+        while column in {name for _, name in keys}:
+            column += "_"
+        keys.append([expression, column])
+    if not measures:
+        measures.add(("count", "*"))
+    return Summary(name=None, baseTable=base.group(1).split(".")[-1].strip('"`').lower(), source=clauses["from"],
+                   where=clauses.get("where"), keys=keys, measures=sorted(measures))
+
+
+@dataclass
+class Suggestion:
+    summary: Summary
+    queries: int
+    medianSeconds: float
+    totalSeconds: float
+
+
+def _summaryName(summary: Summary, taken: dict) -> str:
+    # Readable when possible; the digest tells apart patterns with the same table and key names
+    name = f"{SUMMARY_PREFIX}{summary.baseTable}_by_{'_'.join(column for _, column in summary.keys)}"
+    name = re.sub(r"[^\w]+", "_", name).lower()
+    # Short enough for PostgreSQL's 63 characters once STAGING_SUFFIX is appended
+    if len(name) > 40 or summary.where or taken.get(name, summary.pattern) != summary.pattern:
+        name = f"{name[:40]}_{_digest(*map(str, summary.pattern))}"
+    taken[name] = summary.pattern
+    return name
+
+
+def _summarySettings(minQueries, minSeconds, maxTables):
+    minQueries = int(os.getenv("SUMMARY_MIN_QUERIES", "3")) if minQueries is None else minQueries
+    minSeconds = float(os.getenv("SUMMARY_MIN_SECONDS", "0.1")) if minSeconds is None else minSeconds
+    maxTables = int(os.getenv("SUMMARY_MAX_TABLES", "10")) if maxTables is None else maxTables
+    return minQueries, minSeconds, maxTables
+
+
+def suggestSummaries(db, minQueries: int = None, minSeconds: float = None, maxTables: int = None,
+                     since: float = 0.0) -> list:
+    """
+    Mine the query log of a connection for GROUP BY patterns worth a summary table.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        minQueries (int): Logged runs a pattern needs. Defaults to SUMMARY_MIN_QUERIES or 3.
+        minSeconds (float): Median execution time a pattern needs. Defaults to SUMMARY_MIN_SECONDS or 0.1.
+        maxTables (int): Maximum number of suggestions. Defaults to SUMMARY_MAX_TABLES or 10.
+        since (float): Only consider queries logged after this UNIX time.
+
+    Returns:
+        list: Suggestions, the ones that cost the most execution time in total first.
+    """
+    minQueries, minSeconds, maxTables = _summarySettings(minQueries, minSeconds, maxTables)
+    patterns, timings = {}, {}
+    for sql, seconds, _, _ in getQueryLog().entries(queryScope(db), since):
+        if any(table.startswith(SUMMARY_PREFIX) for table in extractTables(sql)):
+            # Already answered from a summary
+            continue
+        summary = parseAggregate(sql)
+        if summary is None:
+            continue
+        if summary.pattern in patterns:
+            patterns[summary.pattern].merge(summary)
+        else:
+            patterns[summary.pattern] = summary
+        timings.setdefault(summary.pattern, []).append(seconds)
+    suggestions = [Suggestion(patterns[pattern], len(seconds), statistics.median(seconds), sum(seconds))
+                   for pattern, seconds in timings.items()
+                   if len(seconds) >= minQueries and statistics.median(seconds) >= minSeconds]
+    suggestions.sort(key=lambda suggestion: -suggestion.totalSeconds)
+    taken = {}
+    for suggestion in suggestions[:maxTables]:
+        suggestion.summary.name = _summaryName(suggestion.summary, taken)
+    return suggestions[:maxTables]
+
+
+def loadSummaries(db, schemaIndex=None) -> dict:
+    """
+    Read the registry of a connection's summary tables.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        schemaIndex (SchemaIndex): The current catalog, which spares a query when there is no registry and
+            leaves out summaries whose table is gone.
+
+    Returns:
+        dict: The summaries by table name.
+    """
+    if schemaIndex is not None:
+        if REGISTRY_TABLE not in schemaIndex.tables:
+            return {}
+    elif not inspect(db._engine).has_table(REGISTRY_TABLE):
+        return {}
+    with db._engine.connect() as connection:
+        rows = connection.execute(select(_REGISTRY)).mappings().fetchall()
+    summaries = {}
+    for row in rows:
+        if schemaIndex is not None and row["name"] not in schemaIndex.tables:
+            continue
+        summaries[row["name"]] = Summary(**json.loads(row["definition"]), name=row["name"],
+                                         refreshedAt=row["refreshed_at"], rowCount=row["row_count"])
+    return summaries
+
+
+def summaryNotes(summaries: dict) -> dict:
+    """
+    Returns:
+        dict: The schema note of every summary table and of every table that has summaries, by table name.
+    """
+    maxAge = float(os.getenv("SUMMARY_MAX_AGE", "0"))
+    notes, bases = {}, {}
+    for name, summary in summaries.items():
+        if maxAge and time.time() - (summary.refreshedAt or 0) > maxAge:
+            # A summary the schedule stopped refreshing would give stale answers
+            continue
+        notes[name] = summary.describe()
+        bases.setdefault(summary.baseTable, []).append(name)
+    for base, names in bases.items():
+        notes[base] = f"pre-aggregated in {', '.join(sorted(names))}"
+    return notes
+
+
+def isInternalTable(tableName: str) -> bool:
+    """
+    Returns:
+        bool: Whether a table is the registry or a summary being rebuilt, which the LLM must not see.
+    """
+    return tableName == REGISTRY_TABLE or (tableName.startswith(SUMMARY_PREFIX) and tableName.endswith(STAGING_SUFFIX))
+
+
+def _copyTyped(connection, staging: str, target: str):
+    # SQLite declares no type for computed columns of CREATE TABLE AS, which the schema would show as
+    # "nulltype"; the (small) summary is copied into a table typed after its first row instead
+    cursor = connection.execute(text(f"SELECT * FROM {staging} LIMIT 1"))
+    columns, row = list(cursor.keys()), cursor.fetchone() or ()
+    types = {int: "INTEGER", float: "REAL", str: "TEXT", bytes: "BLOB"}
+    quote = connection.dialect.identifier_preparer.quote
+    definitions = [f"{quote(column)} {types.get(type(value), '')}".strip()
+                   for column, value in zip(columns, row or [None] * len(columns))]
+    connection.execute(text(f"CREATE TABLE {target} ({', '.join(definitions)})"))
+    connection.execute(text(f"INSERT INTO {target} SELECT * FROM {staging}"))
+    connection.execute(text(f"DROP TABLE {staging}"))
+
+
+def refreshSummary(db, summary: Summary) -> Summary:
+    """
+    Build a summary table under a staging name, then swap it in and record it in the registry.
+
+    The swap is a single transaction on PostgreSQL; MySQL and pysqlite commit DDL statements one by one, so a
+    query may briefly find the table missing there.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        summary (Summary): The summary, named.
+
+    Returns:
+        Summary: The summary with its refresh time and row count.
+    """
+    quote = db._engine.dialect.identifier_preparer.quote
+    staging = quote(summary.name + STAGING_SUFFIX)
+    _REGISTRY.create(db._engine, checkfirst=True)
+    with db._engine.begin() as connection:
+        connection.execute(text(f"DROP TABLE IF EXISTS {staging}"))
+        connection.execute(text(f"CREATE TABLE {staging} AS {summary.selectSql(quote)}"))
+        rowCount = connection.execute(text(f"SELECT COUNT(*) FROM {staging}")).scalar()
+    definition = {key: value for key, value in asdict(summary).items()
+                  if key not in ("name", "refreshedAt", "rowCount")}
+    summary.refreshedAt, summary.rowCount = time.time(), rowCount
+    with db._engine.begin() as connection:
+        connection.execute(text(f"DROP TABLE IF EXISTS {quote(summary.name)}"))
+        if db.dialect == "sqlite":
+            _copyTyped(connection, staging, quote(summary.name))
+        else:
+            connection.execute(text(f"ALTER TABLE {staging} RENAME TO {quote(summary.name)}"))
+        connection.execute(delete(_REGISTRY).where(_REGISTRY.c.name == summary.name))
+        connection.execute(insert(_REGISTRY).values(name=summary.name, base_table=summary.baseTable,
+                                                    definition=json.dumps(definition),
+                                                    refreshed_at=summary.refreshedAt, row_count=rowCount))
+    return summary
+
+
+def _invalidateSchema(db):
+    # Lazy import: schema_cache reads the registry through this module
+    from schema_cache import getSchemaCache
+
+    getSchemaCache(db).invalidate()
+
+
+def refreshSummaries(db, create: bool = False, **settings) -> list:
+    """
+    Refresh every registered summary table, and with `create` also build the current suggestions.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        create (bool): Whether to create the suggested summaries that don't exist yet and to add new measures
+            of their patterns to existing ones. Without it no table is ever created.
+        **settings: Passed to `suggestSummaries`.
+
+    Returns:
+        list: (summary, seconds the refresh took) pairs.
+    """
+    summaries = loadSummaries(db)
+    if create:
+        by_pattern = {summary.pattern: summary for summary in summaries.values()}
+        taken = {name: summary.pattern for name, summary in summaries.items()}
+        for suggestion in suggestSummaries(db, **settings):
+            existing = by_pattern.get(suggestion.summary.pattern)
+            if existing is not None:
+                existing.merge(suggestion.summary)
+            else:
+                suggestion.summary.name = _summaryName(suggestion.summary, taken)
+                summaries[suggestion.summary.name] = suggestion.summary
+    refreshed = []
+    for summary in summaries.values():
+        start = time.perf_counter()
+        refreshSummary(db, summary)
+        refreshed.append((summary, time.perf_counter() - start))
+    if refreshed:
+        _invalidateSchema(db)
+    return refreshed
+
+
+def dropSummary(db, name: str):
+    """
+    Drop a summary table and remove it from the registry.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        name (str): The table name.
+    """
+    quote = db._engine.dialect.identifier_preparer.quote
+    with db._engine.begin() as connection:
+        connection.execute(text(f"DROP TABLE IF EXISTS {quote(name)}"))
+        if inspect(connection).has_table(REGISTRY_TABLE):
+            connection.execute(delete(_REGISTRY).where(_REGISTRY.c.name == name))
+    _invalidateSchema(db)
+
+
+def main():
+    from config import loadConfig
+    from engine_registry import getSqlDatabase
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["suggest", "refresh", "drop"])
+    parser.add_argument("names", nargs="*", help="tables to drop")
+    parser.add_argument("--db-uri", help="defaults to DB_URI")
+    parser.add_argument("--create", action="store_true", help="create the suggested summary tables")
+    parser.add_argument("--every", type=float, help="refresh again every this many seconds")
+    parser.add_argument("--min-queries", type=int)
+    parser.add_argument("--min-seconds", type=float)
+    parser.add_argument("--max-tables", type=int)
+    args = parser.parse_args()
+    loadConfig()
+    if (args.command == "suggest" or args.create) and not os.getenv("QUERY_LOG_PATH"):
+        # The in-memory log of this process is empty: nothing would ever be suggested
+        parser.error("QUERY_LOG_PATH must name the query log file written by the app and the API")
+    db = getSqlDatabase(args.db_uri or os.environ["DB_URI"])
+    settings = {"minQueries": args.min_queries, "minSeconds": args.min_seconds, "maxTables": args.max_tables}
+
+    if args.command == "suggest":
+        for suggestion in suggestSummaries(db, **settings):
+            print(f"{suggestion.summary.name}: {suggestion.queries} queries, median "
+                  f"{suggestion.medianSeconds * 1000:.0f} ms, total {suggestion.totalSeconds:.1f} s\n"
+                  f"    {suggestion.summary.selectSql()}")
+    elif args.command == "drop":
+        for name in args.names:
+            dropSummary(db, name)
+    else:
+        while True:
+            for summary, seconds in refreshSummaries(db, create=args.create, **settings):
+                print(f"{time.strftime('%H:%M:%S')} refreshed {summary.name}: {summary.rowCount} rows in {seconds:.2f}s")
+            if not args.every:
+                break
+            time.sleep(args.every)
+
+
+if __name__ == '__main__':
+    main()
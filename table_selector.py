@@ -0,0 +1,180 @@
+import math
+import os
+import re
+import threading
+import weakref
+from collections import defaultdict
+
+from schema_cache import getSchemaCache
+
+# A hit on the table name says more about relevance than a hit on one of its columns
+TABLE_WEIGHT = 3.0
+COLUMN_WEIGHT = 1.0
+# Share of the selection kept for tables joined to the best matches, which tokens like "id" would crowd out
+NEIGHBOUR_SHARE = 0.4
+
+
+def identifierTokens(text: str) -> list:
+    """
+    Split identifiers and free text into lower-cased, roughly singular word tokens.
+
+    "OrderItems", "order_items" and "order items" all produce ["order", "item"].
+
+    Args:
+        text (str): An identifier, comment or question.
+
+    Returns:
+        list: The tokens.
+    """
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", text or "")
+    tokens = []
+    for word in re.findall(r"[a-z0-9]+", text.lower()):
+        if word.isdigit():
+            continue
+        if len(word) > 3 and word.endswith("ies"):
+            word = word[:-3] + "y"
+        elif len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+
+class TableIndex:
+    """
+    Inverted index from name tokens to tables, built from table, column and comment names.
+
+    Tables are ranked by the IDF-weighted sum of the question tokens that hit them.
+    """
+
+    def __init__(self, schemaIndex, tableNames: list):
+        """
+        Args:
+            schemaIndex (SchemaIndex): The columns and foreign keys of every table, see `utils.SchemaIndex`.
+            tableNames (list): The tables to index.
+        """
+        self.tableNames = list(tableNames)
+        self.foreignKeys = defaultdict(set)
+        row_estimates = {}
+        postings = defaultdict(dict)
+        for name in self.tableNames:
+            for token in identifierTokens(name):
+                postings[token][name] = postings[token].get(name, 0.0) + TABLE_WEIGHT
+            table = schemaIndex.tables.get(name)
+            if table is None:
+                continue
+            row_estimates[name] = table.rowEstimate or 0
+            for token in identifierTokens(table.comment):
+                postings[token][name] = postings[token].get(name, 0.0) + COLUMN_WEIGHT
+            for column in table.columns:
+                for token in set(identifierTokens(column.name) + identifierTokens(column.comment)):
+                    postings[token][name] = postings[token].get(name, 0.0) + COLUMN_WEIGHT
+            self.foreignKeys[name] |= schemaIndex.neighbours(name)
+        # Tables offered when the question matches none: the most joined first, then the biggest
+        self.centralTables = sorted(self.tableNames, key=lambda name: (-len(self.foreignKeys.get(name, ())),
+                                                                       -row_estimates.get(name, 0)))
+        count = max(len(self.tableNames), 1)
+        self.postings = {
+            token: {name: weight * math.log(1 + count / len(hits)) for name, weight in hits.items()}
+            for token, hits in postings.items()
+        }
+
+    def rank(self, question: str) -> list:
+        """
+        Rank the tables against a question.
+
+        Args:
+            question (str): The user's natural language question.
+
+        Returns:
+            list: (table name, score) pairs with a positive score, best first.
+        """
+        scores = defaultdict(float)
+        for token in set(identifierTokens(question)):
+            for name, weight in self.postings.get(token, {}).items():
+                scores[name] += weight
+        return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+    def select(self, question: str, topK: int) -> list:
+        """
+        Pick the tables whose schema should go into the prompt.
+
+        The best matches fill all but a `NEIGHBOUR_SHARE` of the `topK` slots. The rest go to the tables they
+        are joined to through foreign keys, the best scored first, and slots left over go back to the next
+        matches. When nothing matches, the `topK` tables with the most foreign keys, then the most rows,
+        are returned so the LLM still gets a schema of bounded size.
+
+        Args:
+            question (str): The user's natural language question.
+            topK (int): Maximum number of tables returned.
+
+        Returns:
+            list: The selected table names, in schema order.
+        """
+        if len(self.tableNames) <= topK:
+            return list(self.tableNames)
+        scores = dict(self.rank(question))
+        if not scores:
+            selected = self.centralTables[:topK]
+            return [name for name in self.tableNames if name in selected]
+        ranked = list(scores)
+        selected = ranked[:max(1, topK - int(topK * NEIGHBOUR_SHARE))]
+        for name in list(selected):
+            neighbours = [neighbour for neighbour in self.foreignKeys.get(name, ()) if neighbour in self.foreignKeys]
+            for neighbour in sorted(neighbours, key=lambda neighbour: (-scores.get(neighbour, 0.0), neighbour)):
+                if len(selected) >= topK:
+                    break
+                if neighbour not in selected:
+                    selected.append(neighbour)
+        for name in ranked:
+            if len(selected) >= topK:
+                break
+            if name not in selected:
+                selected.append(name)
+        return [name for name in self.tableNames if name in selected]
+
+
+_indexes = weakref.WeakKeyDictionary()
+_indexesLock = threading.Lock()
+
+
+def getTableIndex(db) -> TableIndex:
+    """
+    Return the table index of a connection, rebuilding it whenever the schema snapshot changes.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+
+    Returns:
+        TableIndex: The index over the current schema snapshot.
+    """
+    schema_cache = getSchemaCache(db)
+    # Summary tables aren't ranked on their own; `selectTables` adds them with their base table
+    summaries = schema_cache.getSummaries()
+    table_names = [name for name in schema_cache.getTableNames() if name not in summaries]
+    schema_index = schema_cache.getIndex()
+    with _indexesLock:
+        version, index = _indexes.get(db, (None, None))
+        if version != schema_cache.version:
+            index = TableIndex(schema_index, table_names)
+            _indexes[db] = (schema_cache.version, index)
+        return index
+
+
+def selectTables(db, question: str, topK: int = None) -> list:
+    """
+    Select the tables relevant to a question.
+
+    Args:
+        db (SQLDatabase): The SQLDatabase object representing the connection.
+        question (str): The user's natural language question.
+        topK (int): Maximum number of tables. Defaults to SCHEMA_TOP_K or 5.
+
+    Returns:
+        list: The selected table names.
+    """
+    topK = int(os.getenv("SCHEMA_TOP_K", "5")) if topK is None else topK
+    selected = getTableIndex(db).select(question, topK)
+    # Summaries of the selected tables come on top of topK: one line each, and often the whole answer
+    summaries = getSchemaCache(db).getSummaries()
+    return selected + [name for name, summary in summaries.items()
+                       if summary.baseTable in selected and name not in selected]
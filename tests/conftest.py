@@ -0,0 +1,12 @@
+import pytest
+
+from benchmarks.fixtures import createDatabase
+from engine_registry import getSqlDatabase
+
+
+@pytest.fixture(scope="session")
+def db(tmp_path_factory):
+    """The seeded SQLite database of the benchmarks: the core sales tables plus filler tables."""
+    path = tmp_path_factory.mktemp("db") / "sales.db"
+    createDatabase(str(path), tables=20, rows=500, seed=0)
+    return getSqlDatabase(f"sqlite:///{path}")
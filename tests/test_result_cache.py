@@ -0,0 +1,119 @@
+import pytest
+
+import result_cache
+from query_runner import executeQuery
+from result_cache import ResultCache, cacheableTables, canonicalizeSql, extractTables
+
+
+@pytest.fixture(params=["sqlglot", "tokens"])
+def parser(request, monkeypatch):
+    """Run a test with sqlglot and with the token scan used when it isn't installed."""
+    if request.param == "tokens":
+        monkeypatch.setattr(result_cache, "_tablesWithSqlglot", lambda sql, dialect: None)
+    return request.param
+
+
+class CountingExecute:
+    """`executeQuery` that counts the queries reaching the database."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, db, sql):
+        self.calls += 1
+        return executeQuery(db, sql)
+
+
+def test_canonical_sql_ignores_formatting():
+    assert canonicalizeSql("SELECT  *\n FROM orders -- all of them\n;") == "SELECT * FROM orders"
+    assert canonicalizeSql("SELECT /* all */ * FROM orders") == "SELECT * FROM orders"
+
+
+def test_canonical_sql_keeps_literals():
+    assert canonicalizeSql("SELECT 'a  b' FROM orders") == "SELECT 'a  b' FROM orders"
+    assert canonicalizeSql("SELECT 'a--b' FROM orders") != canonicalizeSql("SELECT 'a--c' FROM orders")
+    assert canonicalizeSql("SELECT '/*' AS x, '*/' AS y FROM orders") == "SELECT '/*' AS x, '*/' AS y FROM orders"
+
+
+@pytest.mark.parametrize("sql, tables", [
+    ("SELECT * FROM orders", {"orders"}),
+    ('SELECT * FROM "main"."Orders" o', {"orders"}),
+    ("SELECT * FROM orders o JOIN customers c ON c.customer_id = o.customer_id, invoices i",
+     {"orders", "customers", "invoices"}),
+    ("SELECT EXTRACT(YEAR FROM order_date) FROM orders", {"orders"}),
+    ("SELECT * FROM (SELECT * FROM orders) AS recent JOIN customers USING (customer_id)", {"orders", "customers"}),
+    ("WITH recent AS (SELECT * FROM orders) SELECT * FROM recent", {"orders"}),
+    ("SELECT * FROM customers WHERE customer_id IN (SELECT customer_id FROM orders)", {"customers", "orders"}),
+    ("SELECT 'FROM invoices' FROM orders -- JOIN products", {"orders"}),
+])
+def test_extract_tables(parser, sql, tables):
+    assert extractTables(sql, "sqlite") == tables
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT * FROM generate_series(1, 10)",
+    "SELECT 1",
+    "DELETE FROM orders",
+])
+def test_uncacheable_queries(parser, sql):
+    assert cacheableTables(sql, "postgresql") is None
+
+
+def test_result_is_cached_until_invalidated(db):
+    cache = ResultCache()
+    execute = CountingExecute()
+    sql = "SELECT COUNT(*) FROM orders"
+    first = cache.run(db, sql, execute)
+    assert cache.run(db, "SELECT COUNT(*)\n  FROM orders;", execute) is first
+    assert execute.calls == 1
+
+    cache.invalidateTables("customers")
+    cache.run(db, sql, execute)
+    assert execute.calls == 1
+
+    cache.invalidateTables("ORDERS")
+    cache.run(db, sql, execute)
+    assert execute.calls == 2
+    assert cache.stats() == {"hits": 2, "misses": 2, "size": 1}
+
+
+def test_result_expires(db):
+    cache = ResultCache(ttl=-1)
+    execute = CountingExecute()
+    cache.run(db, "SELECT COUNT(*) FROM orders", execute)
+    cache.run(db, "SELECT COUNT(*) FROM orders", execute)
+    assert execute.calls == 2
+
+
+def test_uncacheable_query_always_runs(db):
+    cache = ResultCache()
+    execute = CountingExecute()
+    cache.run(db, "SELECT 1", execute)
+    cache.run(db, "SELECT 1", execute)
+    assert execute.calls == 2
+    assert cache.stats()["size"] == 0
+
+
+def test_changed_marker_invalidates_table(db, monkeypatch):
+    cache = ResultCache()
+    markers = {"orders": "1", "customers": "1"}
+    monkeypatch.setattr(cache, "changeMarkers", lambda db, tables: {name: markers[name] for name in tables})
+    execute = CountingExecute()
+    cache.run(db, "SELECT COUNT(*) FROM orders", execute)
+    cache.run(db, "SELECT COUNT(*) FROM customers", execute)
+    markers["orders"] = "2"
+    cache.run(db, "SELECT COUNT(*) FROM orders", execute)
+    cache.run(db, "SELECT COUNT(*) FROM customers", execute)
+    assert execute.calls == 3
+
+
+def test_table_without_marker_is_not_cached(db, monkeypatch):
+    cache = ResultCache()
+    # A view, or a table the statistics don't list yet
+    monkeypatch.setattr(cache, "changeMarkers", lambda db, tables: {"orders": "1"})
+    execute = CountingExecute()
+    sql = "SELECT COUNT(*) FROM orders JOIN customers USING (customer_id)"
+    cache.run(db, sql, execute)
+    cache.run(db, sql, execute)
+    assert execute.calls == 2
+    assert cache.stats()["size"] == 0
@@ -0,0 +1,80 @@
+from langchain_core.messages import AIMessage, HumanMessage
+
+import sql_cache
+from sql_cache import SqlCache, cacheScope, isFollowUp, normalizeQuestion
+
+SQL = "SELECT COUNT(*) FROM customers"
+
+
+def test_hit_after_put():
+    cache = SqlCache()
+    question = normalizeQuestion("How many customers are there?")
+    assert cache.get("scope", question) is None
+    cache.put("scope", question, SQL)
+    assert cache.get("scope", normalizeQuestion("how many  customers are there")) == SQL
+    assert cache.get("other scope", question) is None
+    assert cache.stats() == {"hits": 1, "fuzzy_hits": 0, "misses": 2, "size": 1}
+
+
+def test_entries_expire():
+    cache = SqlCache(ttl=-1)
+    cache.put("scope", "how many customers are there", SQL)
+    assert cache.get("scope", "how many customers are there") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = SqlCache(maxSize=2)
+    cache.put("scope", "first", "SELECT 1")
+    cache.put("scope", "second", "SELECT 2")
+    cache.get("scope", "first")
+    cache.put("scope", "third", "SELECT 3")
+    assert cache.get("scope", "first") == "SELECT 1"
+    assert cache.get("scope", "second") is None
+
+
+def test_discard_drops_every_question_served_by_a_query():
+    cache = SqlCache()
+    cache.put("scope", "how many customers are there", SQL)
+    cache.put("scope", "count the customers", SQL)
+    cache.put("other scope", "count the customers", SQL)
+    cache.discard("scope", SQL)
+    assert cache.get("scope", "how many customers are there") is None
+    assert cache.get("scope", "count the customers") is None
+    assert cache.get("other scope", "count the customers") == SQL
+
+
+def test_similar_question_hits():
+    cache = SqlCache(similarity=0.8)
+    cache.put("scope", "how many customers are there", SQL)
+    assert cache.get("scope", "how many customers are there now") == SQL
+    assert cache.get("scope", "average salary per department") is None
+    assert cache.stats()["fuzzy_hits"] == 1
+
+
+def test_persisted_entries_keep_hit_recency(tmp_path, monkeypatch):
+    monkeypatch.setattr(sql_cache, "USED_FLUSH_EVERY", 1)
+    path = str(tmp_path / "sql_cache.db")
+    cache = SqlCache(path=path)
+    cache.put("scope", "first", "SELECT 1")
+    cache.put("scope", "second", "SELECT 2")
+    cache.get("scope", "first")
+
+    reloaded = SqlCache(maxSize=1, path=path)
+    assert reloaded.get("scope", "first") == "SELECT 1"
+    assert reloaded.get("scope", "second") is None
+
+
+def test_follow_up_questions():
+    assert isFollowUp(normalizeQuestion("And what about those in 2023?"))
+    assert isFollowUp(normalizeQuestion("show their emails"))
+    assert not isFollowUp(normalizeQuestion("How many customers are there?"))
+
+
+def test_scope_depends_on_history_only_for_follow_ups(db):
+    history = [HumanMessage(content="list the 20 most recent orders"), AIMessage(content="Here they are.")]
+    other_history = [HumanMessage(content="top 10 customers by revenue"), AIMessage(content="Here they are.")]
+    question = "how many customers are there"
+    assert cacheScope(db, question, history) == cacheScope(db, question, other_history) == cacheScope(db, question, [])
+    follow_up = "and how many of them paid?"
+    assert cacheScope(db, follow_up, history) != cacheScope(db, follow_up, other_history)
@@ -0,0 +1,72 @@
+import pytest
+
+import sql_guard
+from benchmarks.fixtures import INVALID_SQL
+from sql_guard import QueryRejected, checkStatement, guardQuery
+
+
+@pytest.fixture(params=["sqlglot", "tokens"])
+def parser(request, monkeypatch):
+    """Run a test with sqlglot and with the token-level fallback used when it isn't installed."""
+    if request.param == "tokens":
+        monkeypatch.setattr(sql_guard, "_checkWithSqlglot", lambda sql, dialect, limit: None)
+    return request.param
+
+
+@pytest.mark.parametrize("sql", [
+    "DROP TABLE orders",
+    "DELETE FROM orders",
+    "UPDATE orders SET status = 'paid'",
+    "SELECT 1; DELETE FROM orders",
+    "SELECT * FROM orders; SELECT * FROM customers",
+    "WITH gone AS (DELETE FROM orders RETURNING *) SELECT * FROM gone",
+])
+def test_rejects_writes_and_multiple_statements(parser, sql):
+    with pytest.raises(QueryRejected):
+        checkStatement(sql, "sqlite", limit=10)
+
+
+def test_rejects_empty_query(parser):
+    with pytest.raises(QueryRejected):
+        checkStatement("```sql\n```", "sqlite")
+
+
+def test_adds_limit_once(parser):
+    assert checkStatement("SELECT * FROM orders", "sqlite", limit=10) == "SELECT * FROM orders LIMIT 10"
+    assert checkStatement("SELECT * FROM orders LIMIT 5", "sqlite", limit=10) == "SELECT * FROM orders LIMIT 5"
+    assert checkStatement("SELECT * FROM orders", "sqlite") == "SELECT * FROM orders"
+
+
+def test_strips_code_fence_and_semicolon(parser):
+    assert checkStatement("```sql\nSELECT * FROM orders;\n```", "sqlite", limit=10) == \
+        "SELECT * FROM orders LIMIT 10"
+
+
+def test_keywords_inside_literals_are_allowed(parser):
+    sql = "SELECT * FROM orders WHERE status = 'a--b; drop'"
+    checked = checkStatement(sql, "sqlite", limit=10)
+    assert "'a--b; drop'" in checked
+    assert checked.endswith("LIMIT 10")
+
+
+def test_token_fallback_returns_query_unchanged(monkeypatch):
+    monkeypatch.setattr(sql_guard, "_checkWithSqlglot", lambda sql, dialect, limit: None)
+    sql = "select  status,\n  count(*) from orders /* per status */ group by status"
+    assert checkStatement(sql, "sqlite", limit=10) == f"{sql} LIMIT 10"
+    # A trailing comment would swallow the LIMIT
+    assert checkStatement(f"{sql} -- done;", "sqlite", limit=10) == f"{sql} LIMIT 10"
+
+
+def test_guard_accepts_and_limits(db):
+    sql = guardQuery(db, "SELECT * FROM orders WHERE status = 'paid'", limit=10)
+    assert sql.endswith("LIMIT 10")
+
+
+@pytest.mark.parametrize("sql", [
+    INVALID_SQL,
+    "SELECT * FROM orders, customers",
+    "DELETE FROM orders",
+])
+def test_guard_rejects(db, sql):
+    with pytest.raises(QueryRejected):
+        guardQuery(db, sql, limit=10)
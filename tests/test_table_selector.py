@@ -0,0 +1,35 @@
+from table_selector import getTableIndex, identifierTokens, selectTables
+
+
+def test_identifier_tokens():
+    assert identifierTokens("OrderItems") == identifierTokens("order_items") == ["order", "item"]
+    assert identifierTokens("categories") == ["category"]
+
+
+def test_best_match_comes_with_its_join_table(db):
+    index = getTableIndex(db)
+    question = "customer audit ticket"
+    # Filler tables outrank orders, which only the foreign keys connect to the question
+    assert "orders" not in [name for name, _ in index.rank(question)[:3]]
+    selected = index.select(question, 3)
+    assert len(selected) == 3
+    assert {"customers", "orders"} <= set(selected)
+
+
+def test_selection_keeps_schema_order(db):
+    selected = selectTables(db, "which customers have unpaid invoices", topK=3)
+    assert selected == [name for name in db.get_usable_table_names() if name in selected]
+    assert {"customers", "invoices"} <= set(selected)
+
+
+def test_no_match_returns_bounded_central_tables(db):
+    index = getTableIndex(db)
+    selected = index.select("zzz qqq", 3)
+    assert len(selected) == 3
+    assert set(selected) == set(index.centralTables[:3])
+    assert "orders" in selected
+
+
+def test_small_schema_is_returned_whole(db):
+    index = getTableIndex(db)
+    assert index.select("zzz qqq", len(index.tableNames)) == index.tableNames
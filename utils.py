@@ -1,30 +1,275 @@
-import sqlite3
+import hashlib
+import json
+import os
+import re
+from dataclasses import asdict, dataclass, field
 
-def getDatabaseSchema(database_path):
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from engine_registry import getEngine
+
+# Planner statistics giving a row count per table without scanning it
+ROW_ESTIMATE_QUERIES = {
+    "postgresql": """
+        SELECT c.relname, c.reltuples
+        FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = current_schema() AND c.relkind IN ('r', 'p')
+    """,
+    "mysql": """
+        SELECT table_name, table_rows
+        FROM information_schema.tables
+        WHERE table_schema = DATABASE()
+    """,
+    # Only present once ANALYZE has run; the first number of `stat` is the row count. Tables with an index
+    # only have rows for their indexes (a partial index counts fewer rows), hence the MAX
+    "sqlite": "SELECT tbl, MAX(CAST(stat AS INTEGER)) FROM sqlite_stat1 GROUP BY tbl",
+}
+
+# Long type names shortened in the compact serialization
+TYPE_ABBREVIATIONS = [
+    (r"character varying", "varchar"),
+    (r"\s+with(out)? time zone", ""),
+    (r"double precision", "double"),
+    (r"\binteger\b", "int"),
+    (r"\bboolean\b", "bool"),
+]
+
+
+@dataclass
+class ColumnSchema:
+    name: str
+    type: str
+    nullable: bool = True
+    primaryKey: bool = False
+    references: str = None
+    comment: str = None
+
+
+@dataclass
+class TableSchema:
+    name: str
+    columns: list = field(default_factory=list)
+    rowEstimate: int = None
+    comment: str = None
+
+    def serialize(self) -> str:
+        """
+        Returns:
+            str: One compact line, e.g. "orders(order_id:int PK,customer_id:int->customers.customer_id) ~20000 rows".
+        """
+        columns = []
+        for column in self.columns:
+            entry = f"{column.name}:{column.type}"
+            if column.primaryKey:
+                entry += " PK"
+            if column.references:
+                entry += f"->{column.references}"
+            columns.append(entry)
+        line = f"{self.name}({','.join(columns)})"
+        if self.rowEstimate is not None:
+            line += f" ~{self.rowEstimate} rows"
+        if self.comment:
+            line += f" -- {self.comment}"
+        return line
+
+
+@dataclass
+class SchemaIndex:
+    """
+    In-memory description of every table of a database: columns, types, keys, foreign keys and row estimates.
+    """
+    tables: dict = field(default_factory=dict)
+    fingerprint: str = None
+
+    def serialize(self, tableNames: list = None) -> str:
+        """
+        Serialize tables in the compact prompt format, one line per table with foreign keys inlined as edges.
+
+        Args:
+            tableNames (list): Optional subset of tables. Defaults to every table.
+
+        Returns:
+            str: The compact schema.
+        """
+        names = self.tables if tableNames is None else tableNames
+        return "\n".join(self.tables[name].serialize() for name in names if name in self.tables)
+
+    def neighbours(self, tableName: str) -> set:
+        """
+        Returns:
+            set: The tables linked to `tableName` by a foreign key, in either direction.
+        """
+        linked = set()
+        for table in self.tables.values():
+            for column in table.columns:
+                if not column.references:
+                    continue
+                referred = column.references.rsplit(".", 1)[0]
+                if table.name == tableName:
+                    linked.add(referred)
+                elif referred == tableName:
+                    linked.add(table.name)
+        linked.discard(tableName)
+        return linked
+
+    def save(self, path: str):
+        """
+        Write the index to a JSON file, atomically.
+
+        Row estimates are left out: they change with the data, which the fingerprint doesn't cover.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        data = asdict(self)
+        for table in data["tables"].values():
+            table["rowEstimate"] = None
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "w", encoding="utf-8") as file:
+            json.dump(data, file)
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path: str):
+        """
+        Returns:
+            SchemaIndex: The index saved at `path`.
+        """
+        with open(path, encoding="utf-8") as file:
+            data = json.load(file)
+        tables = {
+            name: TableSchema(**{**table, "columns": [ColumnSchema(**column) for column in table["columns"]]})
+            for name, table in data["tables"].items()
+        }
+        return cls(tables=tables, fingerprint=data.get("fingerprint"))
+
+
+def _typeName(columnType, dialect) -> str:
+    try:
+        name = columnType.compile(dialect=dialect)
+    except Exception:
+        name = type(columnType).__name__
+    name = name.lower()
+    for pattern, replacement in TYPE_ABBREVIATIONS:
+        name = re.sub(pattern, replacement, name)
+    return name
+
+
+def _rowEstimates(connection, dialect: str) -> dict:
+    query = ROW_ESTIMATE_QUERIES.get(dialect)
+    if query is None:
+        return {}
     try:
-        connection = sqlite3.connect(database_path)
-        cursor = connection.cursor()
+        rows = connection.execute(text(query)).fetchall()
+    except SQLAlchemyError:
+        # e.g. sqlite_stat1 doesn't exist before the first ANALYZE
+        return {}
+    # PostgreSQL reports -1 for tables that were never analyzed
+    return {name: int(count) for name, count in rows if count is not None and count >= 0}
 
-        # Query to retrieve table schema
-        cursor.execute("PRAGMA table_info(student)")
 
-        # Fetch all rows
-        schema_rows = cursor.fetchall()
+def introspectSchema(engine, fingerprint: str = None) -> SchemaIndex:
+    """
+    Read the catalog of a SQLite, MySQL or PostgreSQL database with a handful of batched inspector calls.
 
-        # Close cursor and connection
-        cursor.close()
-        connection.close()
+    Args:
+        engine (Engine): The SQLAlchemy engine of the connection.
+        fingerprint (str): Optional catalog fingerprint stored with the index, see `schema_cache`.
 
-        # Extract table schema
-        schema = {row[1]: row[2] for row in schema_rows}
+    Returns:
+        SchemaIndex: Every table of the default schema.
+    """
+    with engine.connect() as connection:
+        inspector = inspect(connection)
+        columns = inspector.get_multi_columns()
+        primary_keys = inspector.get_multi_pk_constraint()
+        foreign_keys = inspector.get_multi_foreign_keys()
+        try:
+            comments = inspector.get_multi_table_comment()
+        except NotImplementedError:
+            comments = {}
+        row_estimates = _rowEstimates(connection, engine.dialect.name)
 
-        return schema
+    index = SchemaIndex(fingerprint=fingerprint)
+    for key in sorted(columns, key=lambda key: key[1]):
+        name = key[1]
+        primary = set((primary_keys.get(key) or {}).get("constrained_columns") or ())
+        references = {}
+        for foreign_key in foreign_keys.get(key, ()):
+            for column, referred in zip(foreign_key["constrained_columns"], foreign_key["referred_columns"]):
+                references[column] = f"{foreign_key['referred_table']}.{referred}"
+        index.tables[name] = TableSchema(
+            name=name,
+            columns=[ColumnSchema(name=column["name"], type=_typeName(column["type"], engine.dialect),
+                                  nullable=bool(column.get("nullable", True)),
+                                  primaryKey=column["name"] in primary,
+                                  references=references.get(column["name"]),
+                                  comment=column.get("comment"))
+                     for column in columns[key]],
+            rowEstimate=row_estimates.get(name),
+            comment=(comments.get(key) or {}).get("text"),
+        )
+    return index
 
-    except sqlite3.Error as e:
-        print(f"An error occurred: {e}")
+
+def schemaIndexPath(engine) -> str:
+    """
+    Returns:
+        str: The file the schema index of a connection is persisted to, or None if SCHEMA_INDEX_DIR is not set.
+    """
+    directory = os.getenv("SCHEMA_INDEX_DIR")
+    if not directory:
         return None
+    url = engine.url.render_as_string(hide_password=True)
+    return os.path.join(directory, hashlib.sha1(url.encode()).hexdigest()[:16] + ".json")
+
+
+def loadSchemaIndex(engine, fingerprint: str = None) -> SchemaIndex:
+    """
+    Return the schema index of a connection from disk when its fingerprint still matches, else introspect it.
+
+    An index read from disk gets current row estimates, with a single catalog query.
 
-# Example usage:
-schema = getDatabaseSchema("student.db")
-print("Database Schema:")
-print(schema)
+    Args:
+        engine (Engine): The SQLAlchemy engine of the connection.
+        fingerprint (str): The current catalog fingerprint. Without one, the index on disk is never trusted.
+
+    Returns:
+        SchemaIndex: The schema index.
+    """
+    path = schemaIndexPath(engine)
+    if path and fingerprint and os.path.exists(path):
+        try:
+            index = SchemaIndex.load(path)
+            if index.fingerprint == fingerprint:
+                with engine.connect() as connection:
+                    row_estimates = _rowEstimates(connection, engine.dialect.name)
+                for name, table in index.tables.items():
+                    table.rowEstimate = row_estimates.get(name)
+                return index
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+    index = introspectSchema(engine, fingerprint)
+    if path and fingerprint:
+        index.save(path)
+    return index
+
+
+def getDatabaseSchema(database_path):
+    """
+    Describe every table of a database.
+
+    The result is keyed by table, where it used to map the columns of the "student" table only.
+
+    Args:
+        database_path (str): A SQLite file path or an SQLAlchemy connection URI.
+
+    Returns:
+        dict: {table name: {column name: type}}, e.g. {"student": {"name": "varchar(25)", ...}}, or None if the
+            database can't be read.
+    """
+    uri = database_path if "://" in database_path else f"sqlite:///{database_path}"
+    try:
+        index = introspectSchema(getEngine(uri))
+    except SQLAlchemyError:
+        return None
+    return {name: {column.name: column.type for column in table.columns} for name, table in index.tables.items()}